@@ -1,14 +1,12 @@
 from flask import Flask, request, jsonify, send_file
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from datetime import datetime, timedelta
 import pandas as pd
 import os
 from werkzeug.utils import secure_filename
 import json
 
-from utils.docx_filler import fill_document
-
 # For mail
 from flask import Flask, render_template, request
 from flask_mail import Mail, Message
@@ -24,11 +22,53 @@ app = Flask(__name__)
 CORS(app)
 
 # Database configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///timesheet.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URI', 'sqlite:///timesheet.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Cold storage for old, fully paid invoices (see archive_invoices)
+app.config['SQLALCHEMY_BINDS'] = {'archive': os.getenv('ARCHIVE_DATABASE_URI', 'sqlite:///invoice_archive.db')}
+app.config['ARCHIVE_HORIZON_MONTHS'] = int(os.getenv('ARCHIVE_HORIZON_MONTHS', 24))
+# Concurrent writers (batch runs, several workers) wait for SQLite's write lock instead of failing at once
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'connect_args': {'timeout': 30}}
+# Reporting reads: 'off' (primary), 'snapshot' (backup copy of the SQLite file) or 'replica' (READ_DATABASE_URI)
+app.config['READ_ROUTING'] = os.getenv('READ_ROUTING', 'off')
+app.config['READ_DATABASE_URI'] = os.getenv('READ_DATABASE_URI')
+app.config['READ_SNAPSHOT_PATH'] = os.getenv('READ_SNAPSHOT_PATH')  # defaults to <primary db>.snapshot
+app.config['READ_MAX_STALENESS'] = int(os.getenv('READ_MAX_STALENESS', 60))  # oldest snapshot a report may read
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['DOCUMENTS_FOLDER'] = 'documents'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
+app.config['PROFILES_FOLDER'] = 'profiles'
+# Per-request profiling: send 'X-Profile: 1' (or ?profile=1); off unless enabled
+app.config['PROFILING_ENABLED'] = os.getenv('PROFILING_ENABLED', 'false').lower() == 'true'
+app.config['PROFILING_TOKEN'] = os.getenv('PROFILING_TOKEN')  # When set, X-Profile-Token must match
+app.config['PROFILES_KEEP'] = 200
+app.config['TEMPLATES_FOLDER'] = os.getenv('TEMPLATES_FOLDER', os.path.join(app.root_path, 'templates'))
+app.config['TEMPLATE_CACHE_SIZE'] = int(os.getenv('TEMPLATE_CACHE_SIZE', 32))
+app.config['DEFAULT_UPLOAD_LIMIT'] = 16 * 1024 * 1024
+# Per-endpoint request body limits (bytes); anything not listed gets DEFAULT_UPLOAD_LIMIT
+app.config['UPLOAD_LIMITS'] = {
+    'generate_invoice_from_archive': int(os.getenv('ARCHIVE_UPLOAD_LIMIT', 512 * 1024 * 1024)),
+    'import_companies': 64 * 1024 * 1024,
+}
+app.config['ARCHIVE_MEMBER_LIMIT'] = 64 * 1024 * 1024  # Largest single workbook accepted from a zip
+# Endpoints not listed in UPLOAD_LIMITS; see EndpointLimitedRequest for the per-endpoint ceiling
+app.config['MAX_CONTENT_LENGTH'] = app.config['DEFAULT_UPLOAD_LIMIT']
+app.config['CACHE_URL'] = os.getenv('CACHE_URL')  # e.g. redis://localhost:6379/0, in-process LRU when unset
+app.config['CACHE_DEFAULT_TTL'] = int(os.getenv('CACHE_DEFAULT_TTL', 300))
+app.config['CACHE_MAX_ENTRIES'] = int(os.getenv('CACHE_MAX_ENTRIES', 1024))
+app.config['RATE_LIMIT_URL'] = os.getenv('RATE_LIMIT_URL')  # shared bucket store; in-process when unset
+# scope -> {key kind: (burst capacity, seconds to refill the full bucket)}
+app.config['RATE_LIMITS'] = {
+    'login': {'ip': (20, 60), 'email': (5, 300)},
+    'send_code': {'ip': (5, 600), 'email': (3, 600)},
+    'register': {'ip': (10, 600), 'email': (5, 600)},
+}
+app.config['OTP_TTL_SECONDS'] = 10 * 60
+app.config['TIMESHEET_MAX_DAILY_HOURS'] = float(os.getenv('TIMESHEET_MAX_DAILY_HOURS', 12))
+# Only used when the fx_rate table has no rate at all for a currency
+app.config['FX_FALLBACK_RATES'] = {'USD': float(os.getenv('USD_INR_FALLBACK_RATE', 85))}
+app.config['FX_CACHE_TTL'] = int(os.getenv('FX_CACHE_TTL', 60))  # seconds a worker trusts its in-memory rates
+# Werkzeug hash spec, e.g. 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'; see `python -m invoice_generator bench-hash`
+app.config['PASSWORD_HASH_METHOD'] = os.getenv('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')  # Werkzeug's default
 app.config['MAIL_SERVER'] = 'smtp.gmail.com'
 app.config['MAIL_PORT'] = 465
 app.config['MAIL_USERNAME'] = sender_email
@@ -44,7 +84,135 @@ mail = Mail(app)
 def generate_verifaction_code():
     return str(random.randint(100000,999999))
 
-db = SQLAlchemy(app)
+# =====================================
+# READ ROUTING
+# =====================================
+import sqlite3
+import threading
+import time
+from functools import wraps
+from flask import g, has_request_context, make_response
+from flask_sqlalchemy.session import Session as FlaskSession
+from sqlalchemy import create_engine
+from sqlalchemy.sql.dml import UpdateBase
+
+class ReadRoutingSession(FlaskSession):
+    """
+    Sends default-bind reads to the read engine chosen for the request (see
+    read_routed). Flushes and INSERT/UPDATE/DELETE statements always use the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        primary = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        if bind is not None or self._flushing or isinstance(clause, UpdateBase) or not has_request_context():
+            return primary
+        read_engine = g.get('read_engine')
+        if read_engine is not None and primary is db.engine:
+            return read_engine
+        return primary
+
+class SnapshotReader:
+    """
+    A read-only copy of the primary SQLite file made with the online backup API.
+    A background thread refreshes it every READ_MAX_STALENESS / 2 seconds; requests
+    never wait for a copy and fall back to the primary when none is fresh enough.
+    """
+
+    def __init__(self):
+        self._engine = None
+        self._thread = None
+        self.refreshed_at = 0.0
+        self._lock = threading.Lock()
+
+    def age(self):
+        return time.time() - self.refreshed_at
+
+    def engine(self):
+        """The snapshot engine, or None (read the primary) while no copy is within the staleness bound"""
+        self._ensure_refresher()
+        if self._engine is None or self.age() > app.config['READ_MAX_STALENESS']:
+            return None
+        return self._engine
+
+    def _ensure_refresher(self):
+        # Started lazily so every worker process of a forking server gets its own thread
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._refresh_loop, name='read-snapshot', daemon=True)
+                self._thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                with app.app_context():
+                    self.refresh()
+            except Exception as e:
+                print(f"❌ Snapshot refresh failed: {str(e)}")
+            time.sleep(max(app.config['READ_MAX_STALENESS'] / 2, 1))
+
+    def refresh(self):
+        if db.engine.url.get_backend_name() != 'sqlite' or not db.engine.url.database:
+            raise RuntimeError('Snapshot reads need a file-backed SQLite primary; use READ_ROUTING=replica')
+        target = app.config['READ_SNAPSHOT_PATH'] or f'{db.engine.url.database}.snapshot'
+        tmp_path = f'{target}.{os.getpid()}.tmp'
+        raw = db.engine.raw_connection()
+        try:
+            dest = sqlite3.connect(tmp_path)
+            try:
+                raw.driver_connection.backup(dest)
+            finally:
+                dest.close()
+        finally:
+            raw.close()
+        os.replace(tmp_path, target)
+        if self._engine is None:
+            self._engine = create_engine(f'sqlite:///file:{os.path.abspath(target)}?mode=ro&uri=true',
+                                         connect_args={'timeout': 30})
+        else:
+            # Connections still streaming keep the old file open; new ones see the fresh copy
+            self._engine.dispose()
+        self.refreshed_at = time.time()
+
+read_snapshot = SnapshotReader()
+_replica_engine = None
+
+def get_read_engine():
+    """(engine, source name) for reporting reads under the configured READ_ROUTING"""
+    global _replica_engine
+    mode = app.config['READ_ROUTING']
+    if mode == 'replica' and app.config['READ_DATABASE_URI']:
+        if _replica_engine is None:
+            _replica_engine = create_engine(app.config['READ_DATABASE_URI'], pool_pre_ping=True)
+        return _replica_engine, 'replica'
+    if mode == 'snapshot':
+        engine = read_snapshot.engine()
+        if engine is not None:
+            return engine, 'snapshot'
+    return None, 'primary'
+
+def read_routed(view):
+    """
+    Serve a read-only view from the read engine. Send 'X-Read-Consistency: primary'
+    (or ?consistency=primary) to read the primary instead, e.g. straight after a write.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        engine, source = None, 'primary'
+        wants_primary = (request.headers.get('X-Read-Consistency') or request.args.get('consistency')) == 'primary'
+        if not wants_primary:
+            try:
+                engine, source = get_read_engine()
+            except Exception as e:
+                print(f"❌ Read engine unavailable, using primary: {str(e)}")
+        g.read_engine = engine
+        response = make_response(view(*args, **kwargs))
+        response.headers['X-Read-Source'] = source
+        if source == 'snapshot':
+            response.headers['X-Snapshot-Age'] = str(int(read_snapshot.age()))
+        return response
+    return wrapper
+
+db = SQLAlchemy(app, session_options={'class_': ReadRoutingSession})
 print("✅ Database URI =>", app.config["SQLALCHEMY_DATABASE_URI"])
 
 #fill document function
@@ -53,8 +221,9 @@ from copy import deepcopy
 from docx import Document
 from copy import deepcopy
 
-def fill_document(template_path, output_path, data, client_type, employees=None):
-    doc = Document(template_path)
+def fill_document(template, output_path, data, client_type, employees=None):
+    # Path, file-like object, or an already parsed Document (filled in place)
+    doc = template if hasattr(template, 'paragraphs') else Document(template)
 
     # Fill paragraphs first
     for paragraph in doc.paragraphs:
@@ -226,9 +395,10 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password = db.Column(db.String(120), nullable=False)
+    password = db.Column(db.String(255), nullable=False)  # scrypt hashes are ~160 characters
     role = db.Column(db.String(50), default='Employee')
     verification_code = db.Column(db.String(10))
+    verification_expires_at = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 with app.app_context():
@@ -287,7 +457,178 @@ class Invoice(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     month = db.Column(db.String(20))
     year = db.Column(db.Integer)
+    due_amount = db.Column(db.Float, index=True)  # Outstanding balance in INR, kept in step with payments
+    fx_rate = db.Column(db.Float)  # INR per unit of the invoice currency, fixed at generation (1 for INR)
     company = db.relationship('Company', backref='invoices')
+    payments = db.relationship('Payment', backref='invoice', lazy=True, cascade='all, delete-orphan',
+                               order_by='Payment.id')
+
+class Payment(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'), nullable=False, index=True)
+    amount = db.Column(db.Float, nullable=False)  # Negative for corrections
+    balance_after = db.Column(db.Float, nullable=False)  # Invoice due_amount once this entry is applied
+    receipt_reference = db.Column(db.String(100), index=True)  # Bank reference shared by one transfer
+    paid_on = db.Column(db.Date)
+    source = db.Column(db.String(20), default='manual')  # manual, bulk, bank_import
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class ArchivedInvoice(db.Model):
+    """
+    An invoice moved out of the hot database. Same id and attribute names as Invoice,
+    so read paths (detail, DOCX download) work on either; JSON payloads are zlib-compressed.
+    """
+    __bind_key__ = 'archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    company_id = db.Column(db.Integer, nullable=False, index=True)
+    po_id = db.Column(db.Integer, nullable=False)
+    invoice_number = db.Column(db.String(100), unique=True, nullable=False)
+    invoice_data_gz = db.Column(db.LargeBinary)
+    payments_gz = db.Column(db.LargeBinary)  # Ledger entries at archive time
+    total_amount = db.Column(db.Float)
+    sub_total = db.Column(db.Float)
+    paid_amount = db.Column(db.Float)
+    due_amount = db.Column(db.Float)
+    fx_rate = db.Column(db.Float)
+    month = db.Column(db.String(20))
+    year = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, index=True)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Denormalised so archived lists need no join back to the hot database
+    company_name = db.Column(db.String(200))
+    po_label = db.Column(db.String(50))
+    client_type = db.Column(db.String(50))
+
+    archived = True
+
+    @property
+    def invoice_data(self):
+        import zlib
+        return zlib.decompress(self.invoice_data_gz).decode() if self.invoice_data_gz else '{}'
+
+    @property
+    def payment_entries(self):
+        """Ledger entries as they were serialised at archive time"""
+        import zlib
+        return json.loads(zlib.decompress(self.payments_gz).decode()) if self.payments_gz else []
+
+    @property
+    def company(self):
+        return db.session.get(Company, self.company_id)
+
+    @property
+    def po_number(self):
+        return db.session.get(PONumber, self.po_id)
+
+class InvoiceSequence(db.Model):
+    """Last invoice serial handed out per company per fiscal year (April-March)"""
+    company_id = db.Column(db.Integer, primary_key=True)
+    fiscal_year = db.Column(db.Integer, primary_key=True)  # Year the fiscal year starts in
+    last_value = db.Column(db.Integer, nullable=False, default=0)
+
+class InvoiceTemplate(db.Model):
+    """
+    Versioned DOCX layouts. company_id NULL marks the built-in default for a client_type;
+    otherwise the company's highest active version is used for its invoices.
+    """
+    __table_args__ = (db.Index('ix_invoice_template_lookup', 'company_id', 'client_type', 'is_active'),)
+    id = db.Column(db.Integer, primary_key=True)
+    company_id = db.Column(db.Integer, db.ForeignKey('company.id'), nullable=True)
+    client_type = db.Column(db.String(50), nullable=False)
+    name = db.Column(db.String(200), nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    file_path = db.Column(db.String(500), nullable=False)
+    placeholders = db.Column(db.Text)  # JSON list found at upload
+    is_active = db.Column(db.Boolean, default=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class FxRate(db.Model):
+    """Dated conversion rates: 1 unit of `currency` = `rate` INR from `rate_date` onwards"""
+    __table_args__ = (db.UniqueConstraint('currency', 'rate_date'),)
+    id = db.Column(db.Integer, primary_key=True)
+    currency = db.Column(db.String(3), nullable=False)
+    rate_date = db.Column(db.Date, nullable=False)
+    rate = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class RevenueRollup(db.Model):
+    """Invoiced and collected totals (INR) per company/PO/billing month"""
+    __table_args__ = (db.UniqueConstraint('company_id', 'po_id', 'year', 'month'),
+                      db.Index('ix_revenue_rollup_period', 'year', 'month'))
+    id = db.Column(db.Integer, primary_key=True)
+    company_id = db.Column(db.Integer, nullable=False, index=True)
+    po_id = db.Column(db.Integer, nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.String(20), nullable=False)
+    invoice_count = db.Column(db.Integer, nullable=False, default=0)
+    net_amount = db.Column(db.Float, nullable=False, default=0)  # Before tax
+    billed_amount = db.Column(db.Float, nullable=False, default=0)  # Including tax
+    paid_amount = db.Column(db.Float, nullable=False, default=0)
+    billed_hours = db.Column(db.Float, nullable=False, default=0)
+    billed_days = db.Column(db.Float, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class UsageRollup(db.Model):
+    """Billed hours/days and amount (INR, before tax) per employee per PO per billing month"""
+    __table_args__ = (db.UniqueConstraint('po_id', 'employee_name', 'year', 'month'),
+                      db.Index('ix_usage_rollup_period', 'year', 'month'))
+    id = db.Column(db.Integer, primary_key=True)
+    company_id = db.Column(db.Integer, nullable=False, index=True)
+    po_id = db.Column(db.Integer, nullable=False)
+    employee_name = db.Column(db.String(200), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.String(20), nullable=False)
+    invoice_count = db.Column(db.Integer, nullable=False, default=0)
+    billed_hours = db.Column(db.Float, nullable=False, default=0)
+    billed_days = db.Column(db.Float, nullable=False, default=0)
+    amount = db.Column(db.Float, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class GenerationBatch(db.Model):
+    """One invoice generation run; a retry with the same idempotency key resumes it"""
+    id = db.Column(db.Integer, primary_key=True)
+    idempotency_key = db.Column(db.String(200), unique=True, nullable=False)
+    source = db.Column(db.String(20), nullable=False)  # 'api' or 'cli'
+    po_id = db.Column(db.Integer)  # API batches cover a single PO
+    month = db.Column(db.String(20), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    render = db.Column(db.Boolean, default=False)
+    status = db.Column(db.String(20), nullable=False, default='running')  # running, failed, completed
+    error = db.Column(db.Text)
+    response = db.Column(db.Text)  # JSON replayed for a completed API batch
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    items = db.relationship('GenerationBatchItem', backref='batch', lazy=True,
+                            cascade='all, delete-orphan', order_by='GenerationBatchItem.id')
+
+class GenerationBatchItem(db.Model):
+    """
+    One timesheet within a batch and the last checkpoint it reached:
+    pending -> parsed (stored in uploads/) -> computed (result saved) -> persisted (on an invoice) -> rendered
+    """
+    __table_args__ = (db.UniqueConstraint('batch_id', 'po_id', 'filename'),)
+    id = db.Column(db.Integer, primary_key=True)
+    batch_id = db.Column(db.Integer, db.ForeignKey('generation_batch.id'), nullable=False, index=True)
+    po_id = db.Column(db.Integer, nullable=False)
+    filename = db.Column(db.String(255), nullable=False)
+    source_path = db.Column(db.String(500))  # Where the CLI found it; resume re-reads from here
+    content_hash = db.Column(db.String(64), nullable=False)
+    stage = db.Column(db.String(20), nullable=False, default='pending')
+    result = db.Column(db.Text)  # JSON from process_timesheet
+    invoice_id = db.Column(db.Integer)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+def add_column_if_missing(table, column, ddl):
+    """Lightweight migration helper: ALTER TABLE ... ADD COLUMN when the column is absent"""
+    try:
+        with db.engine.begin() as conn:
+            cols = [row[1] for row in conn.execute(db.text(f"PRAGMA table_info({table})"))]
+            if column not in cols:
+                conn.execute(db.text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+                return True
+    except Exception as e:
+        print(f"❌ Migration of {table}.{column} failed: {str(e)}")
+    return False
 
 # Create tables
 with app.app_context():
@@ -308,6 +649,21 @@ with app.app_context():
             db.engine.execute("ALTER TABLE company ADD COLUMN is_active BOOLEAN DEFAULT 1")
     except Exception:
         pass
+    add_column_if_missing('user', 'verification_expires_at', 'DATETIME')
+    # Existing invoices keep the 85 INR/USD they were always displayed with
+    if add_column_if_missing('invoice', 'fx_rate', 'FLOAT'):
+        with db.engine.begin() as conn:
+            conn.execute(db.text(
+                "UPDATE invoice SET fx_rate = CASE WHEN (SELECT client_type FROM company "
+                "WHERE company.id = invoice.company_id) = 'foreign' THEN 85 ELSE 1 END"
+            ))
+    # Backfill the stored balance for invoices created before the payment ledger
+    if add_column_if_missing('invoice', 'due_amount', 'FLOAT'):
+        with db.engine.begin() as conn:
+            conn.execute(db.text(
+                "UPDATE invoice SET due_amount = "
+                "MAX(COALESCE(sub_total, 0) * COALESCE(fx_rate, 1) - COALESCE(paid_amount, 0), 0)"
+            ))
 
 # Helper functions
 def allowed_file(filename):
@@ -382,11 +738,461 @@ def process_timesheet(file_path, po_data, client_type):
     
     return result
 
+# =====================================
+# EMPLOYEE NAME MATCHING
+# =====================================
+import unicodedata
+
+def normalize_person_name(name):
+    """Casefold, strip accents and punctuation, collapse whitespace"""
+    if name is None or (not isinstance(name, str) and pd.isna(name)):
+        return ''
+    text = unicodedata.normalize('NFKD', str(name))
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch)).casefold()
+    text = ''.join(ch if ch.isalnum() else ' ' for ch in text)
+    return ' '.join(text.split())
+
+def _name_trigrams(key):
+    padded = f'  {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class EmployeeNameIndex:
+    """
+    Resolves timesheet employee names to the Employee rows of one PO.
+    Built once per PO: exact keys (name, reordered name, email local part) are
+    dict lookups; anything else is scored by trigram overlap against only the
+    employees that share a trigram with it.
+    """
+    MIN_SIMILARITY = 0.5
+
+    def __init__(self, employees):
+        self.employees = {e.id: e for e in employees}
+        self.exact = {}
+        self.postings = {}
+        self.trigrams = {}
+        for emp in employees:
+            keys = {normalize_person_name(emp.name)}
+            if emp.email:
+                keys.add(normalize_person_name(emp.email.split('@')[0]))
+            for key in filter(None, keys):
+                for variant in (key, ' '.join(sorted(key.split()))):
+                    # A key shared by two employees is ambiguous; fall back to scoring
+                    self.exact[variant] = None if self.exact.get(variant, emp.id) != emp.id else emp.id
+                grams = _name_trigrams(' '.join(sorted(key.split())))
+                self.trigrams.setdefault(emp.id, set()).update(grams)
+                for gram in grams:
+                    self.postings.setdefault(gram, set()).add(emp.id)
+
+    @classmethod
+    def for_po(cls, po_id):
+        return cls(Employee.query.filter_by(po_id=po_id).all())
+
+    def resolve(self, name):
+        """Best (employee, score) for a timesheet name, or (None, best score)"""
+        key = normalize_person_name(name)
+        if not key:
+            return None, 0.0
+        for variant in (key, ' '.join(sorted(key.split()))):
+            emp_id = self.exact.get(variant)
+            if emp_id is not None:
+                return self.employees[emp_id], 1.0
+
+        grams = _name_trigrams(' '.join(sorted(key.split())))
+        overlap = {}
+        for gram in grams:
+            for emp_id in self.postings.get(gram, ()):
+                overlap[emp_id] = overlap.get(emp_id, 0) + 1
+        scored = sorted(((2 * hits / (len(grams) + len(self.trigrams[emp_id])), emp_id)
+                         for emp_id, hits in overlap.items()), reverse=True)
+        if not scored:
+            return None, 0.0
+        best_score, best_id = scored[0]
+        if best_score < self.MIN_SIMILARITY or (len(scored) > 1 and scored[1][0] == best_score):
+            return None, round(best_score, 3)
+        return self.employees[best_id], round(best_score, 3)
+
+    def match(self, name):
+        return self.resolve(name)[0]
+
+# =====================================
+# RESPONSE CACHE
+# =====================================
+import hashlib
+from collections import OrderedDict
+
+class LRUCacheBackend:
+    """Thread-safe in-process LRU cache with per-entry TTL"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            expires_at = time.monotonic() + ttl if ttl else None
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def incr(self, key):
+        with self._lock:
+            value, expires_at = self._data.get(key, (0, None))
+            value = int(value) + 1
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            return value
+
+class RedisCacheBackend:
+    """Shared cache for multi-process deployments (any Redis-compatible server)"""
+
+    def __init__(self, url):
+        import redis  # only needed when CACHE_URL is configured
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._client.get(key)
+        return value.decode() if isinstance(value, bytes) else value
+
+    def set(self, key, value, ttl=None):
+        self._client.set(key, value, ex=ttl)
+
+    def incr(self, key):
+        return self._client.incr(key)
+
+def create_cache_backend():
+    if app.config.get('CACHE_URL'):
+        return RedisCacheBackend(app.config['CACHE_URL'])
+    return LRUCacheBackend(app.config['CACHE_MAX_ENTRIES'])
+
+response_cache = create_cache_backend()
+
+def _cache_version(namespace):
+    return int(response_cache.get(f'{namespace}:version') or 0)
+
+def invalidate_cache(namespace='companies'):
+    """Bump the namespace version so every cached response under it goes stale"""
+    response_cache.incr(f'{namespace}:version')
+    response_cache.set(f'{namespace}:modified', str(time.time()))
+
+def cached_response(namespace='companies', ttl=None):
+    """
+    Cache a JSON view under a versioned key and answer conditional requests.
+    Responses carry an ETag and Last-Modified; a matching If-None-Match or
+    If-Modified-Since returns 304 without touching the database.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            version = _cache_version(namespace)
+            key = f'{namespace}:{version}:{request.full_path}'
+            entry = response_cache.get(key)
+            if entry is not None:
+                entry = json.loads(entry)
+            else:
+                response = view(*args, **kwargs)
+                if isinstance(response, tuple) or response.status_code != 200:
+                    return response
+                body = response.get_data(as_text=True)
+                entry = {
+                    'body': body,
+                    'etag': hashlib.md5(body.encode()).hexdigest(),
+                    'modified': float(response_cache.get(f'{namespace}:modified') or time.time())
+                }
+                response_cache.set(key, json.dumps(entry), ttl or app.config['CACHE_DEFAULT_TTL'])
+
+            from flask import Response
+            response = Response(entry['body'], mimetype='application/json')
+            response.set_etag(entry['etag'])
+            response.last_modified = datetime.utcfromtimestamp(int(entry['modified']))
+            response.cache_control.no_cache = True
+            return response.make_conditional(request)
+        return wrapper
+    return decorator
+
+# =====================================
+# PAYLOAD SHAPING
+# =====================================
+import gzip
+
+try:
+    import brotli
+except ImportError:  # Optional; gzip is used when brotli isn't installed
+    brotli = None
+
+COMPRESS_MIN_BYTES = 1024
+
+def list_response(rows, available):
+    """
+    JSON for a list endpoint. ?fields=a,b keeps only those keys; ?format=columnar
+    returns {'fields', 'count', 'columns': {field: [values...]}} instead of one
+    object per row, which is much smaller for long tables.
+    """
+    fields = list(available)
+    if request.args.get('fields'):
+        fields = [f.strip() for f in request.args['fields'].split(',') if f.strip()]
+        unknown = [f for f in fields if f not in available]
+        if unknown:
+            return jsonify({'error': f"Unknown fields: {', '.join(unknown)}", 'available': list(available)}), 400
+    if request.args.get('format') == 'columnar':
+        return jsonify({
+            'fields': fields,
+            'count': len(rows),
+            'columns': {f: [r.get(f) for r in rows] for f in fields}
+        })
+    return jsonify([{f: r.get(f) for f in fields} for r in rows])
+
+@app.after_request
+def compress_json_response(response):
+    """Brotli/gzip JSON bodies over COMPRESS_MIN_BYTES for clients that accept it"""
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or response.mimetype != 'application/json' or 'Content-Encoding' in response.headers):
+        return response
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+    if brotli is not None and request.accept_encodings['br']:
+        encoding, body = 'br', brotli.compress(body, quality=5)
+    elif request.accept_encodings['gzip']:
+        encoding, body = 'gzip', gzip.compress(body, compresslevel=6)
+    else:
+        return response
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    etag, _ = response.get_etag()
+    if etag:
+        # Same representation, different bytes: keep If-None-Match working via weak comparison
+        response.set_etag(etag, weak=True)
+    return response
+
+# =====================================
+# RATE LIMITING
+# =====================================
+class InProcessBucketStore:
+    """Token buckets held in this process; fine for a single worker"""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, refill_rate, now):
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * refill_rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+            return allowed, tokens
+
+    def _prune(self, now):
+        # Buckets idle long enough to be full again carry no state worth keeping
+        for key, (tokens, updated) in list(self._buckets.items()):
+            if now - updated > 3600:
+                del self._buckets[key]
+
+class RedisBucketStore:
+    """Token buckets shared by every worker through a Redis-compatible server"""
+
+    SCRIPT = """
+    local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local capacity = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local tokens = tonumber(data[1]) or capacity
+    local ts = tonumber(data[2]) or now
+    tokens = math.min(capacity, tokens + (now - ts) * rate)
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate))
+    return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url):
+        import redis  # only needed when RATE_LIMIT_URL is configured
+        self._client = redis.Redis.from_url(url)
+        self._take = self._client.register_script(self.SCRIPT)
+
+    def take(self, key, capacity, refill_rate, now):
+        allowed, tokens = self._take(keys=[f'ratelimit:{key}'], args=[capacity, refill_rate, now])
+        return bool(allowed), float(tokens)
+
+bucket_store = RedisBucketStore(app.config['RATE_LIMIT_URL']) if app.config.get('RATE_LIMIT_URL') else InProcessBucketStore()
+
+def check_rate_limit(scope, keys):
+    """
+    Take one token from each of the scope's buckets (per IP, per email, ...).
+    Returns seconds to wait when any bucket is empty, else None.
+    """
+    now = time.time()
+    retry_after = None
+    for kind, (capacity, period) in app.config['RATE_LIMITS'].get(scope, {}).items():
+        value = keys.get(kind)
+        if not value:
+            continue
+        refill_rate = capacity / period
+        allowed, tokens = bucket_store.take(f'{scope}:{kind}:{value}', capacity, refill_rate, now)
+        if not allowed:
+            wait = (1 - tokens) / refill_rate
+            retry_after = max(retry_after or 0, wait)
+    return retry_after
+
+def rate_limited(scope):
+    """Throttle a JSON endpoint by client IP and by the 'email' field in the body"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            body = request.get_json(silent=True) or {}
+            email = str(body.get('email') or '').strip().lower()
+            retry_after = check_rate_limit(scope, {'ip': request.remote_addr, 'email': email})
+            if retry_after is not None:
+                response = jsonify({'error': 'Too many attempts. Please try again later.'})
+                response.headers['Retry-After'] = str(int(retry_after) + 1)
+                return response, 429
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# =====================================
+# FX RATES
+# =====================================
+from bisect import bisect_right
+
+_fx_series = None  # currency -> (sorted dates, rates), loaded once per cache version
+_fx_lookup_cache = {}  # (currency, date) -> rate
+_fx_cache_version = None
+_fx_loaded_at = 0.0
+
+def client_currency(client_type):
+    return 'USD' if client_type == 'foreign' else 'INR'
+
+def _load_fx_series():
+    """
+    Reload when another request bumped the 'fx' version, or after FX_CACHE_TTL:
+    without a shared CACHE_URL other workers never see that bump.
+    """
+    global _fx_series, _fx_cache_version, _fx_loaded_at
+    version = _cache_version('fx')
+    expired = time.time() - _fx_loaded_at > app.config['FX_CACHE_TTL']
+    if _fx_series is None or version != _fx_cache_version or expired:
+        series = {}
+        rows = db.session.query(FxRate.currency, FxRate.rate_date, FxRate.rate).order_by(
+            FxRate.currency, FxRate.rate_date)
+        for currency, rate_date, rate in rows:
+            dates, rates = series.setdefault(currency, ([], []))
+            dates.append(rate_date)
+            rates.append(rate)
+        _fx_series = series
+        _fx_lookup_cache.clear()
+        _fx_cache_version = version
+        _fx_loaded_at = time.time()
+    return _fx_series
+
+def get_fx_rate(currency, on_date=None):
+    """
+    INR per unit of `currency` in effect on `on_date` (latest rate on or before it).
+    All rates are held in memory and lookups are memoised, so converting a long
+    list costs no queries per row.
+    """
+    if currency == 'INR':
+        return 1.0
+    on_date = on_date or datetime.utcnow().date()
+    series = _load_fx_series()
+    key = (currency, on_date)
+    if key not in _fx_lookup_cache:
+        dates, rates = series.get(currency, ([], []))
+        idx = bisect_right(dates, on_date) - 1
+        if idx >= 0:
+            rate = rates[idx]
+        elif rates:
+            rate = rates[0]  # Before the first recorded rate: use the earliest we have
+        else:
+            rate = app.config['FX_FALLBACK_RATES'].get(currency)
+        if rate is None:
+            raise ValueError(f'No FX rate available for {currency}')
+        _fx_lookup_cache[key] = rate
+    return _fx_lookup_cache[key]
+
+def invoice_fx_rate(invoice, client_type):
+    """The invoice's snapshot rate, or the dated rate for invoices that predate snapshots"""
+    if invoice.fx_rate is not None:
+        return invoice.fx_rate
+    created = invoice.created_at.date() if invoice.created_at else None
+    return get_fx_rate(client_currency(client_type), created)
+
+def amount_in_inr(amount, fx_rate):
+    return amount * (fx_rate or 1) if amount is not None else None
+
+
 # API Endpoints
 
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, DEFAULT_PBKDF2_ITERATIONS
+import hmac
+
+_dummy_password_hash = None
+
+def hash_password(password):
+    return generate_password_hash(password, method=app.config['PASSWORD_HASH_METHOD'])
+
+def verify_password(user, password):
+    """
+    Check a password in the same time whether or not the user exists: unknown
+    emails are verified against a cached dummy hash of the configured cost.
+    """
+    global _dummy_password_hash
+    if user is None or user.role == 'Pending':
+        if _dummy_password_hash is None:
+            _dummy_password_hash = hash_password(os.urandom(16).hex())
+        check_password_hash(_dummy_password_hash, password)
+        return False
+    return check_password_hash(user.password, password)
+
+def _hash_cost(spec):
+    """(family, work factor) of a Werkzeug method spec or stored hash, e.g. 'scrypt:32768:8:1$...'"""
+    family, *params = spec.split('$', 1)[0].split(':')
+    try:
+        if family == 'scrypt':
+            n, r, p = (int(v) for v in params[:3]) if len(params) >= 3 else (2 ** 15, 8, 1)
+            return family, n * r * p
+        if family == 'pbkdf2':
+            return family, int(params[1]) if len(params) > 1 else DEFAULT_PBKDF2_ITERATIONS
+    except ValueError:
+        pass
+    return family, 0
+
+def password_needs_rehash(stored_hash):
+    """
+    True when a stored hash is cheaper than PASSWORD_HASH_METHOD within the same family.
+    Hashes of another family are left alone: scrypt and PBKDF2 costs are not
+    comparable, and rewriting them could be a downgrade.
+    """
+    stored_family, stored_cost = _hash_cost(stored_hash)
+    family, cost = _hash_cost(app.config['PASSWORD_HASH_METHOD'])
+    return stored_family == family and stored_cost < cost
 
 @app.route('/api/send-code', methods=['POST'])
+@rate_limited('send_code')
 def send_verification_code():
     """Send OTP verification code to user's email"""
     try:
@@ -403,11 +1209,13 @@ def send_verification_code():
         
         # Generate 6-digit verification code
         verification_code = generate_verifaction_code()
+        expires_at = datetime.utcnow() + timedelta(seconds=app.config['OTP_TTL_SECONDS'])
         
         # Create or update temporary user record
         if existing_user and existing_user.role == 'Pending':
             # Update existing temp user's code
             existing_user.verification_code = verification_code
+            existing_user.verification_expires_at = expires_at
         else:
             # Create new temporary user with verification code
             temp_user = User(
@@ -415,7 +1223,8 @@ def send_verification_code():
                 email=email,
                 password='temp',  # Will be updated after verification
                 role='Pending',
-                verification_code=verification_code
+                verification_code=verification_code,
+                verification_expires_at=expires_at
             )
             db.session.add(temp_user)
         
@@ -437,7 +1246,7 @@ def send_verification_code():
                             <div style="background-color: #f0f9ff; padding: 20px; text-align: center; border-radius: 8px; margin: 20px 0;">
                                 <h1 style="color: #2563eb; font-size: 36px; margin: 0; letter-spacing: 5px;">{verification_code}</h1>
                             </div>
-                            <p style="color: #666; font-size: 14px;">This code will expire in 10 minutes.</p>
+                            <p style="color: #666; font-size: 14px;">This code will expire in {app.config['OTP_TTL_SECONDS'] // 60} minutes.</p>
                             <p style="color: #666; font-size: 14px;">If you didn't request this code, please ignore this email.</p>
                             <hr style="border: none; border-top: 1px solid #eee; margin: 30px 0;">
                             <p style="color: #999; font-size: 12px; text-align: center;">© 2025 Tech Tammina. All rights reserved.</p>
@@ -467,6 +1276,7 @@ def send_verification_code():
 # REGISTER USER
 # =====================================
 @app.route('/api/register', methods=['POST'])
+@rate_limited('register')
 def register_user():
     """Create new user after OTP verification"""
     try:
@@ -491,15 +1301,19 @@ def register_user():
         if temp_user.role != 'Pending':
             return jsonify({'error': 'User already exists with this email'}), 400
         
-        # Verify the code matches
-        if temp_user.verification_code != verification_code:
+        # Verify the code matches (constant-time) and has not expired
+        if not temp_user.verification_code or not hmac.compare_digest(
+                temp_user.verification_code, str(verification_code)):
             return jsonify({'error': 'Invalid verification code'}), 400
+        if temp_user.verification_expires_at and temp_user.verification_expires_at < datetime.utcnow():
+            return jsonify({'error': 'Verification code has expired. Please request a new one.'}), 400
         
         # Update the temporary user with real data
         temp_user.name = name
-        temp_user.password = generate_password_hash(password)
+        temp_user.password = hash_password(password)
         temp_user.role = role
         temp_user.verification_code = None  # Clear the verification code
+        temp_user.verification_expires_at = None
         
         db.session.commit()
         
@@ -523,6 +1337,7 @@ def register_user():
 # LOGIN USER
 # =====================================
 @app.route('/api/login', methods=['POST'])
+@rate_limited('login')
 def login_user():
     """User login endpoint"""
     try:
@@ -535,13 +1350,14 @@ def login_user():
         
         user = User.query.filter_by(email=email).first()
         
-        # Check if user exists and is not pending
-        if not user or user.role == 'Pending':
+        # Same hashing cost for unknown, pending and wrong-password attempts
+        if not verify_password(user, password):
             return jsonify({'error': 'Invalid credentials'}), 401
         
-        # Verify password
-        if not check_password_hash(user.password, password):
-            return jsonify({'error': 'Invalid credentials'}), 401
+        # Move old hashes onto the configured cost while we have the plaintext
+        if password_needs_rehash(user.password):
+            user.password = hash_password(password)
+            db.session.commit()
         
         return jsonify({
             'id': user.id,
@@ -623,6 +1439,7 @@ def create_company():
                     db.session.add(employee)
         
         db.session.commit()
+        invalidate_cache('companies')
         return jsonify({'message': 'Company created successfully', 'company_id': company.id}), 201
     
     except json.JSONDecodeError as e:
@@ -634,10 +1451,13 @@ def create_company():
         print(f"Error: {str(e)}")  # Debug log
         return jsonify({'error': str(e)}), 400
 
+COMPANY_LIST_FIELDS = ('id', 'name', 'contact_number', 'email', 'client_type', 'is_active', 'created_at', 'po_count')
+
 @app.route('/api/companies', methods=['GET'])
+@cached_response('companies')
 def get_companies():
     companies = Company.query.all()
-    return jsonify([{
+    return list_response([{
         'id': c.id,
         'name': c.name,
         'contact_number': c.contact_number,
@@ -646,9 +1466,10 @@ def get_companies():
         'is_active': bool(c.is_active),
         'created_at': c.created_at.isoformat(),
         'po_count': len(c.po_numbers)
-    } for c in companies])
+    } for c in companies], COMPANY_LIST_FIELDS)
 
 @app.route('/api/companies/<int:company_id>', methods=['GET'])
+@cached_response('companies')
 def get_company(company_id):
     company = Company.query.get_or_404(company_id)
     return jsonify({
@@ -680,12 +1501,14 @@ def update_company_status(company_id):
             return jsonify({'error': 'is_active is required'}), 400
         company.is_active = bool(body.get('is_active'))
         db.session.commit()
+        invalidate_cache('companies')
         return jsonify({'id': company.id, 'is_active': bool(company.is_active)}), 200
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/companies/<int:company_id>/po-numbers', methods=['GET'])
+@cached_response('companies')
 def get_po_numbers(company_id):
     company = Company.query.get_or_404(company_id)
     return jsonify([{
@@ -697,6 +1520,7 @@ def get_po_numbers(company_id):
     } for po in company.po_numbers])
 
 @app.route('/api/po-numbers/<int:po_id>/employees', methods=['GET'])
+@cached_response('companies')
 def get_po_employees(po_id):
     po = PONumber.query.get_or_404(po_id)
     return jsonify([{
@@ -707,91 +1531,725 @@ def get_po_employees(po_id):
         'location': e.location
     } for e in po.employees])
 
-@app.route('/api/invoices/generate', methods=['POST'])
-def generate_invoice():
+@app.route('/api/invoice-form/bootstrap', methods=['GET'])
+@cached_response('companies')
+def get_invoice_form_bootstrap():
+    """
+    Everything the generate-invoice screen needs in one call:
+    active companies -> PO numbers -> employees, loaded with a single joined query.
+    """
+    from sqlalchemy.orm import joinedload
+
+    companies = Company.query.options(
+        joinedload(Company.po_numbers).joinedload(PONumber.employees)
+    ).filter(Company.is_active.is_(True)).order_by(Company.name).all()
+
+    return jsonify({'companies': [{
+        'id': c.id,
+        'name': c.name,
+        'client_type': c.client_type,
+        'po_numbers': [{
+            'id': po.id,
+            'po_number': po.po_number,
+            'monthly_budget': po.monthly_budget,
+            'hourly_rate': po.hourly_rate,
+            'employees': [{
+                'id': e.id,
+                'name': e.name,
+                'email': e.email,
+                'date_of_joining': e.date_of_joining,
+                'location': e.location
+            } for e in po.employees]
+        } for po in c.po_numbers]
+    } for c in companies]})
+
+# =====================================
+# INVOICE NUMBER ALLOCATION
+# =====================================
+def fiscal_year_for(year, month):
+    """Indian fiscal year (April-March) of a billing period, as its starting year"""
     try:
-        company_id = request.form.get('company_id')
-        po_id = request.form.get('po_id')
+        return int(year) if int(month) >= 4 else int(year) - 1
+    except (TypeError, ValueError):
+        return int(year)
+
+def format_invoice_number(company_id, po_id, year, month, serial):
+    # The billing period fixes the fiscal year, so (company, period, serial) is unique
+    return f"INV-{company_id}-{po_id}-{year}{month}-{serial:05d}"
+
+def _bump_sequence(company_id, fiscal_year, count):
+    """Single atomic upsert that advances the counter by `count` and returns the new last value"""
+    from sqlalchemy.dialects.sqlite import insert
+
+    stmt = insert(InvoiceSequence).values(company_id=company_id, fiscal_year=fiscal_year, last_value=count)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['company_id', 'fiscal_year'],
+        set_={'last_value': InvoiceSequence.last_value + count}
+    )
+    return stmt.returning(InvoiceSequence.last_value)
+
+def allocate_invoice_sequence(company_id, fiscal_year):
+    """
+    Next serial inside the caller's transaction: gapless, since a rollback of the
+    invoice also rolls back the counter. Concurrent writers queue on SQLite's lock.
+    """
+    return db.session.execute(_bump_sequence(company_id, fiscal_year, 1)).scalar_one()
+
+def reserve_invoice_sequence_block(company_id, fiscal_year, count):
+    """
+    Reserve `count` serials in a short transaction of its own, so a worker can
+    number many invoices without holding the write lock. Unused serials leave gaps.
+    """
+    with db.engine.begin() as conn:
+        last = conn.execute(_bump_sequence(company_id, fiscal_year, count)).scalar_one()
+    return range(last - count + 1, last + 1)
+
+class InvoiceNumberAllocator:
+    """Per-worker allocator that hands out serials from block-reserved ranges"""
+
+    def __init__(self, block_size=50):
+        self.block_size = block_size
+        self._blocks = {}
+
+    def next_serial(self, company_id, fiscal_year):
+        key = (company_id, fiscal_year)
+        block = self._blocks.get(key)
+        serial = next(block, None) if block is not None else None
+        if serial is None:
+            block = iter(reserve_invoice_sequence_block(company_id, fiscal_year, self.block_size))
+            self._blocks[key] = block
+            serial = next(block)
+        return serial
+
+    def next_number(self, company_id, po_id, year, month):
+        serial = self.next_serial(company_id, fiscal_year_for(year, month))
+        return format_invoice_number(company_id, po_id, year, month, serial)
+
+# =====================================
+# TIMESHEET VALIDATION
+# =====================================
+MAX_REPORTED_ROWS = 20
+# ISO first, then the day-first forms Indian timesheets and bank exports use
+DATE_INPUT_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y')
+
+def read_timesheet_frame(source):
+    """
+    One read of a timesheet workbook: the employee name from the header block
+    (B2) and the day rows below the column header on row 5.
+    """
+    raw = pd.read_excel(source, header=None)
+    employee_name = raw.iloc[1, 1] if raw.shape[0] > 1 and raw.shape[1] > 1 else None
+    if raw.shape[0] <= 5:
+        return employee_name, pd.DataFrame()
+    body = raw.iloc[5:].reset_index(drop=True)
+    body.columns = [str(c).strip() for c in raw.iloc[4]]
+    return employee_name, body
+
+def _issue(level, code, message, rows=None, **extra):
+    issue = {'level': level, 'code': code, 'message': message}
+    if rows is not None:
+        issue['rows'] = [int(r) for r in rows[:MAX_REPORTED_ROWS]]
+        issue['count'] = len(rows)
+    issue.update(extra)
+    return issue
+
+def parse_timesheet_dates(values):
+    """
+    Parse a date column against DATE_INPUT_FORMATS so 03/04/2025 is 3 April, never
+    4 March. Excel date cells stringify to ISO; anything unparseable becomes NaT.
+    """
+    text = values.astype('string').str.strip().str.slice(0, 10)
+    dates = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    for fmt in DATE_INPUT_FORMATS:
+        dates = dates.fillna(pd.to_datetime(text, format=fmt, errors='coerce'))
+    return dates
+
+def validate_timesheet_frame(employee_name, df, year, month, client_type, name_index, max_hours):
+    """Vectorised checks over one timesheet; returns a list of issues"""
+    issues = []
+    if df.empty:
+        return [_issue('error', 'empty_timesheet', 'No day rows found below the header')]
+
+    excel_rows = df.index.to_numpy() + 6  # Body starts on spreadsheet row 6
+    hours_col = next((c for c in df.columns
+                      if 'regular hours' in c.lower() or 'hours worked' in c.lower()), None)
+    if hours_col is None:
+        return [_issue('error', 'missing_hours_column',
+                       "No 'Regular hours' / 'Hours worked' column; hours cannot be billed")]
+
+    text = df[hours_col].astype('string').str.strip()
+    filled = text.notna() & (text != '')
+    hours = pd.to_numeric(text.str.extract(r'(\d+(?:\.\d+)?)', expand=False), errors='coerce')
+
+    unparseable = filled & hours.isna()
+    if unparseable.any():
+        issues.append(_issue('error', 'unparseable_hours', 'Hours that are not a number would bill as 0',
+                             excel_rows[unparseable.to_numpy()]))
+    over = hours > max_hours
+    if over.any():
+        issues.append(_issue('warning', 'hours_over_threshold', f'More than {max_hours:g} hours in a day',
+                             excel_rows[over.fillna(False).to_numpy()]))
+    if client_type != 'foreign':
+        zero_days = filled & (hours == 0)
+        if zero_days.any():
+            issues.append(_issue('warning', 'zero_hours_counted', 'Rows with 0 hours still count as a worked day',
+                                 excel_rows[zero_days.fillna(False).to_numpy()]))
+
+    date_col = next((c for c in df.columns if 'date' in c.lower()), None)
+    if date_col is None:
+        issues.append(_issue('warning', 'missing_date_column', 'No date column; calendar checks skipped'))
+    else:
+        dates = parse_timesheet_dates(df[date_col])
+        dated = dates.notna()
+        worked = dated & filled & (hours.fillna(0) > 0)
+
+        duplicated = dated & dates.duplicated(keep=False)
+        if duplicated.any():
+            issues.append(_issue('error', 'duplicate_dates', 'The same date appears more than once',
+                                 excel_rows[duplicated.to_numpy()],
+                                 dates=sorted({d.strftime('%Y-%m-%d') for d in dates[duplicated]})))
+        outside = dated & ((dates.dt.year != int(year)) | (dates.dt.month != int(month)))
+        if outside.any():
+            issues.append(_issue('error', 'date_outside_period', f'Dates outside {year}-{int(month):02d}',
+                                 excel_rows[outside.to_numpy()]))
+        weekend = worked & (dates.dt.dayofweek >= 5)
+        if weekend.any():
+            issues.append(_issue('warning', 'weekend_hours', 'Hours logged on a Saturday or Sunday',
+                                 excel_rows[weekend.to_numpy()]))
+
+        period_start = pd.Timestamp(year=int(year), month=int(month), day=1)
+        business_days = pd.bdate_range(period_start, period_start + pd.offsets.MonthEnd(0))
+        missing = business_days.difference(pd.DatetimeIndex(dates[worked].dt.normalize()))
+        if len(missing):
+            issues.append(_issue('warning', 'missing_working_days', f'{len(missing)} weekdays without hours',
+                                 dates=[d.strftime('%Y-%m-%d') for d in missing[:MAX_REPORTED_ROWS]],
+                                 count=len(missing)))
+
+    if not employee_name or pd.isna(employee_name):
+        issues.append(_issue('error', 'missing_employee_name', 'Employee name (cell B2) is empty'))
+    elif name_index is not None and name_index.match(employee_name) is None:
+        issues.append(_issue('warning', 'unknown_employee', f"'{employee_name}' is not an employee on this PO"))
+    return issues
+
+def validate_timesheet_batch(sources, po, client_type, year, month):
+    """
+    Check a whole batch before billing. `sources` is a list of (filename, path or file).
+    Returns a report with per-file and batch-level issues; ok is False on any error.
+    """
+    max_hours = app.config['TIMESHEET_MAX_DAILY_HOURS']
+    name_index = EmployeeNameIndex(po.employees)
+    files = []
+    seen = {}
+    for filename, source in sources:
+        entry = {'filename': filename, 'employee_name': None, 'issues': []}
+        try:
+            employee_name, df = read_timesheet_frame(source)
+            entry['employee_name'] = None if employee_name is None or pd.isna(employee_name) else str(employee_name)
+            entry['issues'] = validate_timesheet_frame(employee_name, df, year, month, client_type,
+                                                       name_index, max_hours)
+            if entry['employee_name']:
+                emp, score = name_index.resolve(entry['employee_name'])
+                entry['employee_id'] = emp.id if emp else None
+                entry['match_score'] = score
+                key = emp.id if emp else normalize_person_name(entry['employee_name'])
+                seen.setdefault(key, []).append(filename)
+        except Exception as e:
+            entry['issues'].append(_issue('error', 'unreadable_file', f'Could not read workbook: {str(e)}'))
+        files.append(entry)
+
+    batch_issues = []
+    for key, filenames in seen.items():
+        if len(filenames) > 1:
+            name = name_index.employees[key].name if key in name_index.employees else key
+            batch_issues.append(_issue('error', 'duplicate_employee', f"'{name}' has more than one timesheet",
+                                       files=filenames))
+    missing = sorted(e.name for e in po.employees if e.id not in seen)
+    if missing:
+        batch_issues.append(_issue('warning', 'missing_timesheets', 'PO employees without a timesheet',
+                                   employees=missing))
+
+    all_issues = batch_issues + [i for f in files for i in f['issues']]
+    errors = sum(1 for i in all_issues if i['level'] == 'error')
+    return {
+        'ok': errors == 0,
+        'summary': {'files': len(files), 'errors': errors, 'warnings': len(all_issues) - errors},
+        'batch_issues': batch_issues,
+        'files': files
+    }
+
+@app.route('/api/timesheets/validate', methods=['POST'])
+def validate_timesheets():
+    """Dry-run checks for a batch of timesheets (same form fields as /api/invoices/generate)"""
+    try:
+        company = Company.query.get_or_404(request.form.get('company_id'))
+        po = PONumber.query.get_or_404(request.form.get('po_id'))
         month = request.form.get('month')
         year = request.form.get('year')
-        
-        company = Company.query.get_or_404(company_id)
-        po = PONumber.query.get_or_404(po_id)
-        
-        files = request.files.getlist('files')
-        results = []
-        
-        for file in files:
-            if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                
-                try:
-                    result = process_timesheet(filepath, po, company.client_type)
-                    result['filename'] = filename
-                    result['filepath'] = filepath  # store full path so download can find it reliably
-                    results.append(result)
-                    # DO NOT delete the file here — keep it for download/generation
-                except Exception as e:
-                    results.append({'filename': filename, 'error': str(e)})
-        
-        grand_total = {
-            'total_amount': sum(r.get('total_amount', 0) for r in results if 'error' not in r),
-            'sub_total': sum(r.get('sub_total', 0) for r in results if 'error' not in r),
-            'total_hours': sum(r.get('total_worked_hours', 0) for r in results if 'error' not in r),
-            'total_days': sum(r.get('total_days', 0) for r in results if 'error' not in r),
-            'IGST': sum(r.get('IGST', 0) for r in results if 'error' not in r),
-            'CGST': sum(r.get('CGST', 0) for r in results if 'error' not in r),
-            'SGST': sum(r.get('SGST', 0) for r in results if 'error' not in r)
-        }
-        
-        invoice_number = f"INV-{company.id}-{po_id}-{year}{month}-{datetime.now().strftime('%H%M%S')}"
-        
-        invoice = Invoice(
-            company_id=company_id,
-            po_id=po_id,
-            invoice_number=invoice_number,
-            invoice_data=json.dumps({'employees': results, 'grand_total': grand_total}),
-            total_amount=grand_total['total_amount'],
-            sub_total=grand_total['sub_total'],
-            month=month,
-            year=int(year)
-        )
-        
-        db.session.add(invoice)
-        db.session.commit()
-        
-        return jsonify({
-            'invoice_id': invoice.id,
-            'invoice_number': invoice_number,
-            'company': {'name': company.name, 'email': company.email, 'client_type': company.client_type},
-            'po_number': po.po_number,
-            'employees': results,
-            'grand_total': grand_total,
-            'month': month,
-            'year': year
-        })
-    
+        if not month or not year:
+            return jsonify({'error': 'month and year are required'}), 400
+        sources = [(secure_filename(f.filename), f.stream) for f in request.files.getlist('files')
+                   if f and allowed_file(f.filename)]
+        return jsonify(validate_timesheet_batch(sources, po, company.client_type, year, month)), 200
     except Exception as e:
-        db.session.rollback()
+        print(f"❌ Error in validate_timesheets: {str(e)}")
         return jsonify({'error': str(e)}), 400
 
+def compute_grand_total(results):
+    ok = [r for r in results if 'error' not in r]
+    return {
+        'total_amount': sum(r.get('total_amount', 0) for r in ok),
+        'sub_total': sum(r.get('sub_total', 0) for r in ok),
+        'total_hours': sum(r.get('total_worked_hours', 0) for r in ok),
+        'total_days': sum(r.get('total_days', 0) for r in ok),
+        'IGST': sum(r.get('IGST', 0) for r in ok),
+        'CGST': sum(r.get('CGST', 0) for r in ok),
+        'SGST': sum(r.get('SGST', 0) for r in ok)
+    }
 
-@app.route('/api/invoices', methods=['GET'])
-def get_invoices():
-    invoices = Invoice.query.order_by(Invoice.created_at.desc()).all()
-    result = []
-    for inv in invoices:
-        client_type = inv.company.client_type
-        rate = 85
-        sub_total_in_inr = inv.sub_total * rate if client_type == 'foreign' and inv.sub_total is not None else inv.sub_total
-        total_amount_in_inr = inv.total_amount * rate if client_type == 'foreign' and inv.total_amount is not None else inv.total_amount
-        paid = inv.paid_amount or 0
-        due_in_inr = max((sub_total_in_inr or 0) - paid, 0)
-        result.append({
-            'id': inv.id,
-            'invoice_number': inv.invoice_number,
+def create_invoice_record(company, po, month, year, results, invoice_number=None):
+    """
+    Build the Invoice for already-parsed timesheet results and add it to the session.
+    Shared by the HTTP route and the CLI; the caller commits. The number comes from
+    the company's fiscal-year sequence unless a pre-reserved one is passed in.
+    """
+    grand_total = compute_grand_total(results)
+    name_index = EmployeeNameIndex.for_po(po.id)
+    for r in results:
+        if 'error' not in r:
+            emp = name_index.match(r.get('employee_name'))
+            r['employee_id'] = emp.id if emp else None
+    if invoice_number is None:
+        fiscal_year = fiscal_year_for(year, month)
+        invoice_number = format_invoice_number(company.id, po.id, year, month,
+                                               allocate_invoice_sequence(company.id, fiscal_year))
+
+    invoice = Invoice(
+        company_id=company.id,
+        po_id=po.id,
+        invoice_number=invoice_number,
+        invoice_data=json.dumps({'employees': results, 'grand_total': grand_total}),
+        total_amount=grand_total['total_amount'],
+        sub_total=grand_total['sub_total'],
+        month=month,
+        year=int(year),
+        fx_rate=get_fx_rate(client_currency(company.client_type))
+    )
+    invoice.due_amount = amount_in_inr(invoice.sub_total, invoice.fx_rate) or 0
+    db.session.add(invoice)
+    db.session.flush()
+    record_invoice_rollups(invoice, results)
+    return invoice
+
+# =====================================
+# GENERATION BATCHES
+# =====================================
+import shutil
+import uuid
+
+BATCH_STAGES = ('pending', 'parsed', 'computed', 'persisted', 'rendered')
+# Requests sent without an idempotency key get a throwaway key: nobody can replay
+# it, so the batch row is dropped once the request is over
+ADHOC_BATCH_PREFIX = 'adhoc:'
+
+class BatchConflictError(Exception):
+    pass
+
+def stage_reached(item, stage):
+    return BATCH_STAGES.index(item.stage) >= BATCH_STAGES.index(stage)
+
+def adhoc_batch_key():
+    return f'{ADHOC_BATCH_PREFIX}{uuid.uuid4().hex}'
+
+def is_adhoc_batch(batch):
+    return batch.idempotency_key.startswith(ADHOC_BATCH_PREFIX)
+
+def file_sha256(source):
+    """Hash a path or a file-like object (rewound afterwards)"""
+    digest = hashlib.sha256()
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+    else:
+        for chunk in iter(lambda: source.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+        source.seek(0)
+    return digest.hexdigest()
+
+def get_or_create_batch(key, source, month, year, po_id=None, render=False):
+    """Look up a batch by idempotency key, creating it on first use; parameters must match"""
+    batch = GenerationBatch.query.filter_by(idempotency_key=key).first()
+    if batch is None:
+        batch = GenerationBatch(idempotency_key=key, source=source, month=str(month), year=int(year),
+                                po_id=po_id, render=render)
+        db.session.add(batch)
+        db.session.commit()
+        return batch
+    if (batch.source, batch.month, batch.year, batch.po_id) != (source, str(month), int(year), po_id):
+        raise BatchConflictError(f"Idempotency key '{key}' was already used for a different request")
+    return batch
+
+def sync_batch_item(batch, po_id, filename, content_hash, source_path=None):
+    """
+    The batch's item for this file. A changed file that is not on an invoice yet
+    starts again from 'pending'; once persisted the checkpoint is kept.
+    """
+    item = next((i for i in batch.items if i.po_id == po_id and i.filename == filename), None)
+    if item is None:
+        # Set stage explicitly: column defaults only apply at flush, and callers check it right away
+        item = GenerationBatchItem(batch=batch, po_id=po_id, filename=filename, stage='pending',
+                                   content_hash=content_hash, source_path=source_path)
+        db.session.add(item)
+    elif item.content_hash != content_hash and not stage_reached(item, 'persisted'):
+        item.content_hash, item.stage, item.result = content_hash, 'pending', None
+    if source_path:
+        item.source_path = source_path
+    return item
+
+def batch_folder(batch):
+    """
+    A batch's timesheet folder. Ad-hoc batch rows are deleted, and SQLite can hand
+    their id out again, so their folder is named after the random key instead.
+    """
+    name = batch.idempotency_key.replace(':', '-') if is_adhoc_batch(batch) else str(batch.id)
+    return os.path.join(app.config['UPLOAD_FOLDER'], 'timesheets', name)
+
+def batch_timesheet_path(batch, po_id, filename):
+    """Where a batch stores a timesheet: per batch and PO, so same-named files never overwrite each other"""
+    folder = os.path.join(batch_folder(batch), str(po_id))
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, filename)
+
+def checkpoint(item, stage, result=None):
+    """Record that `item` reached `stage` and commit, so a crash after this point keeps it"""
+    item.stage = stage
+    if result is not None:
+        item.result = json.dumps(result)
+    db.session.commit()
+
+def compute_batch_item(item, filepath, po, client_type):
+    """Parse a stored timesheet, checkpointing it as parsed and then computed"""
+    checkpoint(item, 'parsed')
+    try:
+        result = process_timesheet(filepath, po, client_type)
+        result['filename'] = item.filename
+        result['filepath'] = filepath  # store full path so download can find it reliably
+    except Exception as e:
+        result = {'filename': item.filename, 'error': str(e)}
+    checkpoint(item, 'computed', result)
+
+def persist_batch_items(batch, company, po, items, invoice_number=None):
+    """Create the invoice for a PO's computed items and mark them persisted; the caller commits"""
+    results = [json.loads(i.result) for i in items]
+    invoice = create_invoice_record(company, po, batch.month, batch.year, results, invoice_number)
+    for item in items:
+        item.stage = 'persisted'
+        item.invoice_id = invoice.id
+    return invoice, results
+
+def complete_api_batch(batch, company, po, items, **extra):
+    """
+    Create the invoice for an HTTP batch and store the replayable response; the
+    invoice, the checkpoints and the response land in one commit. Returns the body.
+    """
+    invoice, results = persist_batch_items(batch, company, po, items)
+    body = {
+        'invoice_id': invoice.id,
+        'invoice_number': invoice.invoice_number,
+        'company': {'name': company.name, 'email': company.email, 'client_type': company.client_type},
+        'po_number': po.po_number,
+        'employees': results,
+        'grand_total': compute_grand_total(results),
+        'month': batch.month,
+        'year': str(batch.year),
+        **extra,
+        'batch_id': None if is_adhoc_batch(batch) else batch.id
+    }
+    if is_adhoc_batch(batch):
+        # The invoice keeps its timesheet paths; the checkpoints have nothing left to resume
+        db.session.delete(batch)
+    else:
+        batch.response = json.dumps(body)
+        batch.status, batch.error = 'completed', None
+    db.session.commit()
+    return body
+
+def abandon_batch(batch, error):
+    """
+    Record an API batch that stopped short. A keyed batch is kept as failed so a
+    retry with the key resumes it; an ad-hoc one is dropped with its stored files.
+    """
+    if is_adhoc_batch(batch):
+        folder = batch_folder(batch)
+        db.session.delete(batch)
+        db.session.commit()
+        shutil.rmtree(folder, ignore_errors=True)
+    else:
+        batch.status, batch.error = 'failed', error
+        db.session.commit()
+
+def replay_batch_response(batch):
+    response = jsonify(json.loads(batch.response))
+    response.headers['Idempotent-Replay'] = 'true'
+    return response
+
+def finish_batch(batch):
+    done = 'rendered' if batch.render else 'persisted'
+    if all(stage_reached(i, done) for i in batch.items):
+        batch.status = 'completed'
+        batch.error = None
+    db.session.commit()
+
+def batch_summary(batch):
+    stages = {}
+    for item in batch.items:
+        stages[item.stage] = stages.get(item.stage, 0) + 1
+    return {
+        'id': batch.id,
+        'idempotency_key': batch.idempotency_key,
+        'source': batch.source,
+        'status': batch.status,
+        'month': batch.month,
+        'year': batch.year,
+        'error': batch.error,
+        'items': len(batch.items),
+        'stages': stages,
+        'invoice_ids': sorted({i.invoice_id for i in batch.items if i.invoice_id}),
+        'updated_at': batch.updated_at.isoformat() if batch.updated_at else None
+    }
+
+@app.route('/api/batches/<int:batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    return jsonify(batch_summary(GenerationBatch.query.get_or_404(batch_id))), 200
+
+@app.route('/api/invoices/generate', methods=['POST'])
+def generate_invoice():
+    """
+    Send an Idempotency-Key header (or idempotency_key field) to make retries safe:
+    a completed key replays its response, an interrupted one skips timesheets that
+    were already parsed and computed. Without a key no batch is kept afterwards.
+    """
+    batch = None
+    try:
+        company_id = request.form.get('company_id')
+        po_id = request.form.get('po_id')
+        month = request.form.get('month')
+        year = request.form.get('year')
+        
+        company = Company.query.get_or_404(company_id)
+        po = PONumber.query.get_or_404(po_id)
+        
+        key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key') or adhoc_batch_key()
+        batch = get_or_create_batch(key, 'api', month, year, po_id=po.id)
+        if batch.status == 'completed' and batch.response:
+            return replay_batch_response(batch)
+        
+        files = request.files.getlist('files')
+        items = []
+        
+        # Optional pre-billing checks: 'report' attaches them, 'strict' refuses to bill on errors
+        validation_mode = request.form.get('validate')
+        validation = None
+        if validation_mode in ('report', 'strict'):
+            sources = [(secure_filename(f.filename), f.stream) for f in files if f and allowed_file(f.filename)]
+            validation = validate_timesheet_batch(sources, po, company.client_type, year, month)
+            for f in files:
+                f.stream.seek(0)
+            if validation_mode == 'strict' and not validation['ok']:
+                abandon_batch(batch, 'Timesheets failed validation')
+                return jsonify({'error': 'Timesheets failed validation', 'validation': validation}), 422
+        
+        for file in files:
+            if file and allowed_file(file.filename):
+                filename = secure_filename(file.filename)
+                filepath = batch_timesheet_path(batch, po.id, filename)
+                item = sync_batch_item(batch, po.id, filename, file_sha256(file.stream))
+                items.append(item)
+                if stage_reached(item, 'computed') and os.path.exists(filepath):
+                    continue  # Same file computed on an earlier attempt
+                
+                # DO NOT delete the file afterwards — keep it for download/generation
+                file.save(filepath)
+                compute_batch_item(item, filepath, po, company.client_type)
+        
+        return jsonify(complete_api_batch(batch, company, po, items, validation=validation))
+    
+    except BatchConflictError as e:
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        db.session.rollback()
+        if batch is not None:
+            abandon_batch(batch, str(e))
+        return jsonify({'error': str(e)}), 400
+
+
+# =====================================
+# STREAMED ARCHIVE UPLOADS
+# =====================================
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+class UploadTooLargeError(Exception):
+    pass
+
+class EndpointLimitedRequest(app.request_class):
+    """Werkzeug's body ceiling follows UPLOAD_LIMITS for the matched endpoint, not one global value"""
+
+    @property
+    def max_content_length(self):
+        return app.config['UPLOAD_LIMITS'].get(self.endpoint, app.config['MAX_CONTENT_LENGTH'])
+
+app.request_class = EndpointLimitedRequest
+
+@app.before_request
+def enforce_upload_limit():
+    """Reject oversized bodies before anything is read, using the endpoint's own limit"""
+    limit = app.config['UPLOAD_LIMITS'].get(request.endpoint, app.config['DEFAULT_UPLOAD_LIMIT'])
+    if request.content_length is not None and request.content_length > limit:
+        return jsonify({'error': f'Upload exceeds the {limit // (1024 * 1024)} MB limit for this endpoint'}), 413
+
+def spool_to_disk(stream, limit, suffix='.zip'):
+    """
+    Copy an incoming stream to a temp file in fixed-size chunks so the body is never
+    held in memory. Raises UploadTooLargeError when more than `limit` bytes arrive.
+    """
+    import tempfile
+
+    written = 0
+    tmp = tempfile.NamedTemporaryFile(dir=app.config['UPLOAD_FOLDER'], suffix=suffix, delete=False)
+    try:
+        with tmp:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if written > limit:
+                    raise UploadTooLargeError(f'Upload exceeds the {limit // (1024 * 1024)} MB limit')
+                tmp.write(chunk)
+    except Exception:
+        os.remove(tmp.name)
+        raise
+    return tmp.name
+
+def iter_archive_members(zf):
+    """
+    Yield (filename, ZipInfo) for each workbook in the archive. The name keeps the
+    member's folders ('team-a/sheet.xlsx' -> 'team-a_sheet.xlsx') and is made unique,
+    so same-named sheets in different folders never share a stored file.
+    """
+    seen = set()
+    for info in zf.infolist():
+        if info.is_dir() or info.filename.startswith('__MACOSX/'):
+            continue
+        filename = secure_filename(info.filename)
+        if not filename or not filename.lower().endswith(('.xlsx', '.xls')):
+            continue
+        stem, ext = os.path.splitext(filename)
+        counter = 1
+        while filename in seen:
+            counter += 1
+            filename = f'{stem}-{counter}{ext}'
+        seen.add(filename)
+        yield filename, info
+
+@app.route('/api/invoices/generate-archive', methods=['POST'])
+def generate_invoice_from_archive():
+    """
+    Generate an invoice from a zip of timesheets.
+    Send the zip either as the raw body (Content-Type: application/zip, fields in the
+    query string) or as a multipart 'archive' file with the usual form fields.
+    Idempotency-Key works as for /api/invoices/generate; members are matched by CRC.
+    """
+    import shutil
+    import zipfile
+
+    zip_path = None
+    batch = None
+    try:
+        params = request.form if request.files else request.args
+        company_id = params.get('company_id')
+        po_id = params.get('po_id')
+        month = params.get('month')
+        year = params.get('year')
+        if not all([company_id, po_id, month, year]):
+            return jsonify({'error': 'company_id, po_id, month and year are required'}), 400
+
+        company = Company.query.get_or_404(company_id)
+        po = PONumber.query.get_or_404(po_id)
+
+        key = request.headers.get('Idempotency-Key') or params.get('idempotency_key') or adhoc_batch_key()
+        batch = get_or_create_batch(key, 'api', month, year, po_id=po.id)
+        if batch.status == 'completed' and batch.response:
+            return replay_batch_response(batch)
+
+        limit = app.config['UPLOAD_LIMITS']['generate_invoice_from_archive']
+        archive = request.files.get('archive')
+        zip_path = spool_to_disk(archive.stream if archive else request.stream, limit)
+
+        member_limit = app.config['ARCHIVE_MEMBER_LIMIT']
+        items = []
+        with zipfile.ZipFile(zip_path) as zf:
+            # One member is extracted and parsed at a time
+            for filename, info in iter_archive_members(zf):
+                item = sync_batch_item(batch, po.id, filename, f'crc32:{info.CRC:08x}:{info.file_size}')
+                items.append(item)
+                filepath = batch_timesheet_path(batch, po.id, filename)
+                if stage_reached(item, 'computed') and os.path.exists(filepath):
+                    continue
+                if info.file_size > member_limit:
+                    error = f'{filename} is larger than {member_limit // (1024 * 1024)} MB'
+                    checkpoint(item, 'computed', {'filename': filename, 'error': error})
+                    continue
+                with zf.open(info) as src, open(filepath, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, UPLOAD_CHUNK_SIZE)
+                compute_batch_item(item, filepath, po, company.client_type)
+
+        if not items:
+            abandon_batch(batch, 'No timesheets in archive')
+            return jsonify({'error': 'No .xlsx/.xls timesheets found in archive'}), 400
+        return jsonify(complete_api_batch(batch, company, po, items))
+
+    except UploadTooLargeError as e:
+        abandon_batch(batch, str(e))
+        return jsonify({'error': str(e)}), 413
+    except BatchConflictError as e:
+        return jsonify({'error': str(e)}), 409
+    except Exception as e:
+        db.session.rollback()
+        if batch is not None:
+            abandon_batch(batch, str(e))
+        print(f"❌ Error in generate_invoice_from_archive: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+    finally:
+        if zip_path and os.path.exists(zip_path):
+            os.remove(zip_path)
+
+INVOICE_LIST_FIELDS = (
+    'id', 'invoice_number', 'company_name', 'po_number', 'client_type', 'total_amount', 'sub_total',
+    'total_amount_in_inr', 'sub_total_in_inr', 'paid_amount', 'due_amount', 'month', 'year',
+    'created_at', 'archived'
+)
+
+@app.route('/api/invoices', methods=['GET'])
+@read_routed
+def get_invoices():
+    """Invoice list; supports ?fields= and ?format=columnar (see list_response)"""
+    from sqlalchemy.orm import joinedload
+
+    invoices = Invoice.query.options(
+        joinedload(Invoice.company), joinedload(Invoice.po_number)
+    ).order_by(Invoice.created_at.desc()).all()
+    result = []
+    for inv in invoices:
+        client_type = inv.company.client_type
+        rate = invoice_fx_rate(inv, client_type)
+        sub_total_in_inr = amount_in_inr(inv.sub_total, rate)
+        total_amount_in_inr = amount_in_inr(inv.total_amount, rate)
+        paid = inv.paid_amount or 0
+        due_in_inr = inv.due_amount if inv.due_amount is not None else max((sub_total_in_inr or 0) - paid, 0)
+        result.append({
+            'id': inv.id,
+            'invoice_number': inv.invoice_number,
             'company_name': inv.company.name,
             'po_number': inv.po_number.po_number,
             'client_type': client_type,
@@ -803,20 +2261,23 @@ def get_invoices():
             'due_amount': due_in_inr,
             'month': inv.month,
             'year': inv.year,
-            'created_at': inv.created_at.isoformat()
+            'created_at': inv.created_at.isoformat(),
+            'archived': False
         })
-    return jsonify(result)
+    if request.args.get('include_archived', '').lower() in ('1', 'true'):
+        result.extend(archived_invoice_summaries())
+    return list_response(result, INVOICE_LIST_FIELDS)
 
 @app.route('/api/invoices/<int:invoice_id>', methods=['GET'])
 def get_invoice(invoice_id):
-    invoice = Invoice.query.get_or_404(invoice_id)
+    invoice = find_invoice(invoice_id)
     invoice_data = json.loads(invoice.invoice_data)
     client_type = invoice.company.client_type
-    rate = 85
-    sub_total_in_inr = invoice.sub_total * rate if client_type == 'foreign' and invoice.sub_total is not None else invoice.sub_total
-    total_amount_in_inr = invoice.total_amount * rate if client_type == 'foreign' and invoice.total_amount is not None else invoice.total_amount
+    rate = invoice_fx_rate(invoice, client_type)
+    sub_total_in_inr = amount_in_inr(invoice.sub_total, rate)
+    total_amount_in_inr = amount_in_inr(invoice.total_amount, rate)
     paid = invoice.paid_amount or 0
-    due_in_inr = max((sub_total_in_inr or 0) - paid, 0)
+    due_in_inr = invoice.due_amount if invoice.due_amount is not None else max((sub_total_in_inr or 0) - paid, 0)
 
     return jsonify({
         'id': invoice.id,
@@ -828,14 +2289,17 @@ def get_invoice(invoice_id):
             'client_type': client_type
         },
         'po_number': invoice.po_number.po_number,
-        'employees': invoice_data['employees'],
+        # Server-side paths are of no use to the client
+        'employees': [{k: v for k, v in e.items() if k != 'filepath'} for e in invoice_data['employees']],
         'grand_total': invoice_data['grand_total'],
         'total_amount': invoice.total_amount,
         'sub_total': invoice.sub_total,
         'total_amount_in_inr': total_amount_in_inr,
         'sub_total_in_inr': sub_total_in_inr,
+        'fx_rate': rate,
         'paid_amount': paid,
         'due_amount': due_in_inr,
+        'archived': getattr(invoice, 'archived', False),
         'month': invoice.month,
         'year': invoice.year,
         'created_at': invoice.created_at.isoformat()
@@ -856,13 +2320,14 @@ def update_invoice_payment(invoice_id):
             return jsonify({'error': 'paid_amount must be a number'}), 400
 
         invoice = Invoice.query.get_or_404(invoice_id)
-        invoice.paid_amount = paid_value
+        delta = paid_value - (invoice.paid_amount or 0)
+        if delta:
+            post_payment(invoice, delta, source='manual')
         db.session.commit()
-        due_amount = max((invoice.sub_total or 0) - (invoice.paid_amount or 0), 0)
         return jsonify({
             'id': invoice.id,
             'paid_amount': invoice.paid_amount or 0,
-            'due_amount': due_amount
+            'due_amount': invoice.due_amount
         }), 200
     except Exception as e:
         db.session.rollback()
@@ -873,217 +2338,174 @@ def health_check():
 
 from docx import Document
 from docx.shared import Inches
-@app.route('/api/invoices/<int:invoice_id>/download-docx', methods=['GET'])
-def download_invoice_docx(invoice_id):
-    try:
-        invoice = Invoice.query.get_or_404(invoice_id)
-        company = invoice.company
-        po = invoice.po_number
-
-        # Fetch rates and taxes from PO table
-        hourly_rate = po.hourly_rate or 0
-        monthly_budget = po.monthly_budget or 0
-        cgst_rate = po.cgst or 9
-        sgst_rate = po.sgst or 9
-        igst_rate = po.igst or 18
-
-        client_type = company.client_type
-        print(f"DEBUG: Client Type = {client_type}")
-
-        # Parse multiple Excel files from invoice_data
-        invoice_data = json.loads(invoice.invoice_data or "{}")
-        employee_entries = invoice_data.get("employees", [])
-
-        if not employee_entries:
-            return jsonify({'error': 'No Excel files linked to this invoice'}), 404
-
-        total_invoice_amount = 0
-        total_cgst = total_sgst = total_igst = 0
-        total_days = 22
-        all_employees = []
-
-        # Fetch employee info from DB
-        employees_list = Employee.query.filter_by(po_id=po.id).all()
-
-        # Process each Excel sheet
-        for idx, emp_data in enumerate(employee_entries, start=1):
-            excel_filename = emp_data.get("filename")
-            if not excel_filename:
-                continue
+def render_invoice_docx(invoice):
+    """
+    Recompute the invoice lines from its timesheets and fill the client's DOCX template.
+    Returns (output_path, output_filename); raises FileNotFoundError when the
+    timesheets or the template are missing. Free of request state so the CLI can use it.
+    """
+    company = invoice.company
+    po = invoice.po_number
 
-            excel_path = os.path.join(app.config['UPLOAD_FOLDER'], excel_filename)
-            if not os.path.exists(excel_path):
-                print(f"DEBUG: Excel file not found: {excel_path}")
-                continue
+    # Fetch rates and taxes from PO table
+    hourly_rate = po.hourly_rate or 0
+    monthly_budget = po.monthly_budget or 0
+    cgst_rate = po.cgst or 9
+    sgst_rate = po.sgst or 9
+    igst_rate = po.igst or 18
 
-            # Read Excel
-            df_header = pd.read_excel(excel_path, header=None)
-            employee_name = df_header.iloc[1, 1] if len(df_header) > 1 else f"Employee {idx}"
-            location_name = df_header.iloc[3, 1] if len(df_header) > 2 else ""
-            df = pd.read_excel(excel_path, skiprows=4)
-
-            # Detect 'Regular Hours' column
-            hours_col = None
-            for col in df.columns:
-                if 'regular hours' in str(col).lower():
-                    hours_col = col
-                    break
-            if not hours_col:
-                hours_col = 'Regular hours worked'
-
-            df = df.dropna(subset=[hours_col])
-
-            total_worked_hours = 0
-            total_worked_days = 0
-            total_amount = sub_total = 0
-            CGST = SGST = IGST = 0
-
-            # Calculate totals
-            if client_type == "foreign":
-                for hours in df[hours_col]:
-                    hours_str = str(hours).lower()
-                    if "hours" in hours_str or "hour" in hours_str:
-                        # Extract numeric value
-                        import re
-                        match = re.search(r'(\d+(?:\.\d+)?)', hours_str)
-                        if match:
-                            total_worked_hours += float(match.group(1))
-                
-                total_amount = total_worked_hours * hourly_rate
-                sub_total = total_amount
-                print(f"DEBUG Foreign: Hours={total_worked_hours}, Rate={hourly_rate}, Amount={total_amount}")
-            else:
-                for hours in df[hours_col]:
-                    if "hours" in str(hours):
-                        total_worked_days += 1
-                per_day_budget = monthly_budget / 22 if monthly_budget else 0
-                total_amount = total_worked_days * per_day_budget
-
-                if client_type == "same_state":
-                    cgst_amt = total_amount * (cgst_rate / 100)
-                    sgst_amt = total_amount * (sgst_rate / 100)
-                    sub_total = total_amount + cgst_amt + sgst_amt
-                    CGST, SGST = cgst_amt, sgst_amt
-                else:
-                    igst_amt = total_amount * (igst_rate / 100)
-                    sub_total = total_amount + igst_amt
-                    IGST = igst_amt
-
-            # Accumulate totals
-            total_invoice_amount += total_amount
-            total_cgst += CGST
-            total_sgst += SGST
-            total_igst += IGST
-
-            # Get employee info from DB or use Excel data
-            if idx <= len(employees_list):
-                emp = employees_list[idx - 1]
-                emp_name = employee_name
-                doj = emp.date_of_joining
-                location = location_name
+    client_type = company.client_type
+    print(f"DEBUG: Client Type = {client_type}")
+
+    # Parse multiple Excel files from invoice_data
+    invoice_data = json.loads(invoice.invoice_data or "{}")
+    employee_entries = invoice_data.get("employees", [])
+
+    if not employee_entries:
+        raise FileNotFoundError('No Excel files linked to this invoice')
+
+    total_invoice_amount = 0
+    total_cgst = total_sgst = total_igst = 0
+    total_days = 22
+    all_employees = []
+
+    # Fetch employee info from DB, matched by name rather than upload order
+    name_index = EmployeeNameIndex.for_po(po.id)
+
+    # Process each Excel sheet
+    for idx, emp_data in enumerate(employee_entries, start=1):
+        excel_filename = emp_data.get("filename")
+        if not excel_filename:
+            continue
+
+        # Older invoices stored timesheets flat under uploads/ and only recorded the name
+        excel_path = emp_data.get("filepath") or os.path.join(app.config['UPLOAD_FOLDER'], excel_filename)
+        if not os.path.exists(excel_path):
+            print(f"DEBUG: Excel file not found: {excel_path}")
+            continue
+
+        # Read Excel
+        df_header = pd.read_excel(excel_path, header=None)
+        employee_name = df_header.iloc[1, 1] if len(df_header) > 1 else f"Employee {idx}"
+        location_name = df_header.iloc[3, 1] if len(df_header) > 2 else ""
+        df = pd.read_excel(excel_path, skiprows=4)
+
+        # Detect 'Regular Hours' column
+        hours_col = None
+        for col in df.columns:
+            if 'regular hours' in str(col).lower():
+                hours_col = col
+                break
+        if not hours_col:
+            hours_col = 'Regular hours worked'
+
+        df = df.dropna(subset=[hours_col])
+
+        total_worked_hours = 0
+        total_worked_days = 0
+        total_amount = sub_total = 0
+        CGST = SGST = IGST = 0
+
+        # Calculate totals
+        if client_type == "foreign":
+            for hours in df[hours_col]:
+                hours_str = str(hours).lower()
+                if "hours" in hours_str or "hour" in hours_str:
+                    # Extract numeric value
+                    import re
+                    match = re.search(r'(\d+(?:\.\d+)?)', hours_str)
+                    if match:
+                        total_worked_hours += float(match.group(1))
+            
+            total_amount = total_worked_hours * hourly_rate
+            sub_total = total_amount
+            print(f"DEBUG Foreign: Hours={total_worked_hours}, Rate={hourly_rate}, Amount={total_amount}")
+        else:
+            for hours in df[hours_col]:
+                if "hours" in str(hours):
+                    total_worked_days += 1
+            per_day_budget = monthly_budget / 22 if monthly_budget else 0
+            total_amount = total_worked_days * per_day_budget
+
+            if client_type == "same_state":
+                cgst_amt = total_amount * (cgst_rate / 100)
+                sgst_amt = total_amount * (sgst_rate / 100)
+                sub_total = total_amount + cgst_amt + sgst_amt
+                CGST, SGST = cgst_amt, sgst_amt
             else:
-                emp_name = employee_name
-                doj = ""
-                location = location_name
-
-            # Build employee entry - THIS MUST HAPPEN INSIDE THE LOOP
-            if client_type == "same_state" or client_type == "other_state":
-                all_employees.append({
-                    "name": emp_name,
-                    "total_days": total_days,
-                    "working_days": total_worked_days,
-                    "status": "Active",
-                    "date_of_joining": doj,
-                    "location": location,
-                    "net_amount": f"₹{total_amount:,.2f}"
-                })
-            else:  # foreign
-                emp_dict = {
-                    "name": emp_name,
-                    "total_hours": f"{total_worked_hours:.2f}",
-                    "rate_per_hour": f"{hourly_rate:.2f}",  # Keep $ sign for display
-                    "net_amount": f"${total_amount:,.2f}"
-                }
-                print(f"DEBUG: Adding employee: {emp_dict}")
-                print(f"DEBUG: hourly_rate from PO: {hourly_rate}, total_hours: {total_worked_hours}, total_amount: {total_amount}")
-                all_employees.append(emp_dict)
-
-        print(f"DEBUG: Total employees to fill: {len(all_employees)}")
-        print(f"DEBUG: Employee data: {all_employees}")
-
-        # Prepare totals for invoice
-        grand_total = total_invoice_amount + total_cgst + total_sgst + total_igst
-
-        # Generate DOCX
-        if client_type == "other_state":
-            template_path = os.path.join("templates", "other_state.docx")
-            data = {
-                "[Invoice number]": invoice.invoice_number,
-                "[Date]": invoice.created_at.strftime("%Y-%m-%d"),
-                "[MM]": invoice.created_at.strftime("%m"),
-                "[YYYY]": invoice.created_at.strftime("%Y"),
-                "[PO number]": po.po_number,
-                "[company_name]": company.name,
-                "[building_no]" : company.building_no,
-                "[local_street]" : company.local_street,
-                "[city]" : company.city,
-                "[state]" : company.state,
-                "[country]" : company.country,
-                "[pin_code]" : company.pin_code,
-                "[GST]": company.GST,
-                "[SAC]": company.SAC,
-                "[sub_total]": f"₹{total_invoice_amount:,.2f}",
-                "[IGST]": f"₹{total_igst:,.2f}",
-                "[TIA]": f"₹{grand_total:,.2f}"
-            }
-        elif client_type == "same_state":
-            template_path = os.path.join("templates", "same_state.docx")
-            data = {
-                "[Invoice number]": invoice.invoice_number,
-                "[Date]": invoice.created_at.strftime("%Y-%m-%d"),
-                "[MM]": invoice.created_at.strftime("%m"),
-                "[YYYY]": invoice.created_at.strftime("%Y"),
-                "[PO number]": po.po_number,
-                "[company_name]": company.name,
-                "[building_no]" : company.building_no,
-                "[local_street]" : company.local_street,
-                "[city]" : company.city,
-                "[state]" : company.state,
-                "[country]" : company.country,
-                "[GST]": company.GST,
-                "[SAC]": company.SAC,
-                "[sub_total]": f"₹{total_invoice_amount:,.2f}",  # Try without brackets
-                "[CGST]": f"₹{total_cgst:,.2f}",
-                "[SGST]": f"₹{total_sgst:,.2f}",
-                "[TIA]": f"₹{grand_total:,.2f}"
-            }
-        else :
-            template_path = os.path.join("templates", "USD INVOICE.docx")
-            data = {
-                '[Date]': invoice.created_at.strftime("%Y-%m-%d"),
-                '[PO number]': str(po.po_number),
-                '[ST]': f"${grand_total:,.2f}",
-                "[Invoice number]": invoice.invoice_number,
-                "[Date]": invoice.created_at.strftime("%Y-%m-%d"),
-                "[MM]": invoice.created_at.strftime("%m"),
-                "[YYYY]": invoice.created_at.strftime("%Y"),
-                "[PO number]": po.po_number,
-                "[company_name]": company.name,  # This is the invoice number placeholder # For the payable line
+                igst_amt = total_amount * (igst_rate / 100)
+                sub_total = total_amount + igst_amt
+                IGST = igst_amt
+
+        # Accumulate totals
+        total_invoice_amount += total_amount
+        total_cgst += CGST
+        total_sgst += SGST
+        total_igst += IGST
+
+        # Get employee info from DB or use Excel data
+        emp = name_index.employees.get(emp_data.get('employee_id')) or name_index.match(employee_name)
+        if emp:
+            emp_name = employee_name
+            doj = emp.date_of_joining
+            location = location_name
+        else:
+            emp_name = employee_name
+            doj = ""
+            location = location_name
+
+        # Build employee entry - THIS MUST HAPPEN INSIDE THE LOOP
+        if client_type == "same_state" or client_type == "other_state":
+            all_employees.append({
+                "name": emp_name,
+                "total_days": total_days,
+                "working_days": total_worked_days,
+                "status": "Active",
+                "date_of_joining": doj,
+                "location": location,
+                "net_amount": f"₹{total_amount:,.2f}"
+            })
+        else:  # foreign
+            emp_dict = {
+                "name": emp_name,
+                "total_hours": f"{total_worked_hours:.2f}",
+                "rate_per_hour": f"{hourly_rate:.2f}",  # Keep $ sign for display
+                "net_amount": f"${total_amount:,.2f}"
             }
-            print(f"DEBUG: Template data: {data}")
+            print(f"DEBUG: Adding employee: {emp_dict}")
+            print(f"DEBUG: hourly_rate from PO: {hourly_rate}, total_hours: {total_worked_hours}, total_amount: {total_amount}")
+            all_employees.append(emp_dict)
+
+    print(f"DEBUG: Total employees to fill: {len(all_employees)}")
+    print(f"DEBUG: Employee data: {all_employees}")
 
-        if not os.path.exists(template_path):
-            return jsonify({'error': f'Invoice template not found at {template_path}'}), 404
+    # Prepare totals for invoice
+    grand_total = total_invoice_amount + total_cgst + total_sgst + total_igst
 
-        output_filename = f"Invoice_{invoice.invoice_number}.docx"
-        output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_filename)
+    # Generate DOCX from the company's registered template (or the built-in for its client type)
+    data = build_template_data(invoice, company, po, client_type, total_invoice_amount,
+                               total_cgst, total_sgst, total_igst, grand_total)
+    template = resolve_invoice_template(company)
+    template_source = load_compiled_template(template)
 
-        print(f"DEBUG: Calling fill_document with {len(all_employees)} employees")
-        fill_document(template_path, output_path, data, client_type, all_employees)
-        print(f"DEBUG: Document created at {output_path}")
+    output_filename = f"Invoice_{invoice.invoice_number}.docx"
+    output_path = os.path.join(app.config['UPLOAD_FOLDER'], output_filename)
 
-        return send_file(output_path, as_attachment=True, download_name=output_filename)
+    print(f"DEBUG: Calling fill_document with {len(all_employees)} employees")
+    fill_document(template_source, output_path, data, client_type, all_employees)
+    print(f"DEBUG: Document created at {output_path}")
+    return output_path, output_filename
+
+@app.route('/api/invoices/<int:invoice_id>/download-docx', methods=['GET'])
+def download_invoice_docx(invoice_id):
+    try:
+        invoice = find_invoice(invoice_id)
+        output_path, output_filename = render_invoice_docx(invoice)
+        # send_file resolves relative paths against the app directory, not the working directory
+        return send_file(os.path.abspath(output_path), as_attachment=True, download_name=output_filename)
 
+    except FileNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -1123,16 +2545,1617 @@ def delete_company(company_id):
             except Exception:
                 pass
 
-        # Delete invoices explicitly
+        # Archived invoices live in another database; remove their files and rows too
+        for archived in ArchivedInvoice.query.filter_by(company_id=company_id).all():
+            try:
+                for entry in json.loads(archived.invoice_data).get('employees', []):
+                    fp = entry.get('filepath')
+                    if fp and os.path.exists(fp):
+                        os.remove(fp)
+            except Exception:
+                pass
+        ArchivedInvoice.query.filter_by(company_id=company_id).delete()
+
+        # Delete invoices and their ledger entries explicitly
+        invoice_ids = db.session.query(Invoice.id).filter_by(company_id=company_id)
+        Payment.query.filter(Payment.invoice_id.in_(invoice_ids)).delete(synchronize_session=False)
         Invoice.query.filter_by(company_id=company_id).delete()
+        RevenueRollup.query.filter_by(company_id=company_id).delete()
+        for template in InvoiceTemplate.query.filter_by(company_id=company_id).all():
+            if os.path.exists(template.file_path):
+                try:
+                    os.remove(template.file_path)
+                except Exception:
+                    pass
+            db.session.delete(template)
+        UsageRollup.query.filter_by(company_id=company_id).delete()
+        po_ids = [po.id for po in company.po_numbers]
+        GenerationBatchItem.query.filter(GenerationBatchItem.po_id.in_(po_ids)).delete(synchronize_session=False)
 
         # Delete company (cascades to POs and employees)
         db.session.delete(company)
         db.session.commit()
+        invalidate_cache('companies')
         return jsonify({'message': 'Company and related data deleted'}), 200
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+# =====================================
+# BULK COMPANY / PO / EMPLOYEE IMPORT
+# =====================================
+IMPORT_COMPANY_FIELDS = ['contact_number', 'building_no', 'local_street', 'city', 'state',
+                         'country', 'pin_code', 'GST', 'SAC', 'email', 'client_type']
+IMPORT_CLIENT_TYPES = {'same_state', 'other_state', 'foreign'}
+IMPORT_PO_FIELDS = ['monthly_budget', 'hourly_rate', 'igst', 'cgst', 'sgst']
+# Applied to new POs only; an upsert never overwrites stored tax rates with defaults
+IMPORT_PO_DEFAULTS = {'igst': 18, 'cgst': 9, 'sgst': 9}
+IMPORT_EMPLOYEE_FIELDS = {'email': ('employee_email',), 'date_of_joining': ('doj', 'date_of_joining'),
+                          'location': ('location',)}
+
+def _clean_cell(value):
+    """Normalise a master-file cell to a stripped string or None"""
+    if value is None:
+        return None
+    if isinstance(value, float) and pd.isna(value):
+        return None
+    value = str(value).strip()
+    return value or None
+
+def _optional_float(value, default=None):
+    value = _clean_cell(value)
+    return float(value) if value is not None else default
+
+def read_import_rows(file_storage=None, raw_body=None):
+    """
+    Yield (row_number, row_dict) from a CSV, XLSX or JSON-lines master file.
+    Every row is flat: company columns, PO columns and (optionally) one employee.
+    """
+    import csv
+    import io
+
+    if file_storage is not None:
+        filename = (file_storage.filename or '').lower()
+        if filename.endswith(('.xlsx', '.xls')):
+            df = pd.read_excel(file_storage, dtype=str)
+            for idx, record in enumerate(df.to_dict(orient='records'), start=2):
+                yield idx, record
+            return
+        stream = io.TextIOWrapper(file_storage.stream, encoding='utf-8-sig')
+        if filename.endswith('.csv'):
+            for idx, record in enumerate(csv.DictReader(stream), start=2):
+                yield idx, record
+            return
+        lines = stream
+    else:
+        lines = io.StringIO(raw_body or '')
+
+    for idx, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield idx, {'__error__': f'Invalid JSON: {str(e)}'}
+            continue
+        if not isinstance(record, dict):
+            yield idx, {'__error__': 'Each line must be a JSON object'}
+            continue
+        yield idx, record
+
+def validate_import_rows(rows):
+    """
+    Validate every row before touching the database.
+    Returns (companies, errors) where companies is keyed by lower-cased company name:
+    {name: {'fields': {...}, 'pos': {po_number: {'fields': {...}, 'employees': {key: {...}}}}}}
+    """
+    companies = {}
+    errors = []
+
+    for row_no, raw in rows:
+        if '__error__' in raw:
+            errors.append({'row': row_no, 'error': raw['__error__']})
+            continue
+        row = {str(k).strip(): _clean_cell(v) for k, v in raw.items()}
+
+        name = row.get('company_name') or row.get('name')
+        po_number = row.get('po_number')
+        client_type = row.get('client_type')
+        row_errors = []
+        if not name:
+            row_errors.append('company_name is required')
+        if not po_number:
+            row_errors.append('po_number is required')
+        if client_type and client_type not in IMPORT_CLIENT_TYPES:
+            row_errors.append(f'client_type must be one of {sorted(IMPORT_CLIENT_TYPES)}')
+
+        # Only columns present in the row are carried, so an upsert leaves the rest alone
+        po_fields = {}
+        try:
+            for field in IMPORT_PO_FIELDS:
+                value = _optional_float(row.get(field))
+                if value is not None:
+                    po_fields[field] = value
+        except ValueError as e:
+            row_errors.append(f'Invalid number: {str(e)}')
+
+        if row_errors:
+            errors.extend({'row': row_no, 'error': msg} for msg in row_errors)
+            continue
+
+        company = companies.setdefault(name.lower(), {'fields': {'name': name}, 'pos': {}, 'row': row_no})
+        for field in IMPORT_COMPANY_FIELDS:
+            if row.get(field) is not None:
+                company['fields'].setdefault(field, row[field])
+
+        po = company['pos'].setdefault(po_number, {'fields': {'po_number': po_number}, 'employees': {}})
+        for field, value in po_fields.items():
+            po['fields'].setdefault(field, value)
+
+        employee_name = row.get('employee_name')
+        if employee_name:
+            employee = {'name': employee_name}
+            for field, columns in IMPORT_EMPLOYEE_FIELDS.items():
+                value = next((row[c] for c in columns if row.get(c) is not None), None)
+                if value is not None:
+                    employee[field] = value
+            key = (employee.get('email') or employee_name).lower()
+            po['employees'].setdefault(key, {}).update(employee)
+
+    # Company level checks need every row merged first
+    for company in companies.values():
+        fields = company['fields']
+        missing = [f for f in ('contact_number', 'email', 'client_type') if not fields.get(f)]
+        if missing:
+            company['missing'] = missing
+
+    return companies, errors
+
+def apply_company_import(companies, upsert=False):
+    """
+    Write validated import data inside the current transaction using bulk mappings.
+    Returns counts of inserted/updated rows per table.
+    """
+    stats = {'companies_created': 0, 'companies_updated': 0, 'pos_created': 0,
+             'pos_updated': 0, 'employees_created': 0, 'employees_updated': 0}
+
+    # One query per table to resolve existing rows
+    existing_companies = {}
+    if upsert and companies:
+        for c in Company.query.filter(db.func.lower(Company.name).in_(list(companies.keys()))).all():
+            existing_companies.setdefault(c.name.lower(), c.id)
+
+    new_companies = []
+    company_updates = []
+    for key, company in companies.items():
+        fields = dict(company['fields'])
+        if key in existing_companies:
+            company['id'] = existing_companies[key]
+            fields['id'] = company['id']
+            company_updates.append(fields)
+        else:
+            fields.setdefault('building_no', '')
+            fields.setdefault('local_street', '')
+            fields.setdefault('city', '')
+            fields.setdefault('state', '')
+            fields.setdefault('country', '')
+            fields.setdefault('pin_code', '')
+            fields['is_active'] = True
+            fields['created_at'] = datetime.utcnow()
+            new_companies.append((company, fields))
+
+    if new_companies:
+        mappings = [fields for _, fields in new_companies]
+        db.session.bulk_insert_mappings(Company, mappings, return_defaults=True)
+        for (company, _), mapping in zip(new_companies, mappings):
+            company['id'] = mapping['id']
+    if company_updates:
+        db.session.bulk_update_mappings(Company, company_updates)
+    stats['companies_created'] = len(new_companies)
+    stats['companies_updated'] = len(company_updates)
+
+    existing_pos = {}
+    company_ids = [c['id'] for c in companies.values()]
+    if upsert and company_ids:
+        for po in PONumber.query.filter(PONumber.company_id.in_(company_ids)).all():
+            existing_pos[(po.company_id, po.po_number)] = po.id
+
+    new_pos = []
+    po_updates = []
+    for company in companies.values():
+        for po_number, po in company['pos'].items():
+            fields = dict(po['fields'], company_id=company['id'])
+            po_key = (company['id'], po_number)
+            if po_key in existing_pos:
+                po['id'] = existing_pos[po_key]
+                fields['id'] = po['id']
+                po_updates.append(fields)
+            else:
+                for field, default in IMPORT_PO_DEFAULTS.items():
+                    fields.setdefault(field, default)
+                fields['created_at'] = datetime.utcnow()
+                new_pos.append((po, fields))
+
+    if new_pos:
+        mappings = [fields for _, fields in new_pos]
+        db.session.bulk_insert_mappings(PONumber, mappings, return_defaults=True)
+        for (po, _), mapping in zip(new_pos, mappings):
+            po['id'] = mapping['id']
+    if po_updates:
+        db.session.bulk_update_mappings(PONumber, po_updates)
+    stats['pos_created'] = len(new_pos)
+    stats['pos_updated'] = len(po_updates)
+
+    # Existing employees match on email first, then on name within the PO when
+    # either side has no email (rosters often add emails later)
+    by_email = {}
+    by_name = {}
+    po_ids = [po['id'] for c in companies.values() for po in c['pos'].values()]
+    if upsert and po_ids:
+        for e in Employee.query.filter(Employee.po_id.in_(po_ids)).all():
+            if e.email:
+                by_email[(e.po_id, e.email.lower())] = e.id
+            by_name.setdefault((e.po_id, e.name.lower()), (e.id, e.email))
+
+    employee_inserts = []
+    employee_updates = []
+    now = datetime.utcnow()
+    for company in companies.values():
+        for po in company['pos'].values():
+            for emp in po['employees'].values():
+                fields = dict(emp, po_id=po['id'])
+                email = (emp.get('email') or '').lower()
+                emp_id = by_email.get((po['id'], email)) if email else None
+                if emp_id is None:
+                    name_match = by_name.get((po['id'], emp['name'].lower()))
+                    if name_match and (not email or not name_match[1]):
+                        emp_id = name_match[0]
+                if emp_id is not None:
+                    fields['id'] = emp_id
+                    employee_updates.append(fields)
+                else:
+                    fields.setdefault('email', '')
+                    fields.setdefault('date_of_joining', '')
+                    fields.setdefault('location', '')
+                    fields['created_at'] = now
+                    employee_inserts.append(fields)
+
+    # Employees are the bulk of a roster: plain executemany, no RETURNING needed
+    if employee_inserts:
+        db.session.bulk_insert_mappings(Employee, employee_inserts)
+    if employee_updates:
+        db.session.bulk_update_mappings(Employee, employee_updates)
+    stats['employees_created'] = len(employee_inserts)
+    stats['employees_updated'] = len(employee_updates)
+
+    return stats
+
+@app.route('/api/companies/import', methods=['POST'])
+def import_companies():
+    """
+    Bulk onboard companies, POs and employees from a master file.
+    Accepts a multipart 'file' (.csv, .xlsx, .jsonl) or a JSON-lines request body.
+    ?mode=upsert updates existing companies/POs/employees instead of rejecting them.
+    Streams newline-delimited JSON: one line per row error, then a summary line.
+    """
+    from flask import Response
+
+    mode = request.args.get('mode', request.form.get('mode', 'insert'))
+    if mode not in ('insert', 'upsert'):
+        return jsonify({'error': 'mode must be insert or upsert'}), 400
+    upsert = mode == 'upsert'
+
+    try:
+        file = request.files.get('file')
+        if file:
+            rows = read_import_rows(file_storage=file)
+        else:
+            rows = read_import_rows(raw_body=request.get_data(as_text=True))
+        companies, errors = validate_import_rows(rows)
+    except Exception as e:
+        print(f"❌ Error reading import file: {str(e)}")
+        return jsonify({'error': f'Could not read import file: {str(e)}'}), 400
+
+    existing = set()
+    if companies:
+        existing = {n for (n,) in db.session.query(db.func.lower(Company.name))
+                    .filter(db.func.lower(Company.name).in_(list(companies.keys()))).all()}
+
+    for key, company in companies.items():
+        name = company['fields']['name']
+        if key in existing and not upsert:
+            errors.append({'row': company['row'], 'error': f"Company '{name}' already exists (use mode=upsert)"})
+        # Existing companies being upserted may omit fields they already have
+        elif key not in existing and company.get('missing'):
+            errors.append({'row': company['row'],
+                           'error': f"Company '{name}' missing: {', '.join(company['missing'])}"})
+
+    stats = None
+    if not errors:
+        try:
+            stats = apply_company_import(companies, upsert=upsert)
+            db.session.commit()
+            invalidate_cache('companies')
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Error in import_companies: {str(e)}")
+            errors.append({'row': None, 'error': str(e)})
+
+    def generate():
+        for err in sorted(errors, key=lambda e: (e['row'] is None, e['row'] or 0)):
+            yield json.dumps(err) + '\n'
+        summary = {'status': 'ok' if not errors else 'failed', 'mode': mode, 'error_count': len(errors)}
+        if stats:
+            summary.update(stats)
+        yield json.dumps(summary) + '\n'
+
+    return Response(generate(), status=200 if not errors else 400, mimetype='application/x-ndjson')
+
+# =====================================
+# STREAMING EXPORTS
+# =====================================
+EXPORT_BATCH_SIZE = 500
+
+INVOICE_EXPORT_COLUMNS = ['invoice_number', 'company_name', 'po_number', 'client_type', 'month', 'year',
+                          'total_amount', 'sub_total', 'fx_rate', 'total_amount_in_inr', 'sub_total_in_inr',
+                          'paid_amount', 'due_amount', 'created_at']
+RECEIVABLE_EXPORT_COLUMNS = ['invoice_number', 'company_name', 'po_number', 'client_type', 'month', 'year',
+                             'sub_total_in_inr', 'paid_amount', 'due_amount', 'created_at', 'age_days']
+
+def _export_query(company_id=None, year=None, month=None, outstanding=False):
+    """
+    Column-only query for exports: never loads Invoice.invoice_data or ORM relationships.
+    yield_per keeps a server-side cursor open and fetches rows in batches.
+    outstanding=True keeps only rows with a balance (or no stored balance yet)
+    using the due_amount index.
+    """
+    q = db.session.query(
+        Invoice.invoice_number,
+        Company.name.label('company_name'),
+        PONumber.po_number,
+        Company.client_type,
+        Invoice.month,
+        Invoice.year,
+        Invoice.total_amount,
+        Invoice.sub_total,
+        Invoice.paid_amount,
+        Invoice.due_amount,
+        Invoice.fx_rate,
+        Invoice.created_at
+    ).join(Company, Invoice.company_id == Company.id).join(PONumber, Invoice.po_id == PONumber.id)
+
+    if company_id:
+        q = q.filter(Invoice.company_id == company_id)
+    if year:
+        q = q.filter(Invoice.year == year)
+    if month:
+        q = q.filter(Invoice.month == month)
+    if outstanding:
+        q = q.filter(db.or_(Invoice.due_amount > 0, Invoice.due_amount.is_(None)))
+
+    return q.order_by(Invoice.created_at.desc()).execution_options(yield_per=EXPORT_BATCH_SIZE)
+
+def _invoice_export_row(row):
+    rate = invoice_fx_rate(row, row.client_type)
+    sub_total_in_inr = amount_in_inr(row.sub_total, rate)
+    total_amount_in_inr = amount_in_inr(row.total_amount, rate)
+    paid = row.paid_amount or 0
+    return {
+        'invoice_number': row.invoice_number,
+        'company_name': row.company_name,
+        'po_number': row.po_number,
+        'client_type': row.client_type,
+        'month': row.month,
+        'year': row.year,
+        'total_amount': row.total_amount,
+        'sub_total': row.sub_total,
+        'total_amount_in_inr': total_amount_in_inr,
+        'sub_total_in_inr': sub_total_in_inr,
+        'fx_rate': rate,
+        'paid_amount': paid,
+        'due_amount': row.due_amount if row.due_amount is not None else max((sub_total_in_inr or 0) - paid, 0),
+        'created_at': row.created_at.isoformat() if row.created_at else ''
+    }
+
+def iter_export_rows(kind, company_id=None, year=None, month=None):
+    now = datetime.utcnow()
+    receivables = kind == 'receivables'
+    for row in _export_query(company_id, year, month, outstanding=receivables):
+        record = _invoice_export_row(row)
+        if receivables:
+            # Only legacy rows without a stored due_amount still need this check
+            if record['due_amount'] <= 0:
+                continue
+            record['age_days'] = (now - row.created_at).days if row.created_at else ''
+        yield record
+
+def stream_csv(records, columns):
+    """Yield CSV text one buffered chunk at a time"""
+    import csv
+    import io
+
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore')
+    writer.writeheader()
+    for count, record in enumerate(records, start=1):
+        writer.writerow(record)
+        if count % EXPORT_BATCH_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+def stream_xlsx(records, columns, sheet_title):
+    """
+    Build the workbook with openpyxl's write-only mode (rows are serialised as they
+    are appended, nothing is kept per cell) into a temp file, then stream the file.
+    """
+    import tempfile
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title=sheet_title)
+    ws.append(columns)
+    for record in records:
+        ws.append([record.get(col) for col in columns])
+
+    with tempfile.TemporaryFile() as tmp:
+        wb.save(tmp)
+        tmp.seek(0)
+        while True:
+            chunk = tmp.read(64 * 1024)
+            if not chunk:
+                break
+            yield chunk
+
+def _export_response(kind, columns):
+    from flask import Response, stream_with_context
+
+    fmt = request.args.get('format', 'csv').lower()
+    if fmt not in ('csv', 'xlsx'):
+        return jsonify({'error': 'format must be csv or xlsx'}), 400
+
+    filename = f"{kind}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+    records = iter_export_rows(
+        kind,
+        company_id=request.args.get('company_id', type=int),
+        year=request.args.get('year', type=int),
+        month=request.args.get('month')
+    )
+    if fmt == 'csv':
+        body = stream_csv(records, columns)
+        mimetype = 'text/csv'
+    else:
+        body = stream_xlsx(records, columns, kind.capitalize())
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+    return Response(
+        stream_with_context(body),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+@app.route('/api/exports/invoices', methods=['GET'])
+@read_routed
+def export_invoices():
+    """Stream all invoices as CSV (default) or XLSX. Filters: company_id, year, month"""
+    return _export_response('invoices', INVOICE_EXPORT_COLUMNS)
+
+@app.route('/api/exports/receivables', methods=['GET'])
+@read_routed
+def export_receivables():
+    """Stream invoices with an outstanding balance as CSV (default) or XLSX"""
+    return _export_response('receivables', RECEIVABLE_EXPORT_COLUMNS)
+
+# =====================================
+# PAYMENT LEDGER
+# =====================================
+def post_payment(invoice, amount, receipt_reference=None, paid_on=None, source='manual'):
+    """
+    Append a ledger entry and move the invoice's running balance by `amount`.
+    Caller owns the transaction.
+    """
+    invoice.paid_amount = (invoice.paid_amount or 0) + amount
+    billed = amount_in_inr(invoice.sub_total, invoice_fx_rate(invoice, invoice.company.client_type)) or 0
+    invoice.due_amount = max(billed - invoice.paid_amount, 0)
+    payment = Payment(
+        invoice_id=invoice.id,
+        amount=amount,
+        balance_after=invoice.due_amount,
+        receipt_reference=receipt_reference,
+        paid_on=paid_on,
+        source=source
+    )
+    db.session.add(payment)
+    record_payment_rollup(invoice, amount)
+    return payment
+
+def _parse_paid_on(value):
+    """Accept ISO dates and the dd/mm/yyyy forms banks export"""
+    if not value:
+        return None
+    value = str(value).strip()[:10]
+    for fmt in DATE_INPUT_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    raise ValueError(f"Unrecognised date '{value}'")
+
+def allocate_receipt(allocations, receipt_reference=None, paid_on=None, source='bulk'):
+    """
+    Apply many (invoice key, amount) allocations in the current transaction.
+    Allocations may reference an invoice by id or invoice_number; an amount of
+    None pays off the remaining balance. An allocation larger than the invoice's
+    remaining balance is reported with its overpayment instead of being posted.
+    All invoices are loaded in two queries. Returns (payments, errors).
+    """
+    from sqlalchemy.orm import joinedload
+
+    ids = [a['invoice_id'] for a in allocations if a.get('invoice_id')]
+    numbers = [a['invoice_number'] for a in allocations if a.get('invoice_number')]
+    by_id = {}
+    by_number = {}
+    if ids:
+        for inv in Invoice.query.options(joinedload(Invoice.company)).filter(Invoice.id.in_(ids)).all():
+            by_id[inv.id] = inv
+    if numbers:
+        for inv in Invoice.query.options(joinedload(Invoice.company)).filter(Invoice.invoice_number.in_(numbers)).all():
+            by_number[inv.invoice_number] = inv
+
+    payments = []
+    errors = []
+    for idx, alloc in enumerate(allocations):
+        invoice = by_id.get(alloc.get('invoice_id')) or by_number.get(alloc.get('invoice_number'))
+        if invoice is None:
+            errors.append({'index': idx, 'error': 'Invoice not found',
+                           'invoice': alloc.get('invoice_id') or alloc.get('invoice_number')})
+            continue
+        amount = alloc.get('amount')
+        try:
+            amount = float(amount) if amount not in (None, '') else (invoice.due_amount or 0)
+        except (TypeError, ValueError):
+            errors.append({'index': idx, 'error': 'amount must be a number', 'invoice': invoice.invoice_number})
+            continue
+        if amount <= 0:
+            errors.append({'index': idx, 'error': 'amount must be positive', 'invoice': invoice.invoice_number})
+            continue
+        due = invoice.due_amount or 0
+        if amount - due > 0.005:
+            errors.append({'index': idx, 'error': 'amount exceeds outstanding balance',
+                           'invoice': invoice.invoice_number, 'due_amount': round(due, 2),
+                           'overpayment': round(amount - due, 2)})
+            continue
+        payments.append(post_payment(
+            invoice, amount,
+            receipt_reference=alloc.get('receipt_reference') or receipt_reference,
+            paid_on=alloc.get('paid_on') or paid_on,
+            source=source
+        ))
+    return payments, errors
+
+def _payment_json(p):
+    return {
+        'id': p.id,
+        'invoice_id': p.invoice_id,
+        'amount': p.amount,
+        'balance_after': p.balance_after,
+        'receipt_reference': p.receipt_reference,
+        'paid_on': p.paid_on.isoformat() if p.paid_on else None,
+        'source': p.source,
+        'created_at': p.created_at.isoformat() if p.created_at else None
+    }
+
+@app.route('/api/payments/bulk', methods=['POST'])
+def post_bulk_payment():
+    """
+    Allocate one receipt across many invoices in a single transaction.
+    Body: {receipt_reference, paid_on, allocations: [{invoice_id|invoice_number, amount}]}
+    """
+    try:
+        body = request.get_json(silent=True) or {}
+        allocations = body.get('allocations')
+        if not allocations or not isinstance(allocations, list):
+            return jsonify({'error': 'allocations is required'}), 400
+        try:
+            paid_on = _parse_paid_on(body.get('paid_on'))
+            for alloc in allocations:
+                alloc['paid_on'] = _parse_paid_on(alloc.get('paid_on'))
+        except ValueError:
+            return jsonify({'error': 'paid_on must be YYYY-MM-DD or DD/MM/YYYY'}), 400
+
+        payments, errors = allocate_receipt(allocations, body.get('receipt_reference'), paid_on, source='bulk')
+        if errors:
+            db.session.rollback()
+            return jsonify({'error': 'Some allocations could not be applied', 'details': errors}), 400
+
+        db.session.commit()
+        return jsonify({
+            'receipt_reference': body.get('receipt_reference'),
+            'total_allocated': sum(p.amount for p in payments),
+            'payments': [_payment_json(p) for p in payments]
+        }), 201
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Error in post_bulk_payment: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/payments/import', methods=['POST'])
+def import_bank_statement():
+    """
+    Post payments from a bank-statement CSV (multipart 'file').
+    Rows are matched on an invoice_number column, or on an INV-... token found in
+    the description/narration. Rows that cannot be posted (no match, bad date or
+    amount, overpayment) are returned individually; the rest are posted together
+    in one transaction.
+    """
+    import csv
+    import io
+    import re
+
+    file = request.files.get('file')
+    if not file:
+        return jsonify({'error': 'file is required'}), 400
+
+    invoice_pattern = re.compile(r'INV-[\w-]+')
+    allocations = []
+    unmatched = []
+    try:
+        reader = csv.DictReader(io.TextIOWrapper(file.stream, encoding='utf-8-sig'))
+        for row_no, raw in enumerate(reader, start=2):
+            row = {str(k).strip().lower(): (v or '').strip() for k, v in raw.items() if k}
+            invoice_number = row.get('invoice_number')
+            if not invoice_number:
+                match = invoice_pattern.search(row.get('description') or row.get('narration') or '')
+                invoice_number = match.group(0) if match else None
+            amount = row.get('amount') or row.get('credit')
+            if not invoice_number or not amount:
+                unmatched.append({'row': row_no, 'error': 'No invoice number or amount'})
+                continue
+            try:
+                paid_on = _parse_paid_on(row.get('date'))
+            except ValueError as e:
+                unmatched.append({'row': row_no, 'error': str(e)})
+                continue
+            allocations.append({
+                'row': row_no,
+                'invoice_number': invoice_number,
+                'amount': amount.replace(',', ''),
+                'receipt_reference': row.get('reference') or row.get('ref'),
+                'paid_on': paid_on
+            })
+    except ValueError as e:
+        return jsonify({'error': f'Invalid bank statement: {str(e)}'}), 400
+
+    try:
+        payments, errors = allocate_receipt(allocations, source='bank_import')
+        for err in errors:
+            row = {k: v for k, v in err.items() if k != 'index'}
+            row['row'] = allocations[err['index']]['row']
+            unmatched.append(row)
+        db.session.commit()
+        return jsonify({
+            'posted': len(payments),
+            'total_allocated': sum(p.amount for p in payments),
+            'unmatched': unmatched
+        }), 200
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Error in import_bank_statement: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/invoices/<int:invoice_id>/payments', methods=['GET'])
+def get_invoice_payments(invoice_id):
+    invoice = find_invoice(invoice_id)
+    archived = getattr(invoice, 'archived', False)
+    return jsonify({
+        'invoice_id': invoice.id,
+        'paid_amount': invoice.paid_amount or 0,
+        'due_amount': invoice.due_amount,
+        'archived': archived,
+        'payments': invoice.payment_entries if archived else [_payment_json(p) for p in invoice.payments]
+    })
+
+@app.route('/api/receivables/outstanding', methods=['GET'])
+@read_routed
+def get_outstanding():
+    """Outstanding balance per company straight from the stored running balances"""
+    rows = db.session.query(
+        Company.id, Company.name,
+        db.func.count(Invoice.id), db.func.sum(Invoice.due_amount)
+    ).join(Invoice, Invoice.company_id == Company.id).filter(
+        Invoice.due_amount > 0
+    ).group_by(Company.id, Company.name).all()
+    return jsonify({
+        'total_outstanding': sum(r[3] or 0 for r in rows),
+        'companies': [{
+            'company_id': r[0],
+            'company_name': r[1],
+            'open_invoices': r[2],
+            'outstanding': r[3] or 0
+        } for r in rows]
+    })
+
+# =====================================
+# ANALYTICS ROLLUPS
+# =====================================
+def _upsert_rollup(model, keys, increments, insert_only=None):
+    """Atomically add `increments` to the rollup row identified by `keys` (creating it if needed)"""
+    from sqlalchemy.dialects.sqlite import insert
+
+    stmt = insert(model).values(**keys, **increments, **(insert_only or {}), updated_at=datetime.utcnow())
+    cols = model.__table__.c
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_=dict({k: cols[k] + stmt.excluded[k] for k in increments}, updated_at=stmt.excluded.updated_at)
+    )
+    db.session.execute(stmt)
+
+def _rollup_amounts(results, fx_rate):
+    """Per-employee usage from parsed timesheet results, amounts converted to INR"""
+    usage = {}
+    for r in results:
+        if 'error' in r:
+            continue
+        name = str(r.get('employee_name') or 'Unknown Employee').strip()
+        entry = usage.setdefault(name, {'billed_hours': 0, 'billed_days': 0, 'amount': 0})
+        entry['billed_hours'] += r.get('total_worked_hours', 0) or 0
+        entry['billed_days'] += r.get('total_worked_days', 0) or 0
+        entry['amount'] += amount_in_inr(r.get('total_amount', 0) or 0, fx_rate)
+    return usage
+
+def record_invoice_rollups(invoice, results):
+    usage = _rollup_amounts(results, invoice.fx_rate)
+    period = {'year': invoice.year, 'month': invoice.month}
+    _upsert_rollup(RevenueRollup, dict(company_id=invoice.company_id, po_id=invoice.po_id, **period), {
+        'invoice_count': 1,
+        'net_amount': amount_in_inr(invoice.total_amount, invoice.fx_rate) or 0,
+        'billed_amount': amount_in_inr(invoice.sub_total, invoice.fx_rate) or 0,
+        'paid_amount': 0,
+        'billed_hours': sum(u['billed_hours'] for u in usage.values()),
+        'billed_days': sum(u['billed_days'] for u in usage.values())
+    })
+    for name, totals in usage.items():
+        _upsert_rollup(UsageRollup, dict(po_id=invoice.po_id, employee_name=name, **period),
+                       dict(totals, invoice_count=1), insert_only={'company_id': invoice.company_id})
+
+def record_payment_rollup(invoice, amount):
+    _upsert_rollup(RevenueRollup, {
+        'company_id': invoice.company_id, 'po_id': invoice.po_id, 'year': invoice.year, 'month': invoice.month
+    }, {'invoice_count': 0, 'net_amount': 0, 'billed_amount': 0, 'paid_amount': amount,
+        'billed_hours': 0, 'billed_days': 0})
+
+def rebuild_analytics(batch_size=500):
+    """
+    Recompute both rollup tables from scratch in one streaming pass over hot and
+    archived invoices. Only the aggregates are held in memory, never the invoice rows.
+    """
+    import zlib
+
+    revenue = {}
+    usage = {}
+    hot = db.session.query(
+        Invoice.id, Invoice.company_id, Invoice.po_id, Invoice.year, Invoice.month, Invoice.total_amount,
+        Invoice.sub_total, Invoice.paid_amount, Invoice.invoice_data, Invoice.fx_rate, Invoice.created_at,
+        Company.client_type
+    ).join(Company, Invoice.company_id == Company.id).execution_options(yield_per=batch_size)
+    archived = db.session.query(
+        ArchivedInvoice.id, ArchivedInvoice.company_id, ArchivedInvoice.po_id, ArchivedInvoice.year, ArchivedInvoice.month,
+        ArchivedInvoice.total_amount, ArchivedInvoice.sub_total, ArchivedInvoice.paid_amount,
+        ArchivedInvoice.invoice_data_gz, ArchivedInvoice.fx_rate, ArchivedInvoice.created_at,
+        ArchivedInvoice.client_type
+    )
+
+    def add(row, invoice_data):
+        results = json.loads(invoice_data).get('employees', [])
+        fx_rate = invoice_fx_rate(row, row.client_type)
+        per_employee = _rollup_amounts(results, fx_rate)
+
+        rev = revenue.setdefault((row.company_id, row.po_id, row.year, row.month), {
+            'invoice_count': 0, 'net_amount': 0, 'billed_amount': 0, 'paid_amount': 0,
+            'billed_hours': 0, 'billed_days': 0})
+        rev['invoice_count'] += 1
+        rev['net_amount'] += amount_in_inr(row.total_amount, fx_rate) or 0
+        rev['billed_amount'] += amount_in_inr(row.sub_total, fx_rate) or 0
+        rev['paid_amount'] += row.paid_amount or 0
+        for name, totals in per_employee.items():
+            rev['billed_hours'] += totals['billed_hours']
+            rev['billed_days'] += totals['billed_days']
+            use = usage.setdefault((row.po_id, name, row.year, row.month), {
+                'company_id': row.company_id, 'invoice_count': 0, 'billed_hours': 0, 'billed_days': 0,
+                'amount': 0})
+            use['invoice_count'] += 1
+            for k, v in totals.items():
+                use[k] += v
+
+    invoice_count = 0
+    for row in hot:
+        invoice_count += 1
+        add(row, row.invoice_data or '{}')
+
+    # An interrupted archive run can leave a row in both databases; the hot copy
+    # wins. One id lookup against the hot database per archived batch.
+    archived_batches = db.session.execute(
+        archived.statement, execution_options={'yield_per': batch_size}).partitions()
+    for batch in archived_batches:
+        in_hot = {i for (i,) in db.session.query(Invoice.id).filter(Invoice.id.in_([r.id for r in batch]))}
+        for row in batch:
+            if row.id in in_hot:
+                continue
+            invoice_count += 1
+            add(row, zlib.decompress(row.invoice_data_gz).decode() if row.invoice_data_gz else '{}')
+
+    now = datetime.utcnow()
+    RevenueRollup.query.delete()
+    UsageRollup.query.delete()
+    db.session.bulk_insert_mappings(RevenueRollup, [
+        dict(v, company_id=k[0], po_id=k[1], year=k[2], month=k[3], updated_at=now) for k, v in revenue.items()
+    ])
+    db.session.bulk_insert_mappings(UsageRollup, [
+        dict(v, po_id=k[0], employee_name=k[1], year=k[2], month=k[3], updated_at=now) for k, v in usage.items()
+    ])
+    db.session.commit()
+    return {'invoices': invoice_count, 'revenue_rows': len(revenue), 'usage_rows': len(usage)}
+
+def _analytics_period_columns(model, period):
+    if period == 'year':
+        return [model.year.label('year')]
+    if period == 'quarter':
+        quarter = ((db.cast(model.month, db.Integer) + 2) // 3).label('quarter')
+        return [model.year.label('year'), quarter]
+    return [model.year.label('year'), model.month.label('month')]
+
+@app.route('/api/analytics/revenue', methods=['GET'])
+@read_routed
+def get_revenue_analytics():
+    """
+    Revenue from the rollup table.
+    group_by=company|po, period=month|quarter|year, optional year/company_id filters
+    """
+    group_by = request.args.get('group_by', 'company')
+    period = request.args.get('period', 'month')
+    if group_by not in ('company', 'po') or period not in ('month', 'quarter', 'year'):
+        return jsonify({'error': 'group_by must be company|po and period month|quarter|year'}), 400
+
+    period_cols = _analytics_period_columns(RevenueRollup, period)
+    group_cols = [RevenueRollup.company_id, Company.name.label('company_name')]
+    if group_by == 'po':
+        group_cols += [RevenueRollup.po_id, PONumber.po_number]
+
+    q = db.session.query(
+        *group_cols, *period_cols,
+        db.func.sum(RevenueRollup.invoice_count).label('invoice_count'),
+        db.func.sum(RevenueRollup.net_amount).label('net_amount'),
+        db.func.sum(RevenueRollup.billed_amount).label('billed_amount'),
+        db.func.sum(RevenueRollup.paid_amount).label('paid_amount'),
+        db.func.sum(RevenueRollup.billed_hours).label('billed_hours'),
+        db.func.sum(RevenueRollup.billed_days).label('billed_days')
+    ).join(Company, Company.id == RevenueRollup.company_id)
+    if group_by == 'po':
+        q = q.join(PONumber, PONumber.id == RevenueRollup.po_id)
+
+    year = request.args.get('year', type=int)
+    company_id = request.args.get('company_id', type=int)
+    if year:
+        q = q.filter(RevenueRollup.year == year)
+    if company_id:
+        q = q.filter(RevenueRollup.company_id == company_id)
+
+    rows = q.group_by(*group_cols, *period_cols).order_by(*[c.desc() for c in period_cols]).all()
+    return jsonify([dict(row._mapping) for row in rows])
+
+@app.route('/api/analytics/usage', methods=['GET'])
+@read_routed
+def get_usage_analytics():
+    """Billed hours/days per employee per month. Filters: company_id, po_id, year, month, employee"""
+    q = db.session.query(
+        UsageRollup.company_id, UsageRollup.po_id, PONumber.po_number, UsageRollup.employee_name,
+        UsageRollup.year, UsageRollup.month, UsageRollup.billed_hours, UsageRollup.billed_days,
+        UsageRollup.amount, UsageRollup.invoice_count
+    ).join(PONumber, PONumber.id == UsageRollup.po_id)
+
+    for arg, column, cast in (('company_id', UsageRollup.company_id, int), ('po_id', UsageRollup.po_id, int),
+                              ('year', UsageRollup.year, int), ('month', UsageRollup.month, str),
+                              ('employee', UsageRollup.employee_name, str)):
+        value = request.args.get(arg, type=cast)
+        if value:
+            q = q.filter(column == value)
+
+    rows = q.order_by(UsageRollup.year.desc(), UsageRollup.month.desc(), UsageRollup.employee_name).all()
+    return jsonify([dict(row._mapping) for row in rows])
+
+@app.route('/api/analytics/rebuild', methods=['POST'])
+def rebuild_analytics_endpoint():
+    try:
+        return jsonify(rebuild_analytics()), 200
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Error in rebuild_analytics: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+# =====================================
+# FX RATE MANAGEMENT
+# =====================================
+@app.route('/api/fx-rates', methods=['GET'])
+def get_fx_rates():
+    q = FxRate.query
+    currency = request.args.get('currency')
+    if currency:
+        q = q.filter(FxRate.currency == currency.upper())
+    return jsonify([{
+        'currency': r.currency,
+        'rate_date': r.rate_date.isoformat(),
+        'rate': r.rate
+    } for r in q.order_by(FxRate.currency, FxRate.rate_date.desc()).all()])
+
+@app.route('/api/fx-rates/import', methods=['POST'])
+def import_fx_rates():
+    """
+    Bulk load dated rates from a CSV (multipart 'file') with columns currency,date,rate.
+    Existing (currency, date) pairs are overwritten; the whole file is one transaction.
+    """
+    import csv
+    import io
+    from sqlalchemy.dialects.sqlite import insert
+
+    file = request.files.get('file')
+    if not file:
+        return jsonify({'error': 'file is required'}), 400
+
+    rows = []
+    errors = []
+    reader = csv.DictReader(io.TextIOWrapper(file.stream, encoding='utf-8-sig'))
+    for row_no, raw in enumerate(reader, start=2):
+        row = {str(k).strip().lower(): (v or '').strip() for k, v in raw.items() if k}
+        try:
+            currency = row['currency'].upper()
+            if len(currency) != 3:
+                raise ValueError('currency must be a 3 letter code')
+            rate = float(row['rate'])
+            if rate <= 0:
+                raise ValueError('rate must be positive')
+            rows.append({
+                'currency': currency,
+                'rate_date': datetime.strptime(row['date'], '%Y-%m-%d').date(),
+                'rate': rate,
+                'created_at': datetime.utcnow()
+            })
+        except (KeyError, ValueError) as e:
+            errors.append({'row': row_no, 'error': str(e)})
+
+    if errors:
+        return jsonify({'error': 'Invalid rows in FX rate file', 'details': errors}), 400
+    if not rows:
+        return jsonify({'error': 'No rates found'}), 400
+
+    try:
+        stmt = insert(FxRate)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['currency', 'rate_date'],
+            set_={'rate': stmt.excluded.rate}
+        )
+        db.session.execute(stmt, rows)
+        db.session.commit()
+        invalidate_cache('fx')
+        return jsonify({'imported': len(rows)}), 200
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Error in import_fx_rates: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+# =====================================
+# INVOICE TEMPLATE REGISTRY
+# =====================================
+import re
+
+BUILTIN_TEMPLATES = {
+    'same_state': 'same_state.docx',
+    'other_state': 'other_state.docx',
+    'foreign': 'USD INVOICE.docx',
+}
+REQUIRED_PLACEHOLDERS = {
+    'same_state': {'[name]', '[Invoice number]', '[TIA]'},
+    'other_state': {'[name]', '[Invoice number]', '[TIA]'},
+    'foreign': {'[name]', '[Invoice number]', '[ST]'},
+}
+PLACEHOLDER_PATTERN = re.compile(r'\[[^\[\]]{1,40}\]')
+
+compiled_templates = LRUCacheBackend(max_entries=app.config['TEMPLATE_CACHE_SIZE'])
+
+def build_template_data(invoice, company, po, client_type, net_total, cgst, sgst, igst, grand_total):
+    """Placeholder values shared by every layout; templates use whichever keys they contain"""
+    symbol = '$' if client_type == 'foreign' else '₹'
+    created = invoice.created_at
+    data = {
+        '[Invoice number]': invoice.invoice_number,
+        '[Date]': created.strftime('%Y-%m-%d'),
+        '[MM]': created.strftime('%m'),
+        '[YYYY]': created.strftime('%Y'),
+        '[PO number]': po.po_number,
+        '[company_name]': company.name,
+        '[building_no]': company.building_no,
+        '[local_street]': company.local_street,
+        '[city]': company.city,
+        '[state]': company.state,
+        '[country]': company.country,
+        '[pin_code]': company.pin_code,
+        '[GST]': company.GST,
+        '[SAC]': company.SAC,
+        '[sub_total]': f'{symbol}{net_total:,.2f}',
+        '[CGST]': f'{symbol}{cgst:,.2f}',
+        '[SGST]': f'{symbol}{sgst:,.2f}',
+        '[IGST]': f'{symbol}{igst:,.2f}',
+        '[TIA]': f'{symbol}{grand_total:,.2f}',
+        '[ST]': f'{symbol}{grand_total:,.2f}',
+    }
+    # fill_document does str.replace, so every value must be a string
+    return {k: '' if v is None else str(v) for k, v in data.items()}
+
+# Keys build_template_data fills; anything else bracketed in a layout is literal text
+TEMPLATE_PLACEHOLDERS = {
+    '[Invoice number]', '[Date]', '[MM]', '[YYYY]', '[PO number]', '[company_name]', '[building_no]',
+    '[local_street]', '[city]', '[state]', '[country]', '[pin_code]', '[GST]', '[SAC]', '[sub_total]',
+    '[CGST]', '[SGST]', '[IGST]', '[TIA]', '[ST]'
+}
+
+def scan_template_placeholders(source):
+    """
+    Return (document placeholders, employee row placeholders) for a DOCX path or file.
+    The row holding [name] is cloned per employee and filled by column position.
+    """
+    doc = Document(source)
+    found = set()
+    row_tokens = set()
+    for paragraph in doc.paragraphs:
+        found.update(PLACEHOLDER_PATTERN.findall(paragraph.text))
+    for table in doc.tables:
+        for row in table.rows:
+            tokens = set()
+            for cell in row.cells:
+                tokens.update(PLACEHOLDER_PATTERN.findall(cell.text))
+            if '[name]' in tokens:
+                row_tokens.update(tokens)
+            else:
+                found.update(tokens)
+    return found, row_tokens
+
+def validate_template(source, client_type):
+    """Raise ValueError when required placeholders are missing; return (placeholders, warnings)"""
+    found, row_tokens = scan_template_placeholders(source)
+    missing = REQUIRED_PLACEHOLDERS[client_type] - (found | row_tokens)
+    if missing:
+        raise ValueError(f"Template is missing required placeholders: {', '.join(sorted(missing))}")
+    unknown = sorted(found - TEMPLATE_PLACEHOLDERS)
+    warnings = [f"{token} is not a known placeholder and will be left as written" for token in unknown]
+    return sorted(found | row_tokens), warnings
+
+def seed_builtin_templates():
+    """Register the shipped layouts as version 1 defaults, once"""
+    existing = {}
+    for t in InvoiceTemplate.query.filter(InvoiceTemplate.company_id.is_(None)).all():
+        existing[t.client_type] = t
+        if not os.path.isabs(t.file_path):
+            # Rows seeded before paths were absolute only worked from the backend directory
+            t.file_path = os.path.join(app.config['TEMPLATES_FOLDER'], os.path.basename(t.file_path))
+    for client_type, filename in BUILTIN_TEMPLATES.items():
+        path = os.path.join(app.config['TEMPLATES_FOLDER'], filename)
+        if client_type in existing or not os.path.exists(path):
+            continue
+        db.session.add(InvoiceTemplate(
+            company_id=None, client_type=client_type, name=filename, version=1, file_path=path, is_active=True
+        ))
+    db.session.commit()
+
+def resolve_invoice_template(company):
+    """The company's newest active template, else the built-in for its client type"""
+    template = InvoiceTemplate.query.filter_by(
+        company_id=company.id, client_type=company.client_type, is_active=True
+    ).order_by(InvoiceTemplate.version.desc()).first()
+    if template is None:
+        template = InvoiceTemplate.query.filter(
+            InvoiceTemplate.company_id.is_(None),
+            InvoiceTemplate.client_type == company.client_type,
+            InvoiceTemplate.is_active.is_(True)
+        ).order_by(InvoiceTemplate.version.desc()).first()
+    if template is None:
+        raise FileNotFoundError(f'No invoice template registered for client type {company.client_type}')
+    return template
+
+def load_compiled_template(template):
+    """
+    Templates are parsed once per (template id, version) and kept in a bounded LRU;
+    each render fills its own deep copy, which is several times cheaper than re-parsing.
+    """
+    key = (template.id, template.version)
+    parsed = compiled_templates.get(key)
+    if parsed is None:
+        if not os.path.exists(template.file_path):
+            raise FileNotFoundError(f'Invoice template not found at {template.file_path}')
+        parsed = Document(template.file_path)
+        compiled_templates.set(key, parsed)
+    return deepcopy(parsed)
+
+def _template_json(t):
+    return {
+        'id': t.id,
+        'company_id': t.company_id,
+        'client_type': t.client_type,
+        'name': t.name,
+        'version': t.version,
+        'placeholders': json.loads(t.placeholders) if t.placeholders else None,
+        'is_active': bool(t.is_active),
+        'created_at': t.created_at.isoformat() if t.created_at else None
+    }
+
+@app.route('/api/companies/<int:company_id>/templates', methods=['POST'])
+def upload_company_template(company_id):
+    """Upload a new DOCX layout for a company; it becomes the next active version"""
+    import io
+
+    try:
+        company = Company.query.get_or_404(company_id)
+        file = request.files.get('template')
+        if not file or not file.filename.lower().endswith('.docx'):
+            return jsonify({'error': 'A .docx template file is required'}), 400
+
+        raw = file.read()
+        try:
+            placeholders, warnings = validate_template(io.BytesIO(raw), company.client_type)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            return jsonify({'error': f'Could not read template: {str(e)}'}), 400
+
+        latest = db.session.query(db.func.max(InvoiceTemplate.version)).filter_by(
+            company_id=company.id, client_type=company.client_type).scalar() or 0
+        version = latest + 1
+
+        folder = os.path.join(app.config['TEMPLATES_FOLDER'], f'company_{company.id}')
+        os.makedirs(folder, exist_ok=True)
+        filepath = os.path.join(folder, f'v{version}_{secure_filename(file.filename)}')
+        with open(filepath, 'wb') as f:
+            f.write(raw)
+
+        template = InvoiceTemplate(
+            company_id=company.id,
+            client_type=company.client_type,
+            name=file.filename,
+            version=version,
+            file_path=filepath,
+            placeholders=json.dumps(placeholders),
+            is_active=True
+        )
+        db.session.add(template)
+        db.session.commit()
+        compiled_templates.set((template.id, template.version), Document(io.BytesIO(raw)))
+
+        return jsonify(dict(_template_json(template), warnings=warnings)), 201
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Error in upload_company_template: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/companies/<int:company_id>/templates', methods=['GET'])
+def get_company_templates(company_id):
+    Company.query.get_or_404(company_id)
+    templates = InvoiceTemplate.query.filter_by(company_id=company_id).order_by(InvoiceTemplate.version.desc()).all()
+    return jsonify([_template_json(t) for t in templates])
+
+@app.route('/api/templates/<int:template_id>/status', methods=['PUT'])
+def update_template_status(template_id):
+    """Deactivate a version to fall back to the previous one (or the built-in)"""
+    try:
+        template = InvoiceTemplate.query.get_or_404(template_id)
+        body = request.get_json(silent=True) or {}
+        if 'is_active' not in body:
+            return jsonify({'error': 'is_active is required'}), 400
+        if template.company_id is None and not body.get('is_active'):
+            # Built-ins are the last fallback of resolve_invoice_template
+            return jsonify({'error': 'Built-in templates cannot be deactivated'}), 400
+        template.is_active = bool(body.get('is_active'))
+        db.session.commit()
+        return jsonify(_template_json(template)), 200
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+with app.app_context():
+    seed_builtin_templates()
+
+# =====================================
+# INVOICE ARCHIVE
+# =====================================
+def find_invoice(invoice_id):
+    """Hot table first, then the archive; 404 when neither has the invoice"""
+    from flask import abort
+
+    invoice = db.session.get(Invoice, invoice_id)
+    if invoice is None:
+        invoice = db.session.get(ArchivedInvoice, invoice_id)
+    if invoice is None:
+        abort(404)
+    return invoice
+
+def archived_invoice_summaries():
+    """List rows for archived invoices, read without decompressing any payload"""
+    rows = db.session.query(
+        ArchivedInvoice.id, ArchivedInvoice.invoice_number, ArchivedInvoice.company_name,
+        ArchivedInvoice.po_label, ArchivedInvoice.client_type, ArchivedInvoice.total_amount,
+        ArchivedInvoice.sub_total, ArchivedInvoice.fx_rate, ArchivedInvoice.paid_amount,
+        ArchivedInvoice.due_amount, ArchivedInvoice.month, ArchivedInvoice.year, ArchivedInvoice.created_at
+    ).order_by(ArchivedInvoice.created_at.desc())
+    return [{
+        'id': r.id,
+        'invoice_number': r.invoice_number,
+        'company_name': r.company_name,
+        'po_number': r.po_label,
+        'client_type': r.client_type,
+        'total_amount': r.total_amount,
+        'sub_total': r.sub_total,
+        'total_amount_in_inr': amount_in_inr(r.total_amount, r.fx_rate),
+        'sub_total_in_inr': amount_in_inr(r.sub_total, r.fx_rate),
+        'paid_amount': r.paid_amount or 0,
+        'due_amount': r.due_amount or 0,
+        'month': r.month,
+        'year': r.year,
+        'created_at': r.created_at.isoformat() if r.created_at else None,
+        'archived': True
+    } for r in rows]
+
+def archive_invoices(months=None, batch_size=200, dry_run=False):
+    """
+    Move fully paid invoices older than `months` into the archive database.
+    Each batch is written (compressed) to the archive and committed before the hot
+    rows are deleted, so a crash can leave a row in both places but never in neither;
+    reads prefer the hot copy and the next run replaces the archived one.
+    """
+    import zlib
+    from dateutil.relativedelta import relativedelta
+
+    months = months if months is not None else app.config['ARCHIVE_HORIZON_MONTHS']
+    cutoff = datetime.utcnow() - relativedelta(months=months)
+    # SQLite reuses the highest rowid once it is deleted; keeping the newest row
+    # guarantees archived ids are never handed out again
+    newest_id = db.session.query(db.func.max(Invoice.id)).scalar()
+
+    candidates = db.session.query(Invoice.id).filter(
+        Invoice.created_at < cutoff,
+        db.func.coalesce(Invoice.due_amount, 0) <= 0,
+        Invoice.id != newest_id
+    ).order_by(Invoice.id)
+    ids = [row[0] for row in candidates]
+    stats = {'cutoff': cutoff.isoformat(), 'candidates': len(ids), 'archived': 0,
+             'bytes_before': 0, 'bytes_after': 0}
+    if dry_run or not ids:
+        return stats
+
+    from sqlalchemy.orm import joinedload
+
+    for start in range(0, len(ids), batch_size):
+        batch_ids = ids[start:start + batch_size]
+        invoices = Invoice.query.options(
+            joinedload(Invoice.company), joinedload(Invoice.po_number), joinedload(Invoice.payments)
+        ).filter(Invoice.id.in_(batch_ids)).all()
+
+        rows = []
+        for inv in invoices:
+            raw = (inv.invoice_data or '{}').encode()
+            packed = zlib.compress(raw, 9)
+            stats['bytes_before'] += len(raw)
+            stats['bytes_after'] += len(packed)
+            rows.append({
+                'id': inv.id,
+                'company_id': inv.company_id,
+                'po_id': inv.po_id,
+                'invoice_number': inv.invoice_number,
+                'invoice_data_gz': packed,
+                'payments_gz': zlib.compress(json.dumps([_payment_json(p) for p in inv.payments]).encode(), 9),
+                'total_amount': inv.total_amount,
+                'sub_total': inv.sub_total,
+                'paid_amount': inv.paid_amount,
+                'due_amount': inv.due_amount,
+                'fx_rate': inv.fx_rate,
+                'month': inv.month,
+                'year': inv.year,
+                'created_at': inv.created_at,
+                'archived_at': datetime.utcnow(),
+                'company_name': inv.company.name,
+                'po_label': inv.po_number.po_number,
+                'client_type': inv.company.client_type
+            })
+
+        with db.engines['archive'].begin() as conn:
+            conn.execute(ArchivedInvoice.__table__.insert().prefix_with('OR REPLACE'), rows)
+
+        Payment.query.filter(Payment.invoice_id.in_(batch_ids)).delete(synchronize_session=False)
+        Invoice.query.filter(Invoice.id.in_(batch_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        stats['archived'] += len(rows)
+
+    return stats
+
+def vacuum_database():
+    """Give the space freed by archiving back to the file system"""
+    with db.engine.connect() as conn:
+        conn.execution_options(isolation_level='AUTOCOMMIT').execute(db.text('VACUUM'))
+
+@app.route('/api/archive', methods=['POST'])
+def run_archive():
+    """Archive paid invoices older than ?months= (default ARCHIVE_HORIZON_MONTHS); ?dry_run=1 only counts"""
+    try:
+        months = request.args.get('months', type=int)
+        dry_run = request.args.get('dry_run', '').lower() in ('1', 'true')
+        return jsonify(archive_invoices(months=months, dry_run=dry_run)), 200
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ Error in run_archive: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+# =====================================
+# ON-DEMAND PROFILING
+# =====================================
+
+PROFILE_TOP_FUNCTIONS = 15
+
+def _profiling_requested():
+    if not app.config['PROFILING_ENABLED']:
+        return None
+    mode = request.headers.get('X-Profile') or request.args.get('profile')
+    if not mode or mode.lower() in ('0', 'false'):
+        return None
+    token = app.config.get('PROFILING_TOKEN')
+    if token and not hmac.compare_digest(request.headers.get('X-Profile-Token', ''), token):
+        return None
+    return 'pyinstrument' if mode.lower() == 'pyinstrument' else 'cprofile'
+
+@app.before_request
+def start_request_profile():
+    mode = _profiling_requested()
+    if mode is None:
+        return
+    if mode == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler  # optional sampling profiler
+            g.profiler = Profiler()
+        except ImportError:
+            mode = 'cprofile'
+    if mode == 'cprofile':
+        import cProfile
+        g.profiler = cProfile.Profile()
+    g.profile_mode = mode
+    g.profile_started = time.perf_counter()
+    if mode == 'cprofile':
+        g.profiler.enable()
+    else:
+        g.profiler.start()
+
+def _top_functions(profiler):
+    import pstats
+
+    stats = pstats.Stats(profiler).stats
+    ranked = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP_FUNCTIONS]
+    return [{
+        'function': f"{func} ({os.path.basename(filename)}:{line})",
+        'calls': calls,
+        'own_seconds': round(own, 4),
+        'cumulative_seconds': round(cumulative, 4)
+    } for (filename, line, func), (_, calls, own, cumulative, _) in ranked]
+
+def _prune_profiles():
+    folder = app.config['PROFILES_FOLDER']
+    metas = sorted(f for f in os.listdir(folder) if f.endswith('.json'))
+    for meta in metas[:-app.config['PROFILES_KEEP']]:
+        stem = meta[:-len('.json')]
+        for name in os.listdir(folder):
+            if name.startswith(stem):
+                os.remove(os.path.join(folder, name))
+
+@app.after_request
+def finish_request_profile(response):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    try:
+        mode = g.pop('profile_mode')
+        duration = time.perf_counter() - g.pop('profile_started')
+        folder = app.config['PROFILES_FOLDER']
+        os.makedirs(folder, exist_ok=True)
+        stem = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}_{request.endpoint or 'unknown'}"
+
+        if mode == 'cprofile':
+            profiler.disable()
+            trace_file = f'{stem}.prof'
+            profiler.dump_stats(os.path.join(folder, trace_file))
+            top = _top_functions(profiler)
+        else:
+            profiler.stop()
+            trace_file = f'{stem}.html'
+            with open(os.path.join(folder, trace_file), 'w') as f:
+                f.write(profiler.output_html())
+            top = []
+
+        meta = {
+            'id': stem,
+            'method': request.method,
+            'path': request.full_path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'duration_ms': round(duration * 1000, 1),
+            'mode': mode,
+            'trace_file': trace_file,
+            'created_at': datetime.utcnow().isoformat(),
+            'top_functions': top
+        }
+        with open(os.path.join(folder, f'{stem}.json'), 'w') as f:
+            json.dump(meta, f)
+        _prune_profiles()
+        response.headers['X-Profile-Id'] = stem
+    except Exception as e:
+        print(f"❌ Error saving request profile: {str(e)}")
+    return response
+
+def _require_profiling():
+    if not app.config['PROFILING_ENABLED']:
+        return jsonify({'error': 'Profiling is disabled'}), 404
+    token = app.config.get('PROFILING_TOKEN')
+    if token and not hmac.compare_digest(request.headers.get('X-Profile-Token', ''), token):
+        return jsonify({'error': 'Invalid profiling token'}), 403
+    return None
+
+@app.route('/api/debug/profiles', methods=['GET'])
+def list_profiles():
+    """Most recent request profiles with their top functions by cumulative time"""
+    denied = _require_profiling()
+    if denied:
+        return denied
+    folder = app.config['PROFILES_FOLDER']
+    if not os.path.isdir(folder):
+        return jsonify([])
+    limit = request.args.get('limit', 20, type=int)
+    metas = sorted((f for f in os.listdir(folder) if f.endswith('.json')), reverse=True)[:limit]
+    result = []
+    for name in metas:
+        with open(os.path.join(folder, name)) as f:
+            result.append(json.load(f))
+    return jsonify(result)
+
+@app.route('/api/debug/profiles/<profile_id>', methods=['GET'])
+def download_profile(profile_id):
+    """Raw trace: .prof for cProfile (open with snakeviz/pstats) or .html for pyinstrument"""
+    denied = _require_profiling()
+    if denied:
+        return denied
+    folder = app.config['PROFILES_FOLDER']
+    profile_id = secure_filename(profile_id)
+    for ext in ('.prof', '.html'):
+        path = os.path.join(folder, profile_id + ext)
+        if os.path.exists(path):
+            return send_file(os.path.abspath(path), as_attachment=True, download_name=profile_id + ext)
+    return jsonify({'error': 'Profile not found'}), 404
+
+# =====================================
+# FULL-TEXT SEARCH (SQLite FTS5)
+# =====================================
+# fts table -> (content table, indexed columns). External-content tables: the index
+# stores only tokens and triggers keep it in step with every insert/update/delete.
+SEARCH_INDEXES = {
+    'company_fts': ('company', ['name']),
+    'po_number_fts': ('po_number', ['po_number']),
+    'employee_fts': ('employee', ['name', 'email']),
+    'invoice_fts': ('invoice', ['invoice_number']),
+}
+
+SEARCH_QUERIES = {
+    'company': (
+        "SELECT 'company' AS kind, c.id AS id, c.name AS title, c.client_type AS subtitle, "
+        "c.id AS company_id, bm25(company_fts) AS score "
+        "FROM company_fts JOIN company c ON c.id = company_fts.rowid WHERE company_fts MATCH :q"
+    ),
+    'po': (
+        "SELECT 'po' AS kind, p.id AS id, p.po_number AS title, co.name AS subtitle, "
+        "p.company_id AS company_id, bm25(po_number_fts) AS score "
+        "FROM po_number_fts JOIN po_number p ON p.id = po_number_fts.rowid "
+        "JOIN company co ON co.id = p.company_id WHERE po_number_fts MATCH :q"
+    ),
+    'employee': (
+        "SELECT 'employee' AS kind, e.id AS id, e.name AS title, COALESCE(e.email, '') AS subtitle, "
+        "p.company_id AS company_id, bm25(employee_fts) AS score "
+        "FROM employee_fts JOIN employee e ON e.id = employee_fts.rowid "
+        "JOIN po_number p ON p.id = e.po_id WHERE employee_fts MATCH :q"
+    ),
+    'invoice': (
+        "SELECT 'invoice' AS kind, i.id AS id, i.invoice_number AS title, co.name AS subtitle, "
+        "i.company_id AS company_id, bm25(invoice_fts) AS score "
+        "FROM invoice_fts JOIN invoice i ON i.id = invoice_fts.rowid "
+        "JOIN company co ON co.id = i.company_id WHERE invoice_fts MATCH :q"
+    ),
+}
+
+search_available = False
+
+def _search_index_ddl(fts, table, columns):
+    cols = ', '.join(columns)
+    new_vals = ', '.join(f'new.{c}' for c in columns)
+    old_vals = ', '.join(f'old.{c}' for c in columns)
+    return [
+        f"CREATE VIRTUAL TABLE {fts} USING fts5({cols}, content='{table}', content_rowid='id', "
+        f"tokenize='unicode61', prefix='2 3')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new_vals}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_vals}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_vals}); "
+        f"INSERT INTO {fts}(rowid, {cols}) VALUES (new.id, {new_vals}); END",
+    ]
+
+def ensure_search_indexes():
+    """Create missing FTS tables and triggers, back-filling new tables from existing rows"""
+    global search_available
+    try:
+        with db.engine.begin() as conn:
+            existing = {row[0] for row in conn.execute(db.text(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE '%_fts'"))}
+            for fts, (table, columns) in SEARCH_INDEXES.items():
+                if fts in existing:
+                    continue
+                for statement in _search_index_ddl(fts, table, columns):
+                    conn.execute(db.text(statement))
+                conn.execute(db.text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+        search_available = True
+    except Exception as e:
+        print(f"❌ Full-text search unavailable (SQLite built without FTS5?): {str(e)}")
+
+def build_match_query(text):
+    """Turn free text into a safe FTS5 query: every word must match, as a prefix"""
+    words = re.findall(r'\w+', text)
+    return ' '.join(f'"{w}"*' for w in words)
+
+@app.route('/api/search', methods=['GET'])
+def search():
+    """
+    Ranked search over company names, PO numbers, employee names/emails and invoice numbers.
+    ?q=text&types=company,po,employee,invoice&page=1&per_page=20
+    """
+    if not search_available:
+        return jsonify({'error': 'Search is not available on this database'}), 501
+
+    match = build_match_query(request.args.get('q', ''))
+    if not match:
+        return jsonify({'error': 'q is required'}), 400
+
+    types = [t for t in request.args.get('types', ','.join(SEARCH_QUERIES)).split(',') if t in SEARCH_QUERIES]
+    if not types:
+        return jsonify({'error': f"types must be among {', '.join(SEARCH_QUERIES)}"}), 400
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 20, type=int), 1), 100)
+
+    sql = ' UNION ALL '.join(SEARCH_QUERIES[t] for t in types) + ' ORDER BY score LIMIT :limit OFFSET :offset'
+    try:
+        rows = db.session.execute(db.text(sql), {
+            'q': match, 'limit': per_page + 1, 'offset': (page - 1) * per_page
+        }).all()
+    except Exception as e:
+        print(f"❌ Error in search: {str(e)}")
+        return jsonify({'error': 'Invalid search query'}), 400
+
+    return jsonify({
+        'query': request.args.get('q'),
+        'page': page,
+        'per_page': per_page,
+        'has_more': len(rows) > per_page,
+        'results': [{
+            'type': r[0],
+            'id': r[1],
+            'title': r[2],
+            'subtitle': r[3],
+            'company_id': r[4],
+            'score': round(-r[5], 4)  # bm25 is negative; larger is better here
+        } for r in rows[:per_page]]
+    })
+
+with app.app_context():
+    ensure_search_indexes()
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
@@ -0,0 +1,12 @@
+"""
+Headless entry points for batch invoice work.
+
+Run from the backend directory (the app resolves uploads/, templates/ and the
+SQLite database relative to it):
+
+    python -m invoice_generator generate --month 03 --year 2025 --timesheets /data/2025-03
+    python -m invoice_generator resume --batch-key cli:2025-03:all
+    python -m invoice_generator render --month 03 --year 2025
+    python -m invoice_generator export --kind receivables --format xlsx --output ar.xlsx
+    python -m invoice_generator bench-hash --rounds 50
+"""
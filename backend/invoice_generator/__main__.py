@@ -0,0 +1,494 @@
+"""
+Month-end batch CLI: generate, render and export invoices straight against the
+database, without going through Flask routes or request limits.
+
+Timesheet parsing and DOCX rendering run in a multiprocessing pool; database
+writes stay in the parent so SQLite only ever sees one writer.
+
+`generate` records its run as a batch with a checkpoint per timesheet, so a
+rerun (or `resume`) skips everything that already completed.
+"""
+import argparse
+import os
+import shutil
+import sys
+import time
+from contextlib import contextmanager
+from multiprocessing import Pool
+from types import SimpleNamespace
+
+from werkzeug.utils import secure_filename
+
+from app_fixed import (
+    app, db, Company, PONumber, Invoice, allowed_file, process_timesheet, render_invoice_docx, iter_export_rows, stream_csv, stream_xlsx, rebuild_analytics,
+    INVOICE_EXPORT_COLUMNS, RECEIVABLE_EXPORT_COLUMNS, InvoiceSequence, InvoiceNumberAllocator,
+    allocate_invoice_sequence, archive_invoices, vacuum_database, GenerationBatch, BatchConflictError,
+    get_or_create_batch, sync_batch_item, checkpoint, persist_batch_items, finish_batch, batch_summary,
+    stage_reached, file_sha256, batch_timesheet_path
+)
+
+
+class ProgressBar:
+    """Minimal stderr progress bar (no third-party dependency)"""
+
+    def __init__(self, total, label, width=30):
+        self.total = total
+        self.label = label
+        self.width = width
+        self.done = 0
+        self.started = time.perf_counter()
+
+    def update(self, step=1):
+        self.done += step
+        filled = int(self.width * self.done / self.total) if self.total else self.width
+        elapsed = time.perf_counter() - self.started
+        sys.stderr.write(
+            f"\r{self.label:<10} [{'#' * filled}{'.' * (self.width - filled)}] "
+            f"{self.done}/{self.total} {elapsed:6.1f}s"
+        )
+        sys.stderr.flush()
+
+    def close(self):
+        sys.stderr.write('\n')
+        sys.stderr.flush()
+
+
+class Timings:
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def measure(self, stage, count=0):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((stage, time.perf_counter() - started, count))
+
+    def report(self):
+        print('\nTiming summary')
+        total = 0
+        for stage, seconds, count in self.stages:
+            total += seconds
+            rate = f"  ({count / seconds:.1f}/s)" if count and seconds else ''
+            print(f"  {stage:<12} {seconds:8.2f}s  {count:>6} items{rate}")
+        print(f"  {'total':<12} {total:8.2f}s")
+
+
+# ---------------------------------------------------------------------------
+# Worker functions (top level so they pickle under spawn as well as fork)
+# ---------------------------------------------------------------------------
+def _init_worker(verbose):
+    if not verbose:
+        # The parsing/rendering helpers print DEBUG lines; keep the progress bar readable
+        sys.stdout = open(os.devnull, 'w')
+    with app.app_context():
+        # Never share the parent's pooled SQLite connections across a fork
+        db.engine.dispose(close=False)
+
+
+def _parse_job(job):
+    key, path, rates, client_type = job
+    try:
+        return key, path, process_timesheet(path, SimpleNamespace(**rates), client_type)
+    except Exception as e:
+        return key, path, {'error': str(e)}
+
+
+def _render_job(invoice_id):
+    with app.app_context():
+        try:
+            invoice = db.session.get(Invoice, invoice_id)
+            output_path, _ = render_invoice_docx(invoice)
+            return invoice_id, output_path, None
+        except Exception as e:
+            return invoice_id, None, str(e)
+        finally:
+            db.session.remove()
+
+
+def _stress_job(job):
+    """Allocate `count` serials the way generate_invoice does (or from reserved blocks)"""
+    company_id, fiscal_year, count, mode, block_size = job
+    serials, errors = [], []
+    allocator = InvoiceNumberAllocator(block_size)
+    with app.app_context():
+        for _ in range(count):
+            try:
+                if mode == 'block':
+                    serials.append(allocator.next_serial(company_id, fiscal_year))
+                else:
+                    serials.append(allocate_invoice_sequence(company_id, fiscal_year))
+                    db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                errors.append(str(e))
+        db.session.remove()
+    return serials, errors
+
+
+# ---------------------------------------------------------------------------
+# Commands
+# ---------------------------------------------------------------------------
+def _po_timesheet_dir(root, po):
+    for name in (po.po_number, secure_filename(po.po_number), str(po.id)):
+        candidate = os.path.join(root, name)
+        if name and os.path.isdir(candidate):
+            return candidate
+    return None
+
+
+def _collect_parse_jobs(args):
+    """Timesheets live in <timesheets>/<po_number>/*.xlsx (a PO id folder also works)"""
+    q = PONumber.query.join(Company).filter(Company.is_active.is_(True))
+    if args.po_id:
+        q = q.filter(PONumber.id.in_(args.po_id))
+
+    jobs = []
+    for po in q.all():
+        folder = _po_timesheet_dir(args.timesheets, po)
+        if not folder:
+            continue
+        for name in sorted(os.listdir(folder)):
+            if allowed_file(name) and name.lower().endswith(('.xlsx', '.xls')):
+                jobs.append((po.id, os.path.join(folder, name), _po_rates(po), po.company.client_type))
+    return jobs
+
+
+def _po_rates(po):
+    return {
+        'hourly_rate': po.hourly_rate,
+        'monthly_budget': po.monthly_budget,
+        'igst': po.igst,
+        'cgst': po.cgst,
+        'sgst': po.sgst
+    }
+
+
+def _render(invoice_ids, args, timings):
+    failures = []
+    with timings.measure('render', len(invoice_ids)):
+        bar = ProgressBar(len(invoice_ids), 'render')
+        with Pool(args.workers, initializer=_init_worker, initargs=(args.verbose,)) as pool:
+            for invoice_id, output_path, error in pool.imap_unordered(_render_job, invoice_ids):
+                if error:
+                    failures.append((invoice_id, error))
+                bar.update()
+        bar.close()
+    for invoice_id, error in failures:
+        print(f"❌ Invoice {invoice_id}: {error}")
+    return failures
+
+
+def _batch_key(args):
+    if args.batch_key:
+        return args.batch_key
+    scope = ','.join(str(p) for p in sorted(args.po_id)) if args.po_id else 'all'
+    return f"cli:{args.year}-{args.month}:{scope}"
+
+
+def _print_batch(batch):
+    summary = batch_summary(batch)
+    stages = ', '.join(f"{stage} {count}" for stage, count in sorted(summary['stages'].items()))
+    print(f"Batch {batch.id} [{batch.idempotency_key}] {batch.status}: {summary['items']} timesheets ({stages})")
+
+
+def _run_batch(batch, args, timings):
+    """Carry every item of `batch` forward from its last checkpoint"""
+    _print_batch(batch)
+    items = {item.id: item for item in batch.items}
+    pos = {po.id: po for po in PONumber.query.filter(PONumber.id.in_({i.po_id for i in items.values()})).all()}
+    failed = False
+
+    jobs = []
+    for item in items.values():
+        if stage_reached(item, 'computed'):
+            continue
+        po = pos.get(item.po_id)
+        if po is None or not item.source_path or not os.path.exists(item.source_path):
+            print(f"❌ {item.filename}: PO or source file no longer available")
+            failed = True
+            continue
+        jobs.append((item.id, item.source_path, _po_rates(po), po.company.client_type))
+
+    if jobs:
+        with timings.measure('parse', len(jobs)):
+            bar = ProgressBar(len(jobs), 'parse')
+            with Pool(args.workers, initializer=_init_worker, initargs=(args.verbose,)) as pool:
+                for item_id, path, result in pool.imap_unordered(_parse_job, jobs, chunksize=4):
+                    item = items[item_id]
+                    stored = batch_timesheet_path(batch, item.po_id, item.filename)
+                    shutil.copyfile(path, stored)
+                    result['filename'] = item.filename
+                    result['filepath'] = stored
+                    checkpoint(item, 'computed', result)
+                    bar.update()
+            bar.close()
+
+    by_po = {}
+    for item in items.values():
+        by_po.setdefault(item.po_id, []).append(item)
+    with timings.measure('persist', len(by_po)):
+        for po_id, po_items in sorted(by_po.items()):
+            po = pos.get(po_id)
+            to_persist = [i for i in po_items if i.stage == 'computed']
+            if po is None or not to_persist or any(not stage_reached(i, 'computed') for i in po_items):
+                continue
+            if any(stage_reached(i, 'persisted') for i in po_items):
+                print(f"❌ PO {po.po_number}: already invoiced in this batch; "
+                      f"{len(to_persist)} new timesheets need a new --batch-key")
+                failed = True
+                continue
+            # Keep file order stable so invoice lines match the directory listing
+            to_persist.sort(key=lambda i: i.source_path or i.filename)
+            try:
+                invoice, results = persist_batch_items(batch, po.company, po, to_persist)
+                db.session.commit()
+                print(f"✅ {invoice.invoice_number}: {len(results)} timesheets, sub total {invoice.sub_total:,.2f}")
+            except Exception as e:
+                db.session.rollback()
+                print(f"❌ PO {po.po_number}: {str(e)}")
+                failed = True
+
+    if batch.render:
+        to_render = sorted({i.invoice_id for i in items.values() if i.stage == 'persisted'})
+        if to_render:
+            render_failures = {invoice_id for invoice_id, _ in _render(to_render, args, timings)}
+            failed = failed or bool(render_failures)
+            for item in items.values():
+                if item.stage == 'persisted' and item.invoice_id not in render_failures:
+                    item.stage = 'rendered'
+            db.session.commit()
+
+    finish_batch(batch)
+    if batch.status != 'completed':
+        batch.status = 'failed' if failed else 'running'
+        db.session.commit()
+    _print_batch(batch)
+    return 0 if batch.status == 'completed' else 1
+
+
+def cmd_generate(args, timings):
+    with timings.measure('discover'):
+        jobs = _collect_parse_jobs(args)
+    if not jobs:
+        print(f"No timesheets found under {args.timesheets}")
+        return 1
+
+    try:
+        batch = get_or_create_batch(_batch_key(args), 'cli', args.month, args.year, render=args.render)
+    except BatchConflictError as e:
+        print(f"❌ {str(e)}")
+        return 1
+    if args.render:
+        batch.render = True
+    with timings.measure('checkpoint', len(jobs)):
+        for po_id, path, _, _ in jobs:
+            sync_batch_item(batch, po_id, secure_filename(os.path.basename(path)), file_sha256(path), source_path=path)
+        db.session.commit()
+    return _run_batch(batch, args, timings)
+
+
+def cmd_resume(args, timings):
+    if args.batch_id:
+        batch = db.session.get(GenerationBatch, args.batch_id)
+    else:
+        batch = GenerationBatch.query.filter_by(idempotency_key=args.batch_key).first()
+    if batch is None:
+        print('No such batch')
+        return 1
+    if batch.source != 'cli':
+        print('API batches resume when the request is retried with the same Idempotency-Key')
+        return 1
+    if batch.status == 'completed':
+        _print_batch(batch)
+        return 0
+    return _run_batch(batch, args, timings)
+
+
+def cmd_render(args, timings):
+    q = db.session.query(Invoice.id)
+    if args.invoice_id:
+        q = q.filter(Invoice.id.in_(args.invoice_id))
+    if args.month:
+        q = q.filter(Invoice.month == args.month)
+    if args.year:
+        q = q.filter(Invoice.year == args.year)
+    invoice_ids = [row[0] for row in q.order_by(Invoice.id).all()]
+    if not invoice_ids:
+        print('No invoices matched')
+        return 1
+    return 1 if _render(invoice_ids, args, timings) else 0
+
+
+def cmd_export(args, timings):
+    columns = INVOICE_EXPORT_COLUMNS if args.kind == 'invoices' else RECEIVABLE_EXPORT_COLUMNS
+    records = iter_export_rows(args.kind, company_id=args.company_id, year=args.year, month=args.month)
+    with timings.measure('export'):
+        if args.format == 'csv':
+            with open(args.output, 'w', newline='', encoding='utf-8') as f:
+                for chunk in stream_csv(records, columns):
+                    f.write(chunk)
+        else:
+            with open(args.output, 'wb') as f:
+                for chunk in stream_xlsx(records, columns, args.kind.capitalize()):
+                    f.write(chunk)
+    print(f"Wrote {args.output}")
+    return 0
+
+
+def cmd_bench_hash(args, timings):
+    """Time password verification per hash spec to pick PASSWORD_HASH_METHOD"""
+    from werkzeug.security import generate_password_hash, check_password_hash
+
+    methods = args.method or [
+        app.config['PASSWORD_HASH_METHOD'],
+        'pbkdf2:sha256:260000',
+        'pbkdf2:sha256:600000',
+        'scrypt:16384:8:1',
+        'scrypt:32768:8:1'
+    ]
+    print(f"{'method':<26} {'mean ms':>9} {'p95 ms':>9} {'checks/s/core':>14}")
+    for method in dict.fromkeys(methods):
+        stored = generate_password_hash('benchmark-password', method=method)
+        samples = []
+        with timings.measure(method, args.rounds):
+            for _ in range(args.rounds):
+                started = time.perf_counter()
+                check_password_hash(stored, 'wrong-password')
+                samples.append(time.perf_counter() - started)
+        samples.sort()
+        mean = sum(samples) / len(samples)
+        p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+        marker = '  <- configured' if method == app.config['PASSWORD_HASH_METHOD'] else ''
+        print(f"{method:<26} {mean * 1000:9.1f} {p95 * 1000:9.1f} {1 / mean:14.1f}{marker}")
+    return 0
+
+
+def cmd_rebuild_analytics(args, timings):
+    with timings.measure('rebuild'):
+        stats = rebuild_analytics(batch_size=args.batch_size)
+    print(f"Rebuilt analytics from {stats['invoices']} invoices: "
+          f"{stats['revenue_rows']} revenue rows, {stats['usage_rows']} usage rows")
+    return 0
+
+
+def cmd_archive(args, timings):
+    with timings.measure('archive'):
+        stats = archive_invoices(months=args.months, batch_size=args.batch_size, dry_run=args.dry_run)
+    verb = 'Would archive' if args.dry_run else 'Archived'
+    count = stats['candidates'] if args.dry_run else stats['archived']
+    print(f"{verb} {count} paid invoices created before {stats['cutoff']}")
+    if stats['bytes_before']:
+        print(f"  invoice_data {stats['bytes_before']:,} -> {stats['bytes_after']:,} bytes compressed")
+    if args.vacuum and not args.dry_run:
+        with timings.measure('vacuum'):
+            vacuum_database()
+    return 0
+
+
+def cmd_stress_invoice_numbers(args, timings):
+    """
+    Hammer the invoice sequence from many processes at once and verify every
+    serial is handed out exactly once with no lock errors. Uses a scratch
+    (company, fiscal year) row that is removed afterwards.
+    """
+    company_id, fiscal_year = -1, 9999
+    InvoiceSequence.query.filter_by(company_id=company_id, fiscal_year=fiscal_year).delete()
+    db.session.commit()
+
+    jobs = [(company_id, fiscal_year, args.per_worker, args.mode, args.block_size)] * args.workers
+    serials, errors = [], []
+    total = args.workers * args.per_worker
+    with timings.measure(f'alloc-{args.mode}', total):
+        with Pool(args.workers, initializer=_init_worker, initargs=(args.verbose,)) as pool:
+            for worker_serials, worker_errors in pool.imap_unordered(_stress_job, jobs):
+                serials.extend(worker_serials)
+                errors.extend(worker_errors)
+
+    InvoiceSequence.query.filter_by(company_id=company_id, fiscal_year=fiscal_year).delete()
+    db.session.commit()
+
+    duplicates = len(serials) - len(set(serials))
+    print(f"{args.workers} workers x {args.per_worker} allocations ({args.mode}): "
+          f"{len(serials)} serials, {duplicates} duplicates, {len(errors)} errors")
+    for error in sorted(set(errors))[:5]:
+        print(f"  ❌ {error}")
+    if args.mode == 'single' and sorted(serials) != list(range(1, total + 1)):
+        print("  ❌ serials are not gapless")
+        return 1
+    return 1 if duplicates or errors or len(serials) != total else 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m invoice_generator', description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker processes (default: CPU count)')
+    parser.add_argument('--verbose', action='store_true', help='keep DEBUG output from workers')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    gen = sub.add_parser('generate', help='parse timesheets and create invoices')
+    gen.add_argument('--month', required=True, help='two digit month, e.g. 03')
+    gen.add_argument('--year', required=True, type=int)
+    gen.add_argument('--timesheets', required=True, help='directory containing one folder per PO number')
+    gen.add_argument('--po-id', type=int, action='append', help='restrict to these PO ids (repeatable)')
+    gen.add_argument('--render', action='store_true', help='also render DOCX for the new invoices')
+    gen.add_argument('--batch-key', help='idempotency key (default: cli:<year>-<month>:<po ids or all>)')
+    gen.set_defaults(func=cmd_generate)
+
+    res = sub.add_parser('resume', help='continue an interrupted generate batch from its checkpoints')
+    target = res.add_mutually_exclusive_group(required=True)
+    target.add_argument('--batch-id', type=int)
+    target.add_argument('--batch-key')
+    res.set_defaults(func=cmd_resume)
+
+    ren = sub.add_parser('render', help='render DOCX files for existing invoices')
+    ren.add_argument('--invoice-id', type=int, action='append')
+    ren.add_argument('--month')
+    ren.add_argument('--year', type=int)
+    ren.set_defaults(func=cmd_render)
+
+    exp = sub.add_parser('export', help='write invoices or receivables to CSV/XLSX')
+    exp.add_argument('--kind', choices=['invoices', 'receivables'], default='invoices')
+    exp.add_argument('--format', choices=['csv', 'xlsx'], default='csv')
+    exp.add_argument('--output', required=True)
+    exp.add_argument('--company-id', type=int)
+    exp.add_argument('--month')
+    exp.add_argument('--year', type=int)
+    exp.set_defaults(func=cmd_export)
+
+    rebuild = sub.add_parser('rebuild-analytics', help='recompute analytics rollups from all invoices')
+    rebuild.add_argument('--batch-size', type=int, default=500)
+    rebuild.set_defaults(func=cmd_rebuild_analytics)
+
+    arch = sub.add_parser('archive', help='move old, fully paid invoices to the compressed archive')
+    arch.add_argument('--months', type=int, help='age horizon (default ARCHIVE_HORIZON_MONTHS)')
+    arch.add_argument('--batch-size', type=int, default=200)
+    arch.add_argument('--dry-run', action='store_true')
+    arch.add_argument('--vacuum', action='store_true', help='VACUUM the main database afterwards')
+    arch.set_defaults(func=cmd_archive)
+
+    stress = sub.add_parser('stress-invoice-numbers', help='concurrent invoice number allocation check')
+    stress.add_argument('--per-worker', type=int, default=200)
+    stress.add_argument('--mode', choices=['single', 'block'], default='single',
+                        help='single: one serial per transaction (as generate does); block: reserved ranges')
+    stress.add_argument('--block-size', type=int, default=50)
+    stress.set_defaults(func=cmd_stress_invoice_numbers)
+
+    bench = sub.add_parser('bench-hash', help='measure login hash cost for PASSWORD_HASH_METHOD candidates')
+    bench.add_argument('--method', action='append', help="werkzeug hash spec, e.g. 'scrypt:32768:8:1' (repeatable)")
+    bench.add_argument('--rounds', type=int, default=20)
+    bench.set_defaults(func=cmd_bench_hash)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    timings = Timings()
+    with app.app_context():
+        status = args.func(args, timings)
+    timings.report()
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,116 @@
+"""
+Test setup: the app reads its database URIs at import time, so point them at a
+scratch directory first. Run from the backend directory: python -m pytest tests
+"""
+import io
+import os
+import sys
+import tempfile
+from datetime import date, timedelta
+
+import pytest
+from openpyxl import Workbook
+
+_workdir = tempfile.mkdtemp(prefix='invoice-tests-')
+os.environ['DATABASE_URI'] = f"sqlite:///{os.path.join(_workdir, 'timesheet.db')}"
+os.environ['ARCHIVE_DATABASE_URI'] = f"sqlite:///{os.path.join(_workdir, 'invoice_archive.db')}"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# uploads/ and documents/ are created relative to the working directory
+os.chdir(_workdir)
+
+import app_fixed  # noqa: E402
+from app_fixed import app, db, Company, PONumber, Employee  # noqa: E402
+
+app.config['TESTING'] = True
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    """Empty every table (both binds) and the in-process caches before each test"""
+    with app.app_context():
+        for metadata in db.metadatas.values():
+            for table in reversed(metadata.sorted_tables):
+                db.session.execute(table.delete())
+        db.session.commit()
+    app_fixed.response_cache = app_fixed.create_cache_backend()
+    app_fixed._fx_series = None
+    yield
+
+
+@pytest.fixture
+def ctx():
+    with app.app_context():
+        yield
+        db.session.remove()
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+def make_company(name='Acme', client_type='same_state', **po_fields):
+    """A company with one PO; returns (company_id, po_id)"""
+    with app.app_context():
+        company = Company(
+            name=name, contact_number='9999999999', building_no='1', local_street='Main Road',
+            city='Pune', state='Maharashtra', country='India', pin_code='411001',
+            email=f'{name.lower()}@example.com', client_type=client_type
+        )
+        po = PONumber(company=company, po_number=po_fields.pop('po_number', f'PO-{name}'),
+                      monthly_budget=po_fields.pop('monthly_budget', 22000),
+                      hourly_rate=po_fields.pop('hourly_rate', 10), **po_fields)
+        db.session.add_all([company, po])
+        db.session.commit()
+        return company.id, po.id
+
+
+def add_employee(po_id, name, email=None):
+    with app.app_context():
+        emp = Employee(po_id=po_id, name=name, email=email, date_of_joining='2024-01-01')
+        db.session.add(emp)
+        db.session.commit()
+        return emp.id
+
+
+def timesheet_xlsx(employee_name, year=2025, month=3, days=3, hours='8 hours', date_format='%Y-%m-%d'):
+    """An in-memory workbook laid out like the client timesheets (name in B2, header on row 5)"""
+    wb = Workbook()
+    ws = wb.active
+    ws.append(['Timesheet'])
+    ws.append(['Employee', employee_name])
+    ws.append(['Project', 'Billing'])
+    ws.append(['Location', 'Pune'])
+    ws.append(['Date', 'Day', 'Regular hours worked'])
+    day = date(year, month, 1)
+    while days:
+        if day.weekday() < 5:
+            ws.append([day.strftime(date_format), day.strftime('%A'), hours])
+            days -= 1
+        day += timedelta(days=1)
+    buf = io.BytesIO()
+    wb.save(buf)
+    buf.seek(0)
+    return buf
+
+
+def generate_invoice(client, company_id, po_id, employees=('Alice',), year=2025, month=3, files=None, key=None,
+                     **fields):
+    """
+    POST /api/invoices/generate with one timesheet per employee name, or with
+    explicit (filename, buffer) files; extra form fields go in `fields`. Returns the response.
+    """
+    if files is None:
+        files = [(f'{name}.xlsx', timesheet_xlsx(name, year=year, month=month)) for name in employees]
+    return client.post('/api/invoices/generate', data={
+        'company_id': str(company_id), 'po_id': str(po_id), 'month': f'{month:02d}', 'year': str(year),
+        'files': [(buf, filename) for filename, buf in files], **fields
+    }, headers={'Idempotency-Key': key} if key else {}, content_type='multipart/form-data')
+
+
+def generate_invoice_from_archive(client, company_id, po_id, archive, year=2025, month=3, key=None):
+    """POST a zip of timesheets to /api/invoices/generate-archive"""
+    return client.post('/api/invoices/generate-archive', data={
+        'company_id': str(company_id), 'po_id': str(po_id), 'month': f'{month:02d}', 'year': str(year),
+        'archive': (archive, 'timesheets.zip')
+    }, headers={'Idempotency-Key': key} if key else {}, content_type='multipart/form-data')
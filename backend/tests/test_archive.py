@@ -0,0 +1,58 @@
+import zlib
+from datetime import datetime
+
+from app_fixed import app, db, Invoice, ArchivedInvoice, archive_invoices, rebuild_analytics
+from conftest import make_company, generate_invoice
+
+
+def _archive_paid_invoice(client):
+    """Beta's invoice is old and fully paid; Acme's stays hot (the newest row is never archived)"""
+    beta = make_company('Beta')
+    acme = make_company('Acme')
+    old_id = generate_invoice(client, *beta, ['Bob'], year=2022).get_json()['invoice_id']
+    assert generate_invoice(client, *acme, ['Alice'], year=2022).status_code == 200
+    with app.app_context():
+        invoice = db.session.get(Invoice, old_id)
+        billed = invoice.sub_total
+        invoice.created_at = datetime(2022, 4, 1)
+        db.session.commit()
+    assert client.put(f'/api/invoices/{old_id}/payment', json={'paid_amount': billed}).status_code == 200
+    with app.app_context():
+        assert archive_invoices(months=24)['archived'] == 1
+        assert db.session.get(ArchivedInvoice, old_id) is not None
+    return old_id, billed
+
+
+def test_rebuild_analytics_keeps_archived_revenue(client):
+    _, billed = _archive_paid_invoice(client)
+    with app.app_context():
+        assert rebuild_analytics()['invoices'] == 2
+    revenue = {r['company_name']: r for r in client.get('/api/analytics/revenue').get_json()}
+    assert set(revenue) == {'Acme', 'Beta'}
+    assert revenue['Beta']['billed_amount'] == billed
+    assert revenue['Beta']['paid_amount'] == billed
+
+
+def test_rebuild_analytics_counts_a_half_archived_invoice_once(client):
+    old_id, billed = _archive_paid_invoice(client)
+    with app.app_context():
+        # What a crash between the archive commit and the hot delete leaves behind
+        a = db.session.get(ArchivedInvoice, old_id)
+        db.session.add(Invoice(
+            id=a.id, company_id=a.company_id, po_id=a.po_id, invoice_number=a.invoice_number,
+            invoice_data=zlib.decompress(a.invoice_data_gz).decode(), total_amount=a.total_amount,
+            sub_total=a.sub_total, paid_amount=a.paid_amount, due_amount=a.due_amount, fx_rate=a.fx_rate,
+            month=a.month, year=a.year, created_at=a.created_at))
+        db.session.commit()
+        assert rebuild_analytics(batch_size=1)['invoices'] == 2
+    revenue = {r['company_name']: r for r in client.get('/api/analytics/revenue').get_json()}
+    assert revenue['Beta']['billed_amount'] == billed
+
+
+def test_archived_invoice_payments_are_readable(client):
+    old_id, billed = _archive_paid_invoice(client)
+    response = client.get(f'/api/invoices/{old_id}/payments')
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['archived'] is True
+    assert [p['amount'] for p in body['payments']] == [billed]
@@ -0,0 +1,43 @@
+import io
+import zipfile
+
+from flask import request
+
+from app_fixed import app, Invoice
+from conftest import make_company, timesheet_xlsx, generate_invoice_from_archive
+
+
+def _zip(members):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        for name, employee in members:
+            zf.writestr(name, timesheet_xlsx(employee).read())
+    buf.seek(0)
+    return buf
+
+
+def test_same_named_members_in_different_folders_are_kept_apart(client):
+    company_id, po_id = make_company()
+    response = generate_invoice_from_archive(client, company_id, po_id, _zip([('team-a/sheet.xlsx', 'Alice'), ('team-b/sheet.xlsx', 'Bob')]))
+    assert response.status_code == 200, response.get_json()
+    employees = response.get_json()['employees']
+    assert sorted(e['employee_name'] for e in employees) == ['Alice', 'Bob']
+    assert len({e['filepath'] for e in employees}) == 2
+
+
+def test_archive_upload_is_idempotent(client):
+    company_id, po_id = make_company()
+    members = [('sheet.xlsx', 'Alice')]
+    first = generate_invoice_from_archive(client, company_id, po_id, _zip(members), key='zip-1')
+    again = generate_invoice_from_archive(client, company_id, po_id, _zip(members), key='zip-1')
+    assert again.headers['Idempotent-Replay'] == 'true'
+    assert again.get_json()['invoice_id'] == first.get_json()['invoice_id']
+    with app.app_context():
+        assert Invoice.query.count() == 1
+
+
+def test_large_body_limit_only_applies_to_the_archive_route():
+    with app.test_request_context('/api/invoices/generate-archive', method='POST'):
+        assert request.max_content_length == app.config['UPLOAD_LIMITS']['generate_invoice_from_archive']
+    with app.test_request_context('/api/invoices/generate', method='POST'):
+        assert request.max_content_length == app.config['DEFAULT_UPLOAD_LIMIT']
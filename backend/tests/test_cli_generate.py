@@ -0,0 +1,44 @@
+import json
+import os
+
+import pandas as pd
+
+from app_fixed import app, Invoice, PONumber
+from conftest import make_company, timesheet_xlsx
+from invoice_generator.__main__ import main
+
+
+def _write(path, employee_name):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(timesheet_xlsx(employee_name).read())
+
+
+def test_same_named_timesheets_in_different_po_folders_do_not_collide(tmp_path):
+    make_company('Acme')
+    make_company('Beta')
+    _write(tmp_path / 'PO-Acme' / 'timesheet.xlsx', 'Alice')
+    _write(tmp_path / 'PO-Beta' / 'timesheet.xlsx', 'Bob')
+
+    assert main(['--workers', '1', 'generate', '--month', '03', '--year', '2025',
+                 '--timesheets', str(tmp_path)]) == 0
+
+    with app.app_context():
+        stored = {}
+        for invoice in Invoice.query.join(PONumber).all():
+            (line,) = json.loads(invoice.invoice_data)['employees']
+            stored[invoice.po_number.po_number] = (line['employee_name'], line['filepath'])
+
+    assert {po: name for po, (name, _) in stored.items()} == {'PO-Acme': 'Alice', 'PO-Beta': 'Bob'}
+    for name, path in stored.values():
+        assert pd.read_excel(path, header=None).iloc[1, 1] == name
+
+
+def test_rerunning_generate_is_idempotent(tmp_path):
+    make_company('Acme')
+    _write(tmp_path / 'PO-Acme' / 'timesheet.xlsx', 'Alice')
+    args = ['--workers', '1', 'generate', '--month', '03', '--year', '2025', '--timesheets', str(tmp_path)]
+    assert main(args) == 0
+    assert main(args) == 0
+    with app.app_context():
+        assert Invoice.query.count() == 1
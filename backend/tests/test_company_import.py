@@ -0,0 +1,45 @@
+import json
+
+from app_fixed import app, db, PONumber, Employee
+from conftest import make_company
+
+
+def _import(client, rows, mode='upsert'):
+    body = '\n'.join(json.dumps(r) for r in rows)
+    response = client.post(f'/api/companies/import?mode={mode}', data=body, content_type='application/x-ndjson')
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert response.status_code == 200, lines
+    return lines[-1]
+
+
+def test_roster_sync_keeps_po_fields_it_does_not_mention(client):
+    company_id, po_id = make_company('Acme', monthly_budget=22000, igst=12, cgst=6, sgst=6)
+    summary = _import(client, [{'company_name': 'Acme', 'po_number': 'PO-Acme', 'employee_name': 'Alice'}])
+    assert summary['pos_updated'] == 1
+    with app.app_context():
+        po = db.session.get(PONumber, po_id)
+        assert (po.monthly_budget, po.igst, po.cgst, po.sgst) == (22000, 12, 6, 6)
+
+
+def test_new_po_gets_default_tax_rates(client):
+    make_company('Acme')
+    _import(client, [{'company_name': 'Acme', 'po_number': 'PO-2', 'hourly_rate': '25'}])
+    with app.app_context():
+        po = PONumber.query.filter_by(po_number='PO-2').one()
+        assert (po.hourly_rate, po.monthly_budget, po.igst, po.cgst, po.sgst) == (25, None, 18, 9, 9)
+
+
+def test_roster_sync_matches_employee_without_email_by_name(client):
+    _, po_id = make_company('Acme')
+    with app.app_context():
+        db.session.add(Employee(po_id=po_id, name='Alice Smith', email=None,
+                                date_of_joining='2024-01-01', location='Pune'))
+        db.session.commit()
+
+    summary = _import(client, [{'company_name': 'Acme', 'po_number': 'PO-Acme', 'employee_name': 'Alice Smith',
+                                'employee_email': 'alice@example.com'}])
+    assert (summary['employees_created'], summary['employees_updated']) == (0, 1)
+    with app.app_context():
+        [alice] = Employee.query.filter_by(po_id=po_id).all()
+        assert alice.email == 'alice@example.com'
+        assert (alice.date_of_joining, alice.location) == ('2024-01-01', 'Pune')
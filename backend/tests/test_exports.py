@@ -0,0 +1,27 @@
+import csv
+import io
+
+from app_fixed import app, db, Invoice, _export_query
+from conftest import make_company, generate_invoice
+
+
+def test_receivables_export_lists_only_outstanding_invoices(client):
+    paid_id = generate_invoice(client, *make_company('Acme')).get_json()['invoice_id']
+    open_id = generate_invoice(client, *make_company('Beta')).get_json()['invoice_id']
+    with app.app_context():
+        billed = db.session.get(Invoice, paid_id).sub_total
+        open_number = db.session.get(Invoice, open_id).invoice_number
+    assert client.put(f'/api/invoices/{paid_id}/payment', json={'paid_amount': billed}).status_code == 200
+
+    response = client.get('/api/exports/receivables')
+    assert response.status_code == 200
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert [r['invoice_number'] for r in rows] == [open_number]
+
+    invoices = list(csv.DictReader(io.StringIO(client.get('/api/exports/invoices').get_data(as_text=True))))
+    assert len(invoices) == 2
+
+
+def test_receivables_filter_runs_in_sql(ctx):
+    sql = str(_export_query(outstanding=True).statement)
+    assert 'invoice.due_amount >' in sql
@@ -0,0 +1,18 @@
+from datetime import date
+
+import app_fixed
+from app_fixed import db, FxRate, get_fx_rate
+
+
+def test_rates_written_by_another_worker_are_picked_up_after_ttl(ctx, monkeypatch):
+    db.session.add(FxRate(currency='USD', rate_date=date(2025, 1, 1), rate=80))
+    db.session.commit()
+    assert get_fx_rate('USD', date(2025, 3, 1)) == 80
+
+    # Another worker imports a rate; this process's cache version is never bumped
+    db.session.add(FxRate(currency='USD', rate_date=date(2025, 2, 1), rate=90))
+    db.session.commit()
+    assert get_fx_rate('USD', date(2025, 3, 1)) == 80
+
+    monkeypatch.setattr(app_fixed, '_fx_loaded_at', app_fixed._fx_loaded_at - app_fixed.app.config['FX_CACHE_TTL'] - 1)
+    assert get_fx_rate('USD', date(2025, 3, 1)) == 90
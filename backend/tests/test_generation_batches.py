@@ -0,0 +1,58 @@
+import os
+
+from app_fixed import app, db, GenerationBatch, GenerationBatchItem, Invoice
+from conftest import make_company, generate_invoice, timesheet_xlsx
+
+
+def test_first_time_upload_creates_invoice_and_batch(client):
+    company_id, po_id = make_company()
+    response = generate_invoice(client, company_id, po_id, key='k-0')
+    assert response.status_code == 200, response.get_json()
+    body = response.get_json()
+    assert body['employees'][0]['total_worked_days'] == 3
+
+    with app.app_context():
+        batch = db.session.get(GenerationBatch, body['batch_id'])
+        assert batch.status == 'completed'
+        assert [i.stage for i in batch.items] == ['persisted']
+        assert batch.items[0].invoice_id == body['invoice_id']
+
+
+def test_retry_with_same_key_replays_without_a_second_invoice(client):
+    company_id, po_id = make_company()
+    first = generate_invoice(client, company_id, po_id, key='k-1')
+    again = generate_invoice(client, company_id, po_id, key='k-1')
+    assert again.status_code == 200
+    assert again.headers['Idempotent-Replay'] == 'true'
+    assert again.get_json()['invoice_id'] == first.get_json()['invoice_id']
+    with app.app_context():
+        assert Invoice.query.count() == 1
+        assert GenerationBatchItem.query.count() == 1
+
+
+def test_key_reused_for_another_period_conflicts(client):
+    company_id, po_id = make_company()
+    generate_invoice(client, company_id, po_id, key='k-2')
+    response = generate_invoice(client, company_id, po_id, month=4, key='k-2')
+    assert response.status_code == 409
+
+
+def test_upload_without_key_keeps_the_invoice_but_no_batch(client):
+    company_id, po_id = make_company()
+    response = generate_invoice(client, company_id, po_id)
+    assert response.status_code == 200, response.get_json()
+    body = response.get_json()
+    assert body['batch_id'] is None
+    assert os.path.exists(body['employees'][0]['filepath'])
+    with app.app_context():
+        assert GenerationBatch.query.count() == 0
+        assert GenerationBatchItem.query.count() == 0
+
+
+def test_failed_upload_without_key_leaves_nothing_behind(client):
+    company_id, po_id = make_company()
+    april = [('Alice.xlsx', timesheet_xlsx('Alice', month=4))]
+    response = generate_invoice(client, company_id, po_id, files=april, validate='strict')
+    assert response.status_code == 422
+    with app.app_context():
+        assert GenerationBatch.query.count() == 0
@@ -0,0 +1,73 @@
+import threading
+
+from app_fixed import app, db, Invoice, InvoiceNumberAllocator, allocate_invoice_sequence
+from conftest import make_company, generate_invoice
+
+
+def _hammer(worker, company_id, fiscal_year, count, serials, errors):
+    with app.app_context():
+        for _ in range(count):
+            try:
+                serials.append(worker(company_id, fiscal_year))
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                errors.append(str(e))
+        db.session.remove()
+
+
+def _run_concurrently(make_worker, threads=8, per_thread=25):
+    serials, errors = [], []
+    workers = [threading.Thread(target=_hammer, args=(make_worker(), 1, 2025, per_thread, serials, errors))
+               for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return serials, errors
+
+
+def test_concurrent_allocation_is_unique_and_gapless():
+    serials, errors = _run_concurrently(lambda: allocate_invoice_sequence)
+    assert errors == []
+    assert sorted(serials) == list(range(1, 8 * 25 + 1))
+
+
+def test_block_reservations_never_overlap():
+    serials, errors = _run_concurrently(lambda: InvoiceNumberAllocator(block_size=7).next_serial)
+    assert errors == []
+    assert len(serials) == len(set(serials)) == 8 * 25
+
+
+def test_rolled_back_allocation_is_reused(ctx):
+    assert allocate_invoice_sequence(2, 2025) == 1
+    db.session.rollback()
+    assert allocate_invoice_sequence(2, 2025) == 1
+    db.session.commit()
+    assert allocate_invoice_sequence(2, 2025) == 2
+
+
+def test_concurrent_generate_requests_number_invoices_without_gaps():
+    company_id, po_id = make_company()
+    threads, per_thread = 16, 2
+    start = threading.Barrier(threads)
+    responses = []
+
+    def post_invoices():
+        client = app.test_client()
+        start.wait()
+        for _ in range(per_thread):
+            responses.append(generate_invoice(client, company_id, po_id))
+
+    workers = [threading.Thread(target=post_invoices) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    assert [r.status_code for r in responses] == [200] * threads * per_thread, \
+        [r.get_json() for r in responses if r.status_code != 200]
+    numbers = [r.get_json()['invoice_number'] for r in responses]
+    assert sorted(int(n.rsplit('-', 1)[1]) for n in numbers) == list(range(1, threads * per_thread + 1))
+    with app.app_context():
+        assert sorted(n for (n,) in db.session.query(Invoice.invoice_number)) == sorted(numbers)
@@ -0,0 +1,41 @@
+import pytest
+from werkzeug.security import generate_password_hash
+
+from app_fixed import app, db, User, hash_password, password_needs_rehash
+
+
+def _login_with_stored_hash(client, stored):
+    with app.app_context():
+        db.session.add(User(name='Ann', email='ann@example.com', password=stored, role='Admin'))
+        db.session.commit()
+    response = client.post('/api/login', json={'email': 'ann@example.com', 'password': 'secret'})
+    assert response.status_code == 200
+    with app.app_context():
+        return User.query.filter_by(email='ann@example.com').one().password
+
+
+def test_existing_scrypt_hash_is_not_downgraded_on_login(client):
+    stored = generate_password_hash('secret')  # Werkzeug default: scrypt
+    assert _login_with_stored_hash(client, stored) == stored
+
+
+def test_weaker_hash_of_the_configured_family_is_upgraded(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+    stored = generate_password_hash('secret', method='pbkdf2:sha256:1000')
+    assert _login_with_stored_hash(client, stored).startswith('pbkdf2:sha256:600000$')
+
+
+@pytest.mark.parametrize('configured, stored, expected', [
+    ('scrypt:32768:8:1', 'scrypt:16384:8:1$s$h', True),
+    ('scrypt:32768:8:1', 'scrypt:65536:8:1$s$h', False),
+    ('scrypt:32768:8:1', 'pbkdf2:sha256:600000$s$h', False),
+    ('pbkdf2:sha256:600000', 'scrypt:32768:8:1$s$h', False),
+])
+def test_only_weaker_same_family_hashes_need_rehash(monkeypatch, configured, stored, expected):
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_METHOD', configured)
+    assert password_needs_rehash(stored) is expected
+
+
+def test_configured_hash_fits_the_password_column():
+    with app.app_context():
+        assert len(hash_password('secret')) <= User.__table__.c.password.type.length
@@ -0,0 +1,55 @@
+import io
+
+from app_fixed import app, db, Invoice, Payment
+from conftest import make_company, generate_invoice
+
+
+def _invoice(client):
+    company_id, po_id = make_company('Acme')
+    response = generate_invoice(client, company_id, po_id)
+    assert response.status_code == 200, response.get_json()
+    with app.app_context():
+        invoice = db.session.get(Invoice, response.get_json()['invoice_id'])
+        return invoice.id, invoice.invoice_number, invoice.due_amount
+
+
+def test_bulk_payment_reports_overpayment(client):
+    invoice_id, number, due = _invoice(client)
+    response = client.post('/api/payments/bulk', json={
+        'receipt_reference': 'UTR1',
+        'allocations': [{'invoice_id': invoice_id, 'amount': due - 100},
+                        {'invoice_number': number, 'amount': 150}]
+    })
+    assert response.status_code == 400
+    [error] = response.get_json()['details']
+    assert error['index'] == 1
+    assert error['error'] == 'amount exceeds outstanding balance'
+    assert error['overpayment'] == 50
+    with app.app_context():
+        assert Payment.query.count() == 0
+        assert db.session.get(Invoice, invoice_id).due_amount == due
+
+
+def test_bank_import_reports_bad_rows_individually(client):
+    _, number, due = _invoice(client)
+    csv_text = (
+        'date,description,amount\n'
+        f'01/04/2025,NEFT {number},100\n'
+        f'not-a-date,NEFT {number},100\n'
+        f'02/04/2025,NEFT {number},{due}\n'
+        '03/04/2025,NEFT no reference,100\n'
+    )
+    response = client.post('/api/payments/import', data={
+        'file': (io.BytesIO(csv_text.encode()), 'statement.csv')
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200, response.get_json()
+    body = response.get_json()
+    assert body['posted'] == 1
+    assert body['total_allocated'] == 100
+    rows = {u['row']: u for u in body['unmatched']}
+    assert set(rows) == {3, 4, 5}
+    assert 'Unrecognised date' in rows[3]['error']
+    assert rows[4]['error'] == 'amount exceeds outstanding balance'
+    assert rows[4]['overpayment'] == 100
+    with app.app_context():
+        assert Invoice.query.filter_by(invoice_number=number).one().due_amount == due - 100
@@ -0,0 +1,43 @@
+import pytest
+
+import app_fixed
+from app_fixed import app, read_snapshot
+from conftest import make_company, generate_invoice
+
+
+@pytest.fixture
+def snapshot_mode(monkeypatch):
+    # Tests refresh the snapshot explicitly instead of racing the background thread
+    monkeypatch.setattr(app_fixed.SnapshotReader, '_ensure_refresher', lambda self: None)
+    app.config.update(READ_ROUTING='snapshot', READ_MAX_STALENESS=3600)
+    yield
+    app.config.update(READ_ROUTING='off', READ_MAX_STALENESS=60)
+
+
+def test_list_reads_snapshot_and_can_force_primary(client, snapshot_mode):
+    with app.app_context():
+        read_snapshot.refresh()
+    invoice_id = generate_invoice(client, *make_company()).get_json()['invoice_id']
+
+    stale = client.get('/api/invoices')
+    assert stale.headers['X-Read-Source'] == 'snapshot'
+    assert invoice_id not in [i['id'] for i in stale.get_json()]
+
+    fresh = client.get('/api/invoices', headers={'X-Read-Consistency': 'primary'})
+    assert fresh.headers['X-Read-Source'] == 'primary'
+    assert invoice_id in [i['id'] for i in fresh.get_json()]
+
+
+def test_detail_always_reads_primary(client, snapshot_mode):
+    invoice_id = generate_invoice(client, *make_company()).get_json()['invoice_id']
+    with app.app_context():
+        read_snapshot.refresh()
+    assert client.put(f'/api/invoices/{invoice_id}/payment', json={'paid_amount': 9999}).status_code == 200
+    response = client.get(f'/api/invoices/{invoice_id}')
+    assert 'X-Read-Source' not in response.headers
+    assert response.get_json()['paid_amount'] == 9999
+
+
+def test_stale_snapshot_falls_back_to_primary_without_blocking(client, snapshot_mode, monkeypatch):
+    monkeypatch.setattr(read_snapshot, 'refreshed_at', 0.0)
+    assert client.get('/api/invoices').headers['X-Read-Source'] == 'primary'
@@ -0,0 +1,24 @@
+import pytest
+
+from conftest import make_company, add_employee
+
+
+@pytest.fixture
+def indexed():
+    company_id, po_id = make_company('Globex', po_number='GLX-4471')
+    add_employee(po_id, 'Grace Hopper', 'grace@globex.com')
+    return company_id, po_id
+
+
+@pytest.mark.parametrize('q, types, expected', [
+    ('globex', 'company', {('company', 'Globex')}),
+    ('glx', 'po', {('po', 'GLX-4471')}),
+    ('grace', 'employee', {('employee', 'Grace Hopper')}),
+    ('glx', 'invoice', set()),
+    ('glx', 'po,employee', {('po', 'GLX-4471')}),
+])
+def test_any_subset_of_types_can_be_searched(client, indexed, q, types, expected):
+    response = client.get(f'/api/search?q={q}&types={types}')
+    assert response.status_code == 200, response.get_json()
+    assert {(r['type'], r['title']) for r in response.get_json()['results']} == expected
+
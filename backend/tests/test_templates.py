@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+import app_fixed
+from app_fixed import app, db, InvoiceTemplate, compiled_templates, load_compiled_template, seed_builtin_templates
+from conftest import make_company, generate_invoice
+
+
+@pytest.fixture
+def builtins(ctx):
+    seed_builtin_templates()
+    return {t.client_type: t for t in InvoiceTemplate.query.filter(InvoiceTemplate.company_id.is_(None))}
+
+
+def test_builtins_are_seeded_with_absolute_paths(builtins):
+    assert set(builtins) == {'same_state', 'other_state', 'foreign'}
+    for template in builtins.values():
+        assert os.path.isabs(template.file_path) and os.path.exists(template.file_path)
+
+
+def test_relative_builtin_paths_are_repaired(builtins):
+    builtins['same_state'].file_path = 'templates/same_state.docx'
+    db.session.commit()
+    seed_builtin_templates()
+    assert builtins['same_state'].file_path == os.path.join(app.config['TEMPLATES_FOLDER'], 'same_state.docx')
+
+
+def test_builtin_templates_cannot_be_deactivated(client, builtins):
+    template_id = builtins['same_state'].id
+    response = client.put(f'/api/templates/{template_id}/status', json={'is_active': False})
+    assert response.status_code == 400
+    assert db.session.get(InvoiceTemplate, template_id).is_active
+
+
+def test_template_is_parsed_once_and_copied_per_render(builtins, monkeypatch):
+    parses = []
+    real_document = app_fixed.Document
+    monkeypatch.setattr(app_fixed, 'Document', lambda source: parses.append(source) or real_document(source))
+    template = builtins['same_state']
+    compiled_templates._data.clear()
+
+    first = load_compiled_template(template)
+    first.paragraphs[0].text = 'filled'
+    second = load_compiled_template(template)
+    assert len(parses) == 1
+    assert second.paragraphs[0].text != 'filled'
+
+
+def test_docx_download_renders_from_the_cached_template(client, builtins):
+    company_id, po_id = make_company()
+    invoice_id = generate_invoice(client, company_id, po_id).get_json()['invoice_id']
+    for _ in range(2):
+        response = client.get(f'/api/invoices/{invoice_id}/download-docx')
+        assert response.status_code == 200
+        assert response.data[:2] == b'PK'
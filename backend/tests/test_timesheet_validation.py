@@ -0,0 +1,23 @@
+import pandas as pd
+
+from app_fixed import parse_timesheet_dates
+from conftest import make_company, add_employee, timesheet_xlsx
+
+
+def test_slash_dates_are_read_day_first():
+    dates = parse_timesheet_dates(pd.Series(['04/03/2025', '2025-03-05', '13-03-2025', 'n/a', None]))
+    assert [d.strftime('%Y-%m-%d') if not pd.isna(d) else None for d in dates] == \
+        ['2025-03-04', '2025-03-05', '2025-03-13', None, None]
+
+
+def test_day_first_timesheet_is_inside_the_billing_period(client):
+    company_id, po_id = make_company()
+    add_employee(po_id, 'Alice')
+    response = client.post('/api/timesheets/validate', data={
+        'company_id': str(company_id), 'po_id': str(po_id), 'month': '03', 'year': '2025',
+        'files': [(timesheet_xlsx('Alice', date_format='%d/%m/%Y'), 'alice.xlsx')]
+    }, content_type='multipart/form-data')
+    assert response.status_code == 200
+    codes = {i['code'] for f in response.get_json()['files'] for i in f['issues']}
+    assert 'date_outside_period' not in codes
+    assert 'duplicate_dates' not in codes
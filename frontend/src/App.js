@@ -3,6 +3,15 @@ import { Upload, Trash2, Plus, X, Loader2 } from 'lucide-react';
 
 const API_URL = 'http://localhost:5000/api';
 
+const INVOICE_TABLE_FIELDS = [
+  'id', 'invoice_number', 'company_name', 'po_number', 'client_type', 'sub_total',
+  'sub_total_in_inr', 'paid_amount', 'due_amount', 'month', 'year', 'created_at'
+];
+
+// Turn a ?format=columnar payload ({ fields, count, columns }) back into row objects
+const fromColumnar = ({ fields, count, columns }) =>
+  Array.from({ length: count }, (_, i) => Object.fromEntries(fields.map(f => [f, columns[f][i]])));
+
 export default function TimesheetApp() {
   const [activeTab, setActiveTab] = useState('onboard');
   const [enabled, setEnabled] = useState(false);
@@ -90,7 +99,7 @@ export default function TimesheetApp() {
       </div>
 
       {activeTab === 'onboard' && <CompanyOnboarding />}
-      {activeTab === 'invoice' && <InvoiceGeneration companies={companies} />}
+      {activeTab === 'invoice' && <InvoiceGeneration />}
       {activeTab === 'history' && <InvoiceHistory />}
       {activeTab === 'companies' && (
         <div className="mt-6">
@@ -484,7 +493,8 @@ function CompanyOnboarding() {
   );
 }
 
-function InvoiceGeneration({ companies }) {
+function InvoiceGeneration() {
+  const [companies, setCompanies] = useState([]);
   const [selectedCompany, setSelectedCompany] = useState('');
   const [selectedPO, setSelectedPO] = useState('');
   const [poNumbers, setPoNumbers] = useState([]);
@@ -495,33 +505,29 @@ function InvoiceGeneration({ companies }) {
   const [loading, setLoading] = useState(false);
   const [employees, setEmployees] = useState([]);
 
+  // One request for companies -> POs -> employees; dropdown changes are resolved locally
+  useEffect(() => {
+    fetch(`${API_URL}/invoice-form/bootstrap`)
+      .then(r => r.json())
+      .then(data => setCompanies(Array.isArray(data.companies) ? data.companies : []))
+      .catch(() => setCompanies([]));
+  }, []);
+
   const handleCompanyChange = (e) => {
     const companyId = e.target.value;
     setSelectedCompany(companyId);
     setSelectedPO('');
     setEmployees([]);
     setTimesheets([]);
-    if (companyId) {
-      fetch(`${API_URL}/companies/${companyId}/po-numbers`).then(r => r.json()).then(setPoNumbers);
-    }
+    const company = companies.find(c => String(c.id) === companyId);
+    setPoNumbers(company ? company.po_numbers : []);
   };
 
   useEffect(() => {
-    if (!selectedPO) {
-      setEmployees([]);
-      setTimesheets([]);
-      return;
-    }
-    fetch(`${API_URL}/po-numbers/${selectedPO}/employees`)
-      .then(r => r.json())
-      .then(list => {
-        setEmployees(Array.isArray(list) ? list : []);
-        setTimesheets([]);
-      })
-      .catch(() => {
-        setEmployees([]);
-      });
-  }, [selectedPO]);
+    setTimesheets([]);
+    const po = poNumbers.find(p => String(p.id) === String(selectedPO));
+    setEmployees(po ? po.employees : []);
+  }, [selectedPO, poNumbers]);
 
   const generateInvoice = async () => {
     if (!selectedCompany || !selectedPO || !month || timesheets.length === 0) {
@@ -670,7 +676,12 @@ function InvoiceHistory() {
   });
 
   useEffect(() => {
-    fetch(`${API_URL}/invoices`).then(r => r.json()).then(setInvoices).catch(console.error).finally(() => setLoading(false));
+    // Only the columns this table renders, as column arrays (the server gzips the response)
+    fetch(`${API_URL}/invoices?format=columnar&fields=${INVOICE_TABLE_FIELDS.join(',')}`)
+      .then(r => r.json())
+      .then(data => setInvoices(fromColumnar(data)))
+      .catch(console.error)
+      .finally(() => setLoading(false));
   }, []);
 
   const startEdit = (inv) => {